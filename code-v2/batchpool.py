@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Run the per-case work of step1.py / step2.py on a pool of worker processes.
+#
+# Only the per-case function runs in the workers, everything else (resume
+# checks, csv appends, progress output) stays in the parent process, so the
+# csv files keep a single writer and rows never interleave.
+
+import os, os.path
+import sys
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+# default number of worker processes
+default_workers = os.cpu_count() or 1
+
+
+# call func(item) and catch the failure, so a single bad case never stops
+# the batch. return (item, result, error) where error is the traceback text
+def call_safely(func, item):
+    try:
+        return item, func(item), None
+    except (Exception, SystemExit):
+        return item, None, traceback.format_exc()
+
+
+# Run func over items with `workers` processes
+# on_submit(item) is called in the parent right before an item is handed to
+# a worker, on_start() once the workers are started (eg. metrics.serve, a
+# thread started before would be forked), yield (item, result, error) in the
+# order the items complete.
+# At most 2 * workers items are in flight, so on_submit markers only cover
+# the cases which are really being processed.
+# A crashed worker (eg. a core dump in praat) breaks the whole pool: the
+# items in flight are run again one at a time, so only the crashing one
+# fails, and a new pool takes the next ones.
+def run_in_pool(func, items, workers=default_workers, on_submit=None, on_start=None):
+    if workers <= 1:
+        if on_start is not None:
+            on_start()
+        for item in items:
+            if on_submit is not None:
+                on_submit(item)
+            yield call_safely(func, item)
+        return
+
+    items = iter(items)
+    executor = ProcessPoolExecutor(workers)
+    try:
+        # fork all the workers before on_submit can start any thread in the
+        # parent (eg. the mp3 prefetch of step1.py), the pool only forks a
+        # new worker when none is idle
+        wait([executor.submit(time.sleep, 0.1) for i in range(workers)])
+        if on_start is not None:
+            on_start()
+        running = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(running) < 2 * workers:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if on_submit is not None:
+                    on_submit(item)
+                running[executor.submit(call_safely, func, item)] = item
+            if not running:
+                break
+            done = wait(running, return_when=FIRST_COMPLETED)[0]
+            suspects = []
+            for future in done:
+                item = running.pop(future)
+                try:
+                    res = future.result()
+                except BrokenProcessPool:
+                    suspects.append(item)
+                    continue
+                yield res
+            if suspects:
+                suspects.extend(running.values())
+                running.clear()
+                executor.shutdown(wait=False)
+                for res in run_one_by_one(func, suspects):
+                    yield res
+                executor = start_pool(workers)
+    finally:
+        executor.shutdown()
+
+# the threads of this process may be running: the new workers are started by
+# a forkserver (not forked from here) with the settings of the scripts copied
+def start_pool(workers):
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver'),
+                               initializer=restore_settings, initargs=(script_settings(),))
+
+# run the items on a pool of one worker, a new one after each crash
+def run_one_by_one(func, items):
+    executor = start_pool(1)
+    try:
+        for item in items:
+            try:
+                yield executor.submit(call_safely, func, item).result()
+            except BrokenProcessPool:
+                yield item, None, traceback.format_exc()
+                executor.shutdown(wait=False)
+                executor = start_pool(1)
+    finally:
+        executor.shutdown()
+
+# {module name: {name: value}} of the settings of the scripts of this folder
+# loaded in this process (the module variables with a plain value, eg. the
+# ones changed by cli.py or metrics.configure)
+def script_settings():
+    folder = os.path.dirname(os.path.realpath(__file__))
+    settings = {}
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, '__file__', None)
+        if path is None or os.path.dirname(os.path.realpath(path)) != folder:
+            continue
+        settings[name] = dict((key, value) for key, value in vars(module).items()
+                              if not key.startswith('_') and isinstance(value, (bool, int, float, str, type(None))))
+    return settings
+
+def restore_settings(settings):
+    for name, values in settings.items():
+        module = sys.modules.get(name)
+        if module is None:
+            try:
+                module = __import__(name)
+            except ImportError:
+                continue
+        # the functions of the script run as __main__ keep the globals of
+        # the copy of the module made by runpy
+        namespaces = dict((id(func.__globals__), func.__globals__) for func in vars(module).values()
+                          if getattr(func, '__module__', None) == module.__name__ and hasattr(func, '__globals__'))
+        namespaces[id(vars(module))] = vars(module)
+        for namespace in namespaces.values():
+            namespace.update(values)
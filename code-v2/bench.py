@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Benchmark of the split and pitch pipeline on synthetic arguments.
+#
+# A synthetic Oyez case is generated: an mp3 (32 kbps mono, like the Oyez
+# delivery files) where every speaker talks with a known F0 contour, the
+# matching -t01.json transcript (with byte offsets) and meta json. Each
+# stage is then timed with its peak python memory (tracemalloc) and the
+# process max RSS, and the F0 found by the pitch engine is checked against
+# the known contour. The results are written as json, eg:
+#
+#   python3 bench.py --minutes 60 --speakers 8 --output bench.json
+
+import os, os.path
+import sys
+import json         # json.dump
+import time
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+import wave
+import http.server
+import numpy as np
+
+import step1
+from downloader import Downloader
+from mp3frames import probe_mp3, read_turns
+from pitch import f0_stats_from_file, segment_f0_stats
+from segments import gather_speakers
+from stream_decode import stream_turns, BufferSink, SAMPLE_WIDTH, FFMPEG
+from transcript import parse_transcript
+
+SAMPLE_RATE = 22050
+BITRATE = '32k'
+# F0 of the speakers: base + 12 Hz per speaker, with a 4 Hz vibrato of
+# VIBRATO Hz amplitude (mean = base, std = VIBRATO / sqrt(2))
+BASE_F0 = 100.0
+VIBRATO = 10.0
+
+
+# the known F0 (mean, std) of a speaker
+def expected_f0(speaker):
+    return BASE_F0 + 12.0 * speaker, VIBRATO / np.sqrt(2)
+
+# a voiced signal with the F0 contour of a speaker
+def synth_voice(speaker, seconds, rng):
+    t = np.arange(int(seconds * SAMPLE_RATE)) / float(SAMPLE_RATE)
+    f0 = expected_f0(speaker)[0] + VIBRATO * np.sin(2 * np.pi * 4.0 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+    voice = sum(np.sin(k * phase) / k for k in range(1, 6))
+    return 0.3 * voice / np.abs(voice).max() + 0.005 * rng.standard_normal(len(t))
+
+# Generate a synthetic case in out_dir, return (t01 json, meta json, mp3)
+def generate_case(out_dir, minutes, speakers, seed=1, url_base='http://127.0.0.1/'):
+    rng = np.random.default_rng(seed)
+    case_id = '2000.00-{0}'.format(seed)
+    turns, t = [], 0.0
+    while t < minutes * 60:
+        seconds = float(rng.uniform(2, 20))
+        turns.append((int(rng.integers(speakers)), round(t, 3), round(t + seconds, 3)))
+        t += seconds
+    wav_path = os.path.join(out_dir, case_id + '.wav')
+    mp3_path = os.path.join(out_dir, case_id + '.mp3')
+    w = wave.open(wav_path, 'wb')
+    w.setnchannels(1)
+    w.setsampwidth(SAMPLE_WIDTH)
+    w.setframerate(SAMPLE_RATE)
+    for speaker, start, stop in turns:
+        samples = synth_voice(speaker, stop - start, rng)
+        w.writeframes((samples * 32767).astype('<i2').tobytes())
+    w.close()
+    subprocess.check_call([FFMPEG, '-loglevel', 'error', '-y', '-i', wav_path, '-ac', '1',
+                           '-ar', str(SAMPLE_RATE), '-b:a', BITRATE, mp3_path])
+    os.remove(wav_path)
+
+    info = probe_mp3(mp3_path)
+    bytes_per_sec = info['bitrate'] * 1000 / 8.0
+    people = [{'identifier': 'speaker_{0}'.format(i), 'last_name': 'Speaker{0}'.format(i),
+               'name': 'Speaker{0}'.format(i)} for i in range(speakers)]
+    json_turns = []
+    for speaker, start, stop in turns:
+        json_turns.append({'speaker': people[speaker], 'start': start, 'stop': stop,
+                           'byte_start': int(info['offset'] + start * bytes_per_sec),
+                           'byte_stop': int(info['offset'] + stop * bytes_per_sec),
+                           'text_blocks': [{'start': start, 'stop': stop, 'text': 'Mr. Speaker{0}.'.format(speaker)}]})
+    transcript = {'title': 'Synthetic argument', 'id': seed,
+                  'media_file': [{'mime': 'audio/mpeg', 'href': url_base + os.path.basename(mp3_path),
+                                  'size': os.path.getsize(mp3_path)}],
+                  'transcript': {'title': 'Synthetic v. Benchmark', 'sections': [{'turns': json_turns}]}}
+    meta = {'advocates': [{'advocate': people[0], 'advocate_description': 'for the petitioner'},
+                          {'advocate': people[1 % speakers], 'advocate_description': 'for the respondent'}]}
+    json_path = os.path.join(out_dir, case_id + '-t01.json')
+    meta_path = os.path.join(out_dir, case_id + '.json')
+    with open(json_path, 'w') as f:
+        json.dump(transcript, f)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return json_path, meta_path, mp3_path
+
+
+# serve the files of a folder over http, return (server, base url)
+def serve_folder(folder):
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=folder, **kwargs)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{0}/'.format(server.server_port)
+
+
+# run func(*args) and append the timing of the stage to results
+def measure(results, stage, func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        res, error = func(*args), None
+    except Exception as e:
+        res, error = None, '{0}: {1}'.format(type(e).__name__, e)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    entry = {'stage': stage, 'seconds': round(seconds, 4), 'peak_bytes': peak,
+             'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    if error is not None:
+        entry['error'] = error
+    results.append(entry)
+    print('{0:16s} {1:9.3f} s {2:12d} B{3}'.format(stage, seconds, peak, '  ' + error if error else ''))
+    return res
+
+
+# decode the whole mp3 through the ffmpeg pipe (no ffprobe needed)
+def decode_stream(mp3_file):
+    from pydub import AudioSegment
+    info = probe_mp3(mp3_file)
+    sink = BufferSink()
+    # a turn longer than the file, the stream stops at its end
+    seconds = info['size'] * 8.0 / (info['bitrate'] * 1000) + 60
+    stream_turns(mp3_file, {'all': [(0, seconds)]}, {'all': sink}, info['sample_rate'], info['channels'])
+    return AudioSegment(bytes(sink.data), sample_width=SAMPLE_WIDTH, frame_rate=info['sample_rate'], channels=info['channels'])
+
+def check_f0(name, stats, speaker, checks):
+    mean, std = expected_f0(speaker)
+    ok = abs(stats.mean - mean) < 0.02 * mean and abs(stats.std - std) < 0.3 * std
+    checks.append({'check': name, 'speaker': speaker, 'mean': stats.mean, 'std': stats.std,
+                   'expected_mean': mean, 'expected_std': std, 'ok': bool(ok)})
+
+
+def run(minutes, speakers, seed, work_dir):
+    results, checks = [], []
+    case_dir = os.path.join(work_dir, 'case')
+    mp3_dir = os.path.join(work_dir, 'mp3')
+    out_dir = os.path.join(work_dir, 'out')
+    for path in (case_dir, mp3_dir, out_dir):
+        os.makedirs(path, exist_ok=True)
+    server, url_base = serve_folder(case_dir)
+    json_file, meta_file, mp3_src = measure(results, 'generate', generate_case, case_dir, minutes, speakers, seed, url_base)
+
+    # the stages use the step1.py code paths, without its cache
+    step1.cache_dir = None
+    transcript = measure(results, 'json_parse', parse_transcript.__wrapped__, json_file, 0, 0)
+    speakerMap = transcript.speakers
+    url = transcript.media_url
+    mp3_file = measure(results, 'download', Downloader(mp3_dir, verify_cached=False).get, url)
+    measure(results, 'byte_range', lambda: dict((key, read_turns(mp3_file, turns)) for key, turns in speakerMap.items()))
+    sound = measure(results, 'decode', step1.load_sound_from_mp3, mp3_file)
+    stream_sound = measure(results, 'decode_stream', decode_stream, mp3_file)
+    decode_fallback = sound is None and stream_sound is not None
+    if sound is None:
+        # the next stages run on the streamed decode, the report says so
+        print('decode failed, the next stages use decode_stream')
+        sound = stream_sound
+    tracks = measure(results, 'process_speaker', gather_speakers, speakerMap, sound)
+    top = step1.select_top_speakers(speakerMap)
+    first_turns = dict((key, step1.process_speaker_1st_turn(speakerMap[key], sound)) for key in top)
+    paths = dict((key, os.path.join(out_dir, key + '.mp3')) for key in top)
+    measure(results, 'export', lambda: [step1.save_to_mp3(paths[key], first_turns[key]) for key in top])
+    for key in top:
+        speaker = int(key.split('_')[-1])
+        # the native engine of step2.py (pitch.py) on the exported mp3
+        stats = measure(results, 'f0_from_file', f0_stats_from_file, paths[key])
+        if stats is not None:
+            check_f0('f0_from_file', stats, speaker, checks)
+        stats = measure(results, 'f0_in_memory', segment_f0_stats, first_turns[key])
+        if stats is not None:
+            check_f0('f0_in_memory', stats, speaker, checks)
+    server.shutdown()
+    del tracks
+    return {'minutes': minutes, 'speakers': speakers, 'seed': seed, 'turns': sum(len(v) for v in speakerMap.values()),
+            'mp3_bytes': os.path.getsize(mp3_src), 'stages': results, 'f0_checks': checks,
+            'decode_fallback': decode_fallback,
+            'ok': all(check['ok'] for check in checks) and not any('error' in r for r in results)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the split and pitch pipeline on a synthetic argument')
+    parser.add_argument('--minutes', type=float, default=10, help='length of the argument')
+    parser.add_argument('--speakers', type=int, default=6, help='number of speakers')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='json file for the results (default: stdout)')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as work_dir:
+        report = run(args.minutes, args.speakers, args.seed, work_dir)
+    report['python'] = sys.version.split()[0]
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results are saved to:', args.output)
+    else:
+        print(json.dumps(report, indent=2))
+    sys.exit(0 if report['ok'] else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Content addressed cache of decoded audio and analysis results.
+#
+# The key of an entry is the sha256 of everything the result depends on:
+# the content hash of the input files (json, mp3) plus the parameters
+# (turn selection, praat parameters...). Changing any of them is a miss,
+# a rerun with the same inputs is a hit, whatever the output folders look
+# like. The entries are files under cache_dir/<2 hex>/<key>, the least
+# recently used ones are evicted when the folder grows over max_bytes.
+
+import os, os.path
+import json         # json.dumps
+import hashlib
+import tempfile
+
+HASH_BLOCK = 1024 * 1024
+
+
+# sha256 of the content of a file, memoized per (path, size, mtime)
+file_hashes = {}
+
+def file_hash(path):
+    st = os.stat(path)
+    stamp = (path, st.st_size, st.st_mtime_ns)
+    if stamp not in file_hashes:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), b''):
+                h.update(block)
+        file_hashes[stamp] = h.hexdigest()
+    return file_hashes[stamp]
+
+# the key of a list of json serializable parts
+def make_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Cache(object):
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total = None
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[0:2], key)
+
+    # the data of an entry, None if missing
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # mtime is the last use of the entry
+            os.utime(path)
+            return data
+        except (IOError, OSError):
+            return None
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if self.total is not None:
+            self.total += len(data)
+        self.evict()
+
+    def get_json(self, key):
+        data = self.get(key)
+        return None if data is None else json.loads(data.decode('utf-8'))
+
+    def put_json(self, key, obj):
+        self.put(key, json.dumps(obj).encode('utf-8'))
+
+    def entries(self):
+        res = []
+        for basedir, dirs, files in os.walk(self.cache_dir):
+            for filename in files:
+                if filename.endswith('.tmp'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(basedir, filename))
+                except OSError:
+                    continue
+                res.append((st.st_mtime, st.st_size, os.path.join(basedir, filename)))
+        return res
+
+    # remove the least recently used entries until the cache fits max_bytes
+    def evict(self):
+        if self.total is None:
+            self.total = sum(entry[1] for entry in self.entries())
+        if self.total <= self.max_bytes:
+            return
+        entries = sorted(self.entries())
+        self.total = sum(entry[1] for entry in entries)
+        for mtime, size, path in entries:
+            if self.total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.total -= size
+
+
+# the cache of this process for a folder, None if cache_dir is None
+caches = {}
+
+def get_cache(cache_dir, max_bytes):
+    if cache_dir is None:
+        return None
+    key = (cache_dir, os.getpid())
+    if key not in caches:
+        caches[key] = Cache(cache_dir, max_bytes)
+    return caches[key]
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# One command line for the steps of the corpus:
+#
+#   python3 cli.py download [json ...]   download the mp3 of the transcripts
+#   python3 cli.py split [json ...]      step1.py: split the mp3 per speaker
+#   python3 cli.py analyze [json ...]    step2.py: F0 of the advocates
+#   python3 cli.py status                what is downloaded / split / analysed
+#
+# without json files the whole sample is processed (the paths and the
+# settings are the ones of step1.py / step2.py). --dry-run prints what would
+# be done without doing it.
+#
+# status and the dry runs only read the json files, the folders and the
+# results database: pydub, parselmouth, numpy and requests are imported by
+# the steps when they process a case, so these queries answer in
+# milliseconds. --profile-imports runs the command under `python3 -X
+# importtime` and prints the slowest imports, eg:
+#
+#   python3 cli.py --profile-imports analyze --dry-run
+
+import os, os.path
+import sys
+import time
+import argparse
+import subprocess
+
+import step1
+import step2
+import metrics
+from results_store import connect_read_only
+
+# the heavy modules, reported by --profile-imports
+HEAVY_MODULES = ('numpy', 'pydub', 'parselmouth', 'requests', 'pyarrow')
+PROFILE_TOP = 15
+
+
+# the -t01.json files given on the command line, or the ones of the sample
+def transcripts(files):
+    if files:
+        return [f if f.endswith('-t01.json') else f[0:-5] + '-t01.json' for f in files]
+    return sorted(step1.list_jsons(step1.json_patten_in_batch))
+
+# {-t01.json file: mp3 url} of the transcripts, the ones without url are
+# left out
+def mp3_urls(jsons):
+    urls = {}
+    for json_file in jsons:
+        url = step1.get_mp3_url(json_file)
+        if url is None:
+            print('No mp3 url found in', json_file)
+            continue
+        urls[json_file] = url
+    return urls
+
+def download(args):
+    urls = mp3_urls(transcripts(args.files))
+    missing = dict((json_file, url) for json_file, url in urls.items() if not os.path.exists(step1.mp3_path(url)))
+    print('{0} mp3 file(s), {1} to download'.format(len(urls), len(missing)))
+    if args.dry_run:
+        for json_file, url in sorted(missing.items()):
+            print(url, '->', step1.mp3_path(url))
+        return
+    step1.create_dir(step1.mp3_folder, False)
+    metrics.configure(step1.metrics_path, None, 0, None)
+    downloader = step1.get_downloader()
+    downloader.prefetch(list(missing.values()))
+    failed = 0
+    for count, (json_file, url) in enumerate(sorted(missing.items()), 1):
+        try:
+            print('{0}/{1} {2}'.format(count, len(missing), step1.download_mp3(url)))
+        except Exception as e:
+            print('{0}/{1} failed {2}: {3}'.format(count, len(missing), url, e))
+            failed += 1
+    downloader.close()
+    print('{0} downloaded, {1} failed'.format(len(missing) - failed, failed))
+
+def split(args):
+    if args.engine is not None:
+        step1.batch_engine = args.engine
+    if args.dry_run:
+        pending, total = pending_splits(args.files)
+        print('{0} transcript(s), {1} to split'.format(total, len(pending)))
+        for json_file in pending:
+            print(json_file)
+        return
+    step1.create_dir(step1.output_dir, False)
+    step1.create_dir(step1.mp3_folder, False)
+    metrics.configure(step1.metrics_path, step1.metrics_port, step1.profile_slowest, step1.profile_dir)
+    if args.files:
+        metrics.serve()
+        for json_file in transcripts(args.files):
+            step1.split_mp3(json_file)
+    elif step1.batch_engine == 'pipeline':
+        step1.split_in_pipeline(step1.json_patten_in_batch)
+    else:
+        step1.split_in_batch(step1.json_patten_in_batch)
+
+# the transcripts not split yet, and their total
+def pending_splits(files):
+    if not files:
+        return step1.pending_jsons(step1.json_patten_in_batch, verbose=False)
+    jsons = transcripts(files)
+    return [json_file for json_file in jsons if not os.path.exists(split_dir(json_file))], len(jsons)
+
+def split_dir(json_file):
+    return os.path.join(step1.output_dir, step2.get_filename_without_ext(json_file))
+
+# the meta json files given on the command line, or the ones of the sample
+def meta_jsons(files):
+    if files:
+        return [f[0:-9] + '.json' if f.endswith('-t01.json') else f for f in files]
+    return step2.obtain_meta_jsons(step2.meta_json_dir)
+
+def analyze(args):
+    if args.engine is not None:
+        step2.batch_engine = args.engine
+    if args.mode is not None:
+        step2.process_mode = args.mode
+    if args.dry_run:
+        jsons = meta_jsons(args.files)
+        pending = pending_analyses(jsons)
+        print('{0} case(s), {1} to analyse ({2} mode)'.format(len(jsons), len(pending), step2.process_mode))
+        for json_file in pending:
+            note = ''
+            if step2.process_mode == 'files' and not os.path.exists(os.path.join(step2.splitted_mp3_dir, step2.get_filename_without_ext(json_file) + '-t01')):
+                note = ' (not split yet)'
+            print(json_file + note)
+        return
+    step2.create_dir(step2.textgrid_out_dir, False)
+    metrics.configure(step2.metrics_path, step2.metrics_port, step2.profile_slowest, step2.profile_dir)
+    if args.files:
+        metrics.serve()
+        print(','.join(step2.CSV_HEADERS[1:]))
+        for json_file in meta_jsons(args.files):
+            step2.print_case_result(step2.process(json_file))
+    elif step2.batch_engine == 'pipeline':
+        step2.process_in_pipeline(step2.meta_json_dir)
+    else:
+        step2.process_in_batch(step2.meta_json_dir)
+
+# the cases not in the results database yet (read only, an older run
+# without database is not imported)
+def pending_analyses(jsons):
+    if not os.path.exists(step2.db_path):
+        return jsons
+    store = step2.ResultStore(step2.db_path, read_only=True)
+    try:
+        return list(step2.pending_cases(store, jsons, verbose=False))
+    finally:
+        store.close()
+
+def status(args):
+    start = time.perf_counter()
+    jsons = transcripts(None)
+    print('{0:12s} {1}'.format('transcripts', len(jsons)))
+    mp3s = [f for f in os.listdir(step1.mp3_folder) if f.endswith('.mp3')] if os.path.isdir(step1.mp3_folder) else []
+    print('{0:12s} {1}'.format('downloaded', len(mp3s)))
+    splits = os.listdir(step1.output_dir) if os.path.isdir(step1.output_dir) else []
+    print('{0:12s} {1}'.format('split', len(splits)))
+    if os.path.exists(step2.db_path):
+        conn = connect_read_only(step2.db_path)
+        try:
+            counts = conn.execute('SELECT status, COUNT(*) FROM results GROUP BY status').fetchall()
+            print('{0:12s} {1}'.format('analysed', ', '.join('{0} {1}'.format(s, n) for s, n in sorted(counts)) or 0))
+            # the queue of supervisor.py
+            if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'jobs'").fetchone():
+                counts = conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+                print('{0:12s} {1}'.format('queue', ', '.join('{0} {1}'.format(s, n) for s, n in sorted(counts)) or 0))
+        finally:
+            conn.close()
+    else:
+        print('{0:12s} {1}'.format('analysed', 0))
+    print('{0:12s} {1}'.format('finished', os.path.exists(step2.status_path)))
+    print('({0:.1f} ms)'.format((time.perf_counter() - start) * 1000))
+
+
+# run the command again under -X importtime, print the slowest imports
+def profile_imports(argv):
+    cmd = [sys.executable, '-X', 'importtime', os.path.realpath(__file__)] + argv
+    proc = subprocess.run(cmd, stderr=subprocess.PIPE, universal_newlines=True)
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            print(line, file=sys.stderr)
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((int(cumulative_us), int(self_us), level, name.strip()))
+    total = sum(cumulative for cumulative, self_us, level, name in imports if level == 0)
+    print('\nImport time: {0:.1f} ms, {1} modules'.format(total / 1000.0, len(imports)))
+    print('{0:>10s} {1:>10s}  {2}'.format('cumul (ms)', 'self (ms)', 'module'))
+    for cumulative, self_us, level, name in sorted(imports, reverse=True)[:PROFILE_TOP]:
+        print('{0:10.1f} {1:10.1f}  {2}{3}'.format(cumulative / 1000.0, self_us / 1000.0, '  ' * level, name))
+    loaded = [name for name in HEAVY_MODULES if any(imp[3] == name for imp in imports)]
+    print('Heavy modules loaded:', ', '.join(loaded) or 'none')
+    return proc.returncode
+
+def main():
+    parser = argparse.ArgumentParser(description='Download, split and analyse the oral arguments')
+    parser.add_argument('--profile-imports', action='store_true', help='print the slowest imports of the command')
+    commands = parser.add_subparsers(dest='command')
+    for name, func, help in (('download', download, 'download the mp3 files'),
+                             ('split', split, 'split the mp3 files per speaker (step1.py)'),
+                             ('analyze', analyze, 'compute the F0 of the advocates (step2.py)')):
+        command = commands.add_parser(name, help=help)
+        command.add_argument('files', nargs='*', help='json files (default: the whole sample)')
+        command.add_argument('--dry-run', action='store_true', help='print the cases to process and exit')
+        if name != 'download':
+            command.add_argument('--engine', choices=('pool', 'pipeline'), help='the batch engine')
+        if name == 'analyze':
+            command.add_argument('--mode', choices=('files', 'fused', 'all_turns'), help='step2.process_mode')
+        command.set_defaults(func=func)
+    commands.add_parser('status', help='print the progress of the sample').set_defaults(func=status)
+    args = parser.parse_args()
+
+    if args.profile_imports:
+        sys.exit(profile_imports([arg for arg in sys.argv[1:] if arg != '--profile-imports']))
+    if args.command is None:
+        parser.print_help()
+        sys.exit(-1)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
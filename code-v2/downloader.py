@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Download the oral argument mp3 files into a local cache folder.
+#
+# * one pooled requests.Session, downloads run on a bounded thread pool so
+#   the next cases can be prefetched while the current one is processed
+# * the body is streamed into <file>.part and renamed when it is complete,
+#   so a file in the cache folder is always a complete download
+# * an interrupted download is resumed with a HTTP Range request
+# * the size is checked against Content-Length / Content-Range, and saved in
+#   <file>.size when the download completes: a cached file is verified once
+#   (HEAD) if it has no size record (older versions of the scripts)
+
+import os, os.path
+import fcntl        # fcntl.flock
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests     # requests.Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+CHUNK_SIZE = 1024 * 1024
+# the size record of a complete download
+SIZE_SUFFIX = '.size'
+
+
+class DownloadError(IOError):
+    pass
+
+
+class Downloader(object):
+
+    # folder: the cache folder of the mp3 files
+    # workers: the number of concurrent downloads
+    # verify_cached: ask the server (HEAD) for the size of a cached file
+    #   without size record, to catch truncated files left by older versions
+    #   of the scripts
+    def __init__(self, folder, workers=4, timeout=60, retries=3, verify_cached=True):
+        self.folder = folder
+        self.timeout = timeout
+        self.retries = retries
+        self.verify_cached = verify_cached
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers,
+                              max_retries=Retry(total=retries, backoff_factor=1,
+                                                status_forcelist=[500, 502, 503, 504]))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(workers)
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    # the local file path of a url
+    def local_path(self, url):
+        filename = url.split('/')[-1]
+        return os.path.join(self.folder, str(filename))
+
+    # start to download the urls in the background (skip the ones already
+    # queued)
+    def prefetch(self, urls):
+        for url in urls:
+            if url is not None:
+                self.submit(url)
+
+    def submit(self, url):
+        with self.lock:
+            future = self.futures.get(url)
+            if future is None or (future.done() and future.exception() is not None):
+                future = self.executor.submit(self.fetch, url)
+                self.futures[url] = future
+            return future
+
+    # download the url (or wait for the prefetch of it), return the local path
+    def get(self, url):
+        return self.submit(url).result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    # the size of the file on the server, None if unknown
+    def remote_size(self, url):
+        r = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+        r.raise_for_status()
+        length = r.headers.get('Content-Length')
+        return int(length) if length is not None else None
+
+    # Download a url into the cache folder (blocking), return the local path
+    def fetch(self, url):
+        filepath = self.local_path(url)
+        if os.path.exists(filepath):
+            if not self.verify_cached or self.verify(url, filepath):
+                return filepath
+            # a truncated file from an older run, resume it
+            print('Cached mp3 is truncated, resume it:', filepath)
+            os.replace(filepath, filepath + '.part')
+
+        for attempt in range(self.retries + 1):
+            try:
+                return self.fetch_part(url, filepath)
+            except (requests.RequestException, DownloadError) as e:
+                if attempt == self.retries:
+                    raise DownloadError('Failed to download {0}: {1}'.format(url, e))
+                print('Download interrupted, resume it:', url, e)
+
+    # whether a cached file is complete: the size record of its download, or
+    # the size on the server (then recorded). If the server can not be asked
+    # the file is used as it is, and verified by the next run
+    def verify(self, url, filepath):
+        size = os.path.getsize(filepath)
+        recorded = read_size(filepath)
+        if recorded is not None:
+            return recorded == size
+        try:
+            remote = self.remote_size(url)
+        except requests.RequestException as e:
+            print('Can not verify the cached mp3, use it as it is:', filepath, e)
+            return True
+        if remote is not None and remote != size:
+            return False
+        write_size(filepath, size)
+        return True
+
+    # Download (or resume) <filepath>.part and rename it when it is complete
+    def fetch_part(self, url, filepath):
+        part_path = filepath + '.part'
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+b') as f:
+            # another process may download the same file
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.path.exists(filepath):
+                return filepath
+            offset = f.seek(0, os.SEEK_END)
+            headers = {'Range': 'bytes={0}-'.format(offset)} if offset > 0 else {}
+            with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+                if r.status_code == 416:
+                    # nothing left to download, check the size of the part file
+                    total = parse_total_size(r.headers.get('Content-Range'))
+                else:
+                    r.raise_for_status()
+                    if r.status_code == 206:
+                        start = parse_range_start(r.headers.get('Content-Range'))
+                        if start != offset:
+                            raise DownloadError('Unexpected range {0}'.format(r.headers.get('Content-Range')))
+                        total = parse_total_size(r.headers.get('Content-Range'))
+                    else:
+                        # the server ignored the range, start from scratch
+                        f.seek(0)
+                        f.truncate()
+                        length = r.headers.get('Content-Length')
+                        total = int(length) if length is not None else None
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+            f.flush()
+            size = f.tell()
+            if total is None and r.status_code == 416:
+                raise DownloadError('Can not resume ' + part_path)
+            if total is not None and size != total:
+                if size > total:
+                    f.truncate(0)
+                raise DownloadError('Incomplete download: {0} of {1} bytes'.format(size, total))
+            os.fsync(f.fileno())
+            os.replace(part_path, filepath)
+            write_size(filepath, size)
+        return filepath
+
+
+# the recorded size of a complete download, None if there is no record
+def read_size(filepath):
+    try:
+        with open(filepath + SIZE_SUFFIX) as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return None
+
+def write_size(filepath, size):
+    tmp_path = '{0}{1}.{2}'.format(filepath, SIZE_SUFFIX, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(str(size))
+    os.replace(tmp_path, filepath + SIZE_SUFFIX)
+
+
+# 'bytes 100-199/1000' => 100
+def parse_range_start(content_range):
+    try:
+        return int(content_range.split()[1].split('-')[0])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+# 'bytes 100-199/1000' or 'bytes */1000' => 1000
+def parse_total_size(content_range):
+    try:
+        total = content_range.split('/')[1]
+        return None if total == '*' else int(total)
+    except (AttributeError, IndexError, ValueError):
+        return None
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Encode the per-speaker tracks of a case in parallel.
+#
+# AudioSegment.export writes a temporary wav file and starts ffmpeg on it,
+# one speaker after another. Here the PCM of every track is piped to its own
+# ffmpeg process (no temporary file), at most `workers` encoders run at the
+# same time. The encoding runs in the ffmpeg processes, the threads only
+# feed the pipes, so a thread pool is enough.
+#
+# The codec and bitrate are configurable:
+#   mp3   libmp3lame, like AudioSegment.export (bitrate None: ffmpeg default)
+#   opus  libopus, much smaller than mp3 at the same quality for speech
+#   flac  lossless, the bitrate is ignored
+
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from stream_decode import FFMPEG
+
+# codec: (file extension, ffmpeg options)
+CODECS = {
+    'mp3': ('.mp3', ['-acodec', 'libmp3lame']),
+    'opus': ('.opus', ['-acodec', 'libopus', '-application', 'voip']),
+    'flac': ('.flac', ['-acodec', 'flac']),
+}
+
+# default number of encoders running at the same time
+default_workers = os.cpu_count() or 1
+
+
+# the file extension and the ffmpeg output options of a codec
+def encoder_options(codec, bitrate=None):
+    if codec not in CODECS:
+        raise ValueError('Unknown codec: {0} (expected one of {1})'.format(codec, ', '.join(sorted(CODECS))))
+    ext, options = CODECS[codec]
+    options = list(options)
+    if bitrate is not None and codec != 'flac':
+        options += ['-b:a', str(bitrate)]
+    return ext, options
+
+# the ffmpeg format of the raw PCM of an AudioSegment by sample width, the
+# 8 bit samples are unsigned (like in a wav file)
+PCM_FORMATS = {1: 'u8', 2: 's16le', 3: 's24le', 4: 's32le'}
+
+# encode the raw PCM of an AudioSegment to path through a pipe
+def encode_segment(segment, path, codec='mp3', bitrate=None):
+    ext, options = encoder_options(codec, bitrate)
+    cmd = [FFMPEG, '-loglevel', 'error', '-y', '-f', PCM_FORMATS[segment.sample_width],
+           '-ar', str(segment.frame_rate), '-ac', str(segment.channels), '-i', 'pipe:0'] + options + [path]
+    with metrics.stage('encode', samples=int(segment.frame_count()), codec=codec):
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        err = proc.communicate(segment.raw_data)[1]
+        if proc.returncode != 0:
+            raise IOError('Failed to encode {0}: {1}'.format(path, err.decode('utf-8', 'replace').strip()))
+    return path
+
+
+class EncoderPool(object):
+
+    def __init__(self, codec='mp3', bitrate=None, workers=default_workers):
+        # fail early on an unknown codec
+        self.ext = encoder_options(codec, bitrate)[0]
+        self.codec = codec
+        self.bitrate = bitrate
+        self.executor = ThreadPoolExecutor(max(1, workers))
+
+    # the output path of a track
+    def output_path(self, out_dir, key):
+        return os.path.join(out_dir, key + self.ext)
+
+    # encode the tracks {key: AudioSegment} into out_dir, the tracks are
+    # released as soon as they are handed to an encoder
+    # return {key: path}, raise the first failure after all the encodes end
+    def export(self, tracks, out_dir):
+        futures = {}
+        for key in list(tracks):
+            futures[key] = self.executor.submit(encode_segment, tracks.pop(key), self.output_path(out_dir, key),
+                                                self.codec, self.bitrate)
+        error = None
+        res = {}
+        for key, future in futures.items():
+            try:
+                res[key] = future.result()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return res
+
+    def close(self):
+        self.executor.shutdown()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# F0 statistics over every turn of the speakers, in bounded memory.
+#
+# The argument is decoded once as a stream (stream_decode.py), the samples
+# of each turn are analysed in chunks of CHUNK_SECONDS as they arrive and
+# dropped right away. Only running accumulators are kept per speaker:
+# * the count / mean / M2 of the voiced F0 frames (Welford, merged chunk by
+#   chunk with Chan's formula), so mean and std are exact
+# * a histogram of 0.5 Hz bins between the pitch floor and ceiling for the
+#   median
+# * the same count / mean / M2 per turn and per window of WINDOW_SECONDS of
+#   the argument timeline, as F0 series
+# The pitch of a chunk is computed like pitch.py (Sound.to_pitch), the few
+# frames at the border of two chunks of a long turn may differ from a
+# single to_pitch over the whole turn.
+# With vad, only the speech of each chunk (vad.py) is analysed, run by run so
+# the times of the frames are kept, and the speech ratio is counted.
+
+import numpy as np
+import parselmouth
+
+from mp3frames import probe_mp3
+from pitch import PitchStats, PitchError, PITCH_FLOOR, PITCH_CEILING, TIME_STEP
+from stream_decode import stream_turns, SAMPLE_WIDTH
+from vad import speech_runs
+
+CHUNK_SECONDS = 30
+WINDOW_SECONDS = 60
+HISTOGRAM_STEP = 0.5
+
+
+class RunningStats(object):
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = float('inf')
+        self.maximum = float('-inf')
+
+    # add an array of values
+    def add(self, values):
+        n = len(values)
+        if n == 0:
+            return
+        mean = float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+        self.merge_parts(n, mean, m2)
+        self.minimum = min(self.minimum, float(values.min()))
+        self.maximum = max(self.maximum, float(values.max()))
+
+    def merge_parts(self, n, mean, m2):
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.n * n / total
+        self.n = total
+
+    def merge(self, other):
+        if other.n:
+            self.merge_parts(other.n, other.mean, other.m2)
+            self.minimum = min(self.minimum, other.minimum)
+            self.maximum = max(self.maximum, other.maximum)
+
+    # sample standard deviation (ddof=1, like pitch.py)
+    def std(self):
+        return (self.m2 / (self.n - 1)) ** 0.5 if self.n > 1 else 0.0
+
+    def to_json(self):
+        return {'voiced_frames': self.n, 'mean': self.mean if self.n else None,
+                'std': self.std() if self.n > 1 else None}
+
+
+class F0Accumulator(object):
+
+    def __init__(self, floor=PITCH_FLOOR, ceiling=PITCH_CEILING, time_step=TIME_STEP, window_seconds=WINDOW_SECONDS):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.time_step = time_step
+        self.window_seconds = window_seconds
+        self.total = RunningStats()
+        self.frames = 0
+        # seconds of the turns, and of their speech (all of it without vad)
+        self.seconds = 0.0
+        self.speech_seconds = 0.0
+        self.histogram = np.zeros(int((ceiling - floor) / HISTOGRAM_STEP) + 1, dtype=np.int64)
+        # [(start, stop, RunningStats)] and {window index: RunningStats}
+        self.turns = []
+        self.windows = {}
+
+    # the RunningStats of a new turn
+    def start_turn(self, start, stop):
+        stats = RunningStats()
+        self.turns.append((start, stop, stats))
+        return stats
+
+    # analyse mono samples (float in [-1, 1]) starting at `start` seconds of
+    # the argument, they belong to the turn of the RunningStats `turn` (the
+    # overlapping turns of a speaker are streamed at once, so it is not
+    # always the last started one)
+    def add_samples(self, samples, sample_rate, start, turn=None):
+        if len(samples) < 3.0 / self.floor * sample_rate:
+            return
+        sound = parselmouth.Sound(samples, sampling_frequency=sample_rate)
+        pitch = sound.to_pitch(time_step=self.time_step, pitch_floor=self.floor, pitch_ceiling=self.ceiling)
+        f0 = pitch.selected_array['frequency']
+        voiced = f0 > 0
+        self.add_frames(f0[voiced], start + pitch.xs()[voiced], len(f0), turn)
+
+    # add voiced F0 frames (Hz) at times (seconds of the argument) of a turn
+    def add_frames(self, f0, times, frames, turn=None):
+        self.frames += frames
+        self.total.add(f0)
+        if turn is not None:
+            turn.add(f0)
+        bins = np.clip(((f0 - self.floor) / HISTOGRAM_STEP).astype(np.int64), 0, len(self.histogram) - 1)
+        self.histogram += np.bincount(bins, minlength=len(self.histogram))
+        windows = (times // self.window_seconds).astype(np.int64)
+        for window in np.unique(windows):
+            self.windows.setdefault(int(window), RunningStats()).add(f0[windows == window])
+
+    def speech_ratio(self):
+        return self.speech_seconds / self.seconds if self.seconds > 0 else 0.0
+
+    def median(self):
+        counts = np.cumsum(self.histogram)
+        i = int(np.searchsorted(counts, counts[-1] / 2.0))
+        return self.floor + (i + 0.5) * HISTOGRAM_STEP
+
+    # PitchStats over all the turns (the median is within HISTOGRAM_STEP)
+    def stats(self):
+        if self.total.n < 2:
+            raise PitchError('No voiced frame found ({0} frames)'.format(self.frames))
+        return PitchStats(self.total.mean, self.total.std(), self.median(), self.total.minimum,
+                          self.total.maximum, self.total.n, self.frames)
+
+    # [{'start', 'stop', 'voiced_frames', 'mean', 'std'}] per turn
+    def turn_series(self):
+        res = []
+        for start, stop, stats in self.turns:
+            entry = {'start': start, 'stop': stop}
+            entry.update(stats.to_json())
+            res.append(entry)
+        return res
+
+    # the same per window of the argument timeline, windows without voiced
+    # frames are left out
+    def window_series(self):
+        res = []
+        for window, stats in sorted(self.windows.items()):
+            entry = {'start': window * self.window_seconds, 'stop': (window + 1) * self.window_seconds}
+            entry.update(stats.to_json())
+            res.append(entry)
+        return res
+
+    def to_json(self):
+        res = {'turns': self.turn_series(), 'windows': self.window_series(), 'speech_ratio': self.speech_ratio()}
+        try:
+            res['stats'] = self.stats()._asdict()
+        except PitchError:
+            res['stats'] = None
+        return res
+
+
+# the sink of a single turn for stream_turns, analyses its samples by
+# chunks of CHUNK_SECONDS and the rest as soon as the turn is complete
+class TurnSink(object):
+
+    def __init__(self, acc, turn, sample_rate, channels, vad=False):
+        self.acc = acc
+        self.vad = vad
+        self.turn = turn
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frame_width = SAMPLE_WIDTH * channels
+        self.chunk_bytes = CHUNK_SECONDS * sample_rate * self.frame_width
+        # the frames stream_turns routes to the turn (see build_timeline)
+        self.remaining = (int(turn[1] * sample_rate) - int(turn[0] * sample_rate)) * self.frame_width
+        self.buffer = bytearray()
+        # start time of the buffered samples
+        self.pos = turn[0]
+        # the RunningStats of the turn, once its first samples arrive
+        self.stats = None
+
+    def write(self, data):
+        if self.stats is None:
+            self.stats = self.acc.start_turn(self.turn[0], self.turn[1])
+        self.buffer += data
+        self.remaining -= len(data)
+        while len(self.buffer) >= self.chunk_bytes:
+            self.analyse(self.chunk_bytes)
+        if self.remaining <= 0:
+            self.close()
+
+    def analyse(self, size):
+        samples = np.frombuffer(bytes(self.buffer[:size]), dtype='<i2').astype(np.float64)
+        del self.buffer[:size]
+        if self.channels > 1:
+            samples = samples.reshape(-1, self.channels).mean(axis=1)
+        samples = samples / 32768.0
+        seconds = len(samples) / float(self.sample_rate)
+        self.acc.seconds += seconds
+        if self.vad:
+            for start, stop in speech_runs(samples, self.sample_rate).tolist():
+                self.acc.add_samples(samples[start:stop], self.sample_rate, self.pos + start / float(self.sample_rate),
+                                     self.stats)
+                self.acc.speech_seconds += (stop - start) / float(self.sample_rate)
+        else:
+            self.acc.add_samples(samples, self.sample_rate, self.pos, self.stats)
+            self.acc.speech_seconds += seconds
+        self.pos += seconds
+
+    def close(self):
+        if self.buffer:
+            self.analyse(len(self.buffer) - len(self.buffer) % self.frame_width)
+            self.buffer = bytearray()
+
+
+# {speaker identifier: F0Accumulator} over every turn of speakerMap, the
+# mp3 is decoded once as a stream
+# vad: only analyse the speech of the turns (vad.py)
+def stream_f0(mp3_file, speakerMap, floor=PITCH_FLOOR, ceiling=PITCH_CEILING, time_step=TIME_STEP,
+              window_seconds=WINDOW_SECONDS, info=None, vad=False):
+    if info is None:
+        info = probe_mp3(mp3_file)
+    rate, channels = info['sample_rate'], info['channels']
+    accs = dict((key, F0Accumulator(floor, ceiling, time_step, window_seconds)) for key in speakerMap)
+    # one sink per turn, so the samples of a turn are analysed together
+    turnMap, sinks = {}, {}
+    for key, turns in speakerMap.items():
+        for i, turn in enumerate(sorted(turns)):
+            turnMap[(key, i)] = [turn]
+            sinks[(key, i)] = TurnSink(accs[key], turn, rate, channels, vad)
+    try:
+        stream_turns(mp3_file, turnMap, sinks, rate, channels)
+    finally:
+        # the turns cut by the end of the mp3
+        for sink in sinks.values():
+            sink.close()
+    return accs
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Per-turn acoustic features of the corpus as a partitioned Parquet dataset.
+#
+# One row per turn: the case, the speaker with the role (get_advocate_map)
+# and gender, the timings and the F0 features of the turn. The rows are
+# buffered and written in batches (at the latest when the results database
+# commits their cases, see ResultStore.before_commit), every batch is a new
+# file of the partition of its term:
+#
+#   <features_dir>/term=1994/part-<time>-<pid>-<n>.parquet
+#
+# so several writers never touch the same file, and a read filtering on the
+# term only opens the files of that term (the other columns are filtered
+# with the row group statistics), eg:
+#
+#   python3 features.py 1994_2019/sample-936/features term=1994 role=appellant
+#
+# or from python: read_features(features_dir, [('gender', '=', 'F')])
+
+import os, os.path
+import sys
+import time
+import itertools
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from transcript import get_term
+
+SCHEMA = pa.schema([
+    ('case_id', pa.string()),
+    ('speaker', pa.string()),
+    ('role', pa.string()),
+    ('gender', pa.string()),
+    ('turn', pa.int32()),
+    ('start', pa.float64()),
+    ('stop', pa.float64()),
+    ('duration', pa.float64()),
+    ('voiced_frames', pa.int32()),
+    ('f0_mean', pa.float64()),
+    ('f0_std', pa.float64()),
+])
+PARTITION = 'term'
+BATCH_ROWS = 100000
+
+
+# the rows of the turns of a case
+# series: {speaker identifier: [{'start', 'stop', 'voiced_frames', 'mean', 'std'}]}
+# (see F0Accumulator.turn_series), roles / genders: {speaker identifier: value}
+def turn_rows(case_id, series, roles, genders):
+    rows = []
+    for speaker, turns in sorted(series.items()):
+        for i, turn in enumerate(turns):
+            rows.append({'case_id': case_id, 'speaker': speaker, 'role': roles.get(speaker),
+                         'gender': genders.get(speaker), 'turn': i, 'start': turn['start'],
+                         'stop': turn['stop'], 'duration': turn['stop'] - turn['start'],
+                         'voiced_frames': turn['voiced_frames'], 'f0_mean': turn['mean'], 'f0_std': turn['std']})
+    return rows
+
+
+class FeatureWriter(object):
+
+    def __init__(self, features_dir, batch_rows=BATCH_ROWS):
+        self.features_dir = features_dir
+        self.batch_rows = batch_rows
+        self.rows = []
+        self.count = itertools.count()
+
+    def add(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_rows:
+            self.flush()
+
+    # write the buffered rows, one file per term
+    def flush(self):
+        if not self.rows:
+            return
+        rows, self.rows = self.rows, []
+        terms = {}
+        for row in rows:
+            terms.setdefault(get_term(row['case_id']), []).append(row)
+        for term, term_rows in sorted(terms.items()):
+            folder = os.path.join(self.features_dir, '{0}={1}'.format(PARTITION, term))
+            os.makedirs(folder, exist_ok=True)
+            filename = 'part-{0}-{1}-{2}.parquet'.format(int(time.time()), os.getpid(), next(self.count))
+            table = pa.Table.from_pylist(term_rows, schema=SCHEMA)
+            # written under a temporary name, a reader never sees half a file
+            pq.write_table(table, os.path.join(folder, '.' + filename))
+            os.replace(os.path.join(folder, '.' + filename), os.path.join(folder, filename))
+
+    def close(self):
+        if self.rows:
+            self.flush()
+
+
+# read the features as a pyarrow Table
+# filters: [(column, op, value)] (pyarrow.parquet syntax), the filter on the
+# term only reads its partition
+def read_features(features_dir, filters=None, columns=None):
+    return pq.read_table(features_dir, columns=columns, filters=filters or None,
+                         partitioning='hive', ignore_prefixes=['.'])
+
+# a filter of the command line, eg. term=1994, f0_mean>150
+def parse_filter(text):
+    for op in ('>=', '<=', '!=', '=', '>', '<'):
+        if op in text:
+            column, value = text.split(op, 1)
+            if column == PARTITION or SCHEMA.field(column).type != pa.string():
+                value = float(value) if '.' in value else int(value)
+            return (column, op, value)
+    raise ValueError('Invalid filter: ' + text)
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python3 features.py <features dir> [column=value ...]')
+        sys.exit(-1)
+    table = read_features(sys.argv[1], [parse_filter(text) for text in sys.argv[2:]])
+    print('{0} turn(s), {1} case(s)'.format(table.num_rows, len(set(table.column('case_id').to_pylist()))))
+    for row in table.slice(0, 10).to_pylist():
+        print(row)
+
+if __name__ == '__main__':
+    main()
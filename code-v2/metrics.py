@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Per-stage instrumentation of the batch runs.
+#
+#   with metrics.case(case_id):
+#       with metrics.stage('download') as m:
+#           ...
+#           m['bytes'] = size
+#
+# Every stage and case is written as a json line to the event file (shared
+# by the worker processes, one write per line in append mode), so a stalled
+# run shows which case and stage it is in. Optionally:
+# * a Prometheus text endpoint (http://127.0.0.1:<port>/metrics) with the
+#   totals per stage of all the processes writing the event file
+# * a sampling profiler (SIGPROF) running during every case, the folded
+#   stacks (flamegraph format) of the slowest N cases are kept
+
+import os, os.path
+import sys
+import json         # json.dumps
+import time
+import heapq
+import signal
+import threading
+import http.server
+from contextlib import contextmanager
+
+events_path = None
+profile_slowest = 0
+profile_dir = None
+PROFILE_INTERVAL = 0.005
+
+# the case of each thread (the thread stages of pipeline.py run several
+# cases at once), see current_case()
+local = threading.local()
+# {stage: {'runs': n, 'seconds': s, <counter>: total}} of this process
+totals = {}
+totals_lock = threading.Lock()
+# (seconds, case) of the profiles kept in profile_dir
+slowest_profiles = []
+# the port of the Prometheus endpoint and its server, see serve()
+http_port = None
+http_server = None
+
+
+# events_path: the json lines file of the events (None: no event file)
+# port: the port of the Prometheus text endpoint (None: no endpoint), it is
+#   started by serve()
+# slowest: keep the sampling profiles of the N slowest cases in prof_dir
+def configure(path=None, port=None, slowest=0, prof_dir=None):
+    global events_path, profile_slowest, profile_dir, http_port
+    events_path = path
+    profile_slowest = slowest
+    profile_dir = prof_dir
+    http_port = port
+    if slowest > 0 and prof_dir is not None and not os.path.exists(prof_dir):
+        os.makedirs(prof_dir, exist_ok=True)
+
+# start the endpoint of configure() once. Its thread must not be forked, the
+# batch modes call this after their worker processes are started
+def serve():
+    global http_server
+    if http_port is not None and http_server is None:
+        http_server = start_http_server(http_port)
+    return http_server
+
+def emit(event, **fields):
+    record = {'ts': round(time.time(), 3), 'pid': os.getpid(), 'event': event}
+    record.update(fields)
+    add_to_totals(record, totals)
+    if events_path is not None:
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        fd = os.open(events_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+def add_to_totals(record, res):
+    if record['event'] not in ('stage', 'case'):
+        return
+    if record['event'] == 'stage':
+        name = record['stage']
+    elif record.get('part') is not None:
+        # the stages of a pipeline case are timed apart, see case()
+        name = 'case_' + record['part']
+    else:
+        name = 'case'
+    with totals_lock:
+        entry = res.setdefault(name, {'runs': 0, 'seconds': 0.0})
+        entry['runs'] += 1
+        entry['seconds'] += record['seconds']
+        for key, value in record.get('counters', {}).items():
+            # the labels of a stage (eg. the pitch engine) are not summed
+            if isinstance(value, (int, float)):
+                entry[key] = entry.get(key, 0) + value
+
+
+# time a stage of the current case, the yielded dict takes the counters of
+# the stage (eg. bytes, samples)
+@contextmanager
+def stage(name, case=None, **counters):
+    counters = dict(counters)
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield counters
+        ok = True
+    finally:
+        emit('stage', stage=name, case=case or current_case(), ok=ok,
+             seconds=round(time.perf_counter() - start, 4), counters=counters)
+
+def current_case():
+    return getattr(local, 'case', None)
+
+# time a whole case, and profile it if profile_slowest is set. part: the
+# stage of a case of the pipeline mode (eg. 'decode'), they run on several
+# threads and processes and are timed apart
+@contextmanager
+def case(case_id, part=None):
+    local.case = case_id
+    # SIGPROF is only delivered to the main thread, the cases of the other
+    # threads are not profiled
+    profiler = None
+    if profile_slowest > 0 and profile_dir is not None and threading.current_thread() is threading.main_thread():
+        profiler = SamplingProfiler()
+    if profiler is not None:
+        profiler.start()
+    emit('case_start', case=case_id, part=part)
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler is not None:
+            profiler.stop()
+            keep_profile(case_id if part is None else '{0}.{1}'.format(case_id, part), seconds, profiler)
+        emit('case', case=case_id, part=part, ok=ok, seconds=round(seconds, 4))
+        local.case = None
+
+
+class SamplingProfiler(object):
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = {}
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        key = ';'.join(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def start(self):
+        # SIGPROF is only delivered to the main thread
+        if threading.current_thread() is not threading.main_thread():
+            return
+        self.previous = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        if not hasattr(self, 'previous'):
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            for key, count in sorted(self.stacks.items()):
+                f.write('{0} {1}\n'.format(key, count))
+
+# keep the profile if the case is one of the slowest of this process
+def keep_profile(case_id, seconds, profiler):
+    path = os.path.join(profile_dir, '{0}.folded'.format(case_id))
+    if len(slowest_profiles) < profile_slowest:
+        heapq.heappush(slowest_profiles, (seconds, path))
+    elif seconds > slowest_profiles[0][0]:
+        evicted = heapq.heappushpop(slowest_profiles, (seconds, path))[1]
+        if os.path.exists(evicted):
+            os.remove(evicted)
+    else:
+        return
+    profiler.save(path)
+
+
+##### Prometheus text endpoint #####
+
+class EventFileReader(object):
+
+    def __init__(self):
+        self.offset = 0
+        self.totals = {}
+        # the scrapes run on several threads
+        self.lock = threading.Lock()
+
+    # fold the new events of the other processes into self.totals, return a
+    # copy of them
+    def update(self):
+        with self.lock:
+            self.read()
+            return copy_totals(self.totals)
+
+    def read(self):
+        if events_path is None or not os.path.exists(events_path):
+            return
+        with open(events_path, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                self.offset += len(line)
+                record = json.loads(line.decode('utf-8'))
+                if record['pid'] != os.getpid():
+                    add_to_totals(record, self.totals)
+
+def copy_totals(stage_totals):
+    return dict((name, dict(entry)) for name, entry in stage_totals.items())
+
+def format_prometheus(stage_totals):
+    lines = []
+    names = sorted(set(key for entry in stage_totals.values() for key in entry))
+    for key in names:
+        metric = 'supreme_court_stage_{0}_total'.format(key)
+        lines.append('# TYPE {0} counter'.format(metric))
+        for name, entry in sorted(stage_totals.items()):
+            if key in entry:
+                lines.append('{0}{{stage="{1}"}} {2}'.format(metric, name, entry[key]))
+    return '\n'.join(lines) + '\n'
+
+def merge_totals(*all_totals):
+    res = {}
+    for t in all_totals:
+        for name, entry in t.items():
+            merged = res.setdefault(name, {})
+            for key, value in entry.items():
+                merged[key] = merged.get(key, 0) + value
+    return res
+
+def start_http_server(port):
+    reader = EventFileReader()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            # add_to_totals takes totals_lock: update the reader before
+            others = reader.update()
+            with totals_lock:
+                own = copy_totals(totals)
+            body = format_prometheus(merge_totals(own, others)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('metrics are served on http://127.0.0.1:{0}/metrics'.format(port), file=sys.stderr)
+    return server
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Cut speaker turns out of an mp3 file without decoding it.
+#
+# Every turn of an Oyez -t01.json transcript carries byte_start/byte_stop
+# offsets into the delivery mp3. We only read those byte ranges from the
+# cached mp3, snap them to MPEG audio frame boundaries and concatenate the
+# frames as they are (no PCM decode, no re-encode).
+#
+# The first frame of each range may point into the bit reservoir of the
+# previous (dropped) frame, decoders render that single frame (~26ms) as
+# silence, which is far below the resolution of the turn timestamps.
+
+import os, os.path
+
+# bitrates (kbps) of MPEG layer III indexed by the 4-bit header field
+BITRATES_V1_L3 = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+BITRATES_V2_L3 = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+# sample rates indexed by the version field: 0 = MPEG 2.5, 2 = MPEG 2, 3 = MPEG 1
+SAMPLE_RATES = {0: [11025, 12000, 8000], 2: [22050, 24000, 16000], 3: [44100, 48000, 32000]}
+
+# the offsets in the json are rounded, accept this much drift (in frames)
+# on top of the relative tolerance before falling back to decoding
+FRAME_SLACK = 2
+RATE_TOLERANCE = 0.05
+
+
+class ByteRangeError(ValueError):
+    pass
+
+
+# Parse the 4-byte frame header at buf[pos]
+# return (frame_length, bitrate_kbps, sample_rate) or None if it is not a
+# valid layer III header
+def read_frame_header(buf, pos):
+    if pos + 4 > len(buf):
+        return None
+    b1, b2, b3 = buf[pos + 1], buf[pos + 2], buf[pos + 3]
+    if buf[pos] != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = (b1 >> 3) & 0x03
+    layer = (b1 >> 1) & 0x03
+    bitrate_idx = b2 >> 4
+    rate_idx = (b2 >> 2) & 0x03
+    if version == 1 or layer != 1 or bitrate_idx in (0, 15) or rate_idx == 3 or (b3 & 0x03) == 2:
+        return None
+    padding = (b2 >> 1) & 0x01
+    sample_rate = SAMPLE_RATES[version][rate_idx]
+    if version == 3:
+        bitrate = BITRATES_V1_L3[bitrate_idx]
+        frame_length = 144000 * bitrate // sample_rate + padding
+    else:
+        bitrate = BITRATES_V2_L3[bitrate_idx]
+        frame_length = 72000 * bitrate // sample_rate + padding
+    return frame_length, bitrate, sample_rate
+
+
+# Find the first frame at or after pos whose successor also starts with a
+# valid header (a lone 0xFFE pattern inside the audio data is not a frame)
+def find_frame(buf, pos, at_eof=False):
+    end = len(buf) - 3
+    while pos < end:
+        pos = buf.find(b'\xff', pos)
+        if pos < 0 or pos >= end:
+            return -1
+        header = read_frame_header(buf, pos)
+        if header is not None:
+            next_pos = pos + header[0]
+            if read_frame_header(buf, next_pos) is not None or (at_eof and next_pos >= len(buf)):
+                return pos
+        pos += 1
+    return -1
+
+
+# size of the ID3v2 tag at the beginning of the file (0 if there is none)
+def id3_size(head):
+    if len(head) < 10 or head[0:3] != b'ID3':
+        return 0
+    size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+    footer = 10 if head[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+# Obtain the position of the first audio frame and the stream parameters
+def probe_mp3(filepath):
+    size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as f:
+        offset = id3_size(f.read(10))
+        f.seek(offset)
+        buf = f.read(16 * 1024)
+    pos = find_frame(buf, 0)
+    if pos < 0:
+        raise ByteRangeError('No mpeg audio frame found in ' + filepath)
+    frame_length, bitrate, sample_rate = read_frame_header(buf, pos)
+    # skip the Xing/Info frame of encoders like lame, it holds no audio and
+    # may use another bitrate than the stream
+    if buf.find(b'Xing', pos, pos + frame_length) > -1 or buf.find(b'Info', pos, pos + frame_length) > -1:
+        if read_frame_header(buf, pos + frame_length) is not None:
+            pos += frame_length
+            frame_length, bitrate, sample_rate = read_frame_header(buf, pos)
+    # channel mode 3 is single channel
+    channels = 1 if buf[pos + 3] >> 6 == 3 else 2
+    return {'offset': offset + pos, 'bitrate': bitrate, 'sample_rate': sample_rate,
+            'channels': channels, 'frame_length': frame_length, 'size': size}
+
+
+# Check the byte offsets of the turns against the time stamps and the file
+# raise ByteRangeError if they are missing or inconsistent
+def check_turns(turns, info):
+    bytes_per_sec = info['bitrate'] * 1000 / 8.0
+    slack = FRAME_SLACK * info['frame_length']
+    for turn in turns:
+        if len(turn) < 4 or turn[2] is None or turn[3] is None:
+            raise ByteRangeError('Missing byte offsets for turn {0}'.format(turn[:2]))
+        start, stop, byte_start, byte_stop = turn[:4]
+        if byte_stop <= byte_start or byte_start < info['offset'] - slack or byte_stop > info['size'] + slack:
+            raise ByteRangeError('Invalid byte range for turn {0}'.format(turn))
+        expected_start = info['offset'] + start * bytes_per_sec
+        if abs(byte_start - expected_start) > slack + expected_start * RATE_TOLERANCE:
+            raise ByteRangeError('Byte offset does not match the time of turn {0}'.format(turn))
+        expected_len = (stop - start) * bytes_per_sec
+        if abs((byte_stop - byte_start) - expected_len) > slack + expected_len * RATE_TOLERANCE:
+            raise ByteRangeError('Byte length does not match the duration of turn {0}'.format(turn))
+
+
+# Read the frames covering [byte_start, byte_stop) from an opened mp3 file
+def read_frames(f, byte_start, byte_stop, frame_length):
+    margin = 4 * frame_length + 4
+    f.seek(byte_start)
+    buf = f.read(byte_stop - byte_start + margin)
+    at_eof = len(buf) < byte_stop - byte_start + margin
+    first = find_frame(buf, 0, at_eof)
+    if first < 0:
+        raise ByteRangeError('No mpeg audio frame in range {0}-{1}'.format(byte_start, byte_stop))
+    limit = byte_stop - byte_start
+    pos = first
+    while pos < limit:
+        header = read_frame_header(buf, pos)
+        if header is None or pos + header[0] > len(buf):
+            break
+        pos += header[0]
+    return buf[first:pos]
+
+
+# Read the frames of the turns [(start, stop, byte_start, byte_stop), ...]
+# from mp3_file, return the concatenated frames (a playable mp3 stream)
+def read_turns(mp3_file, turns, info=None):
+    if info is None:
+        info = probe_mp3(mp3_file)
+    check_turns(turns, info)
+    with open(mp3_file, 'rb') as f:
+        return b''.join(read_frames(f, turn[2], turn[3], info['frame_length']) for turn in turns)
+
+# Extract the turns from mp3_file and write the concatenated frames to
+# out_path, return the number of bytes written
+def extract_turns(mp3_file, turns, out_path, info=None):
+    data = read_turns(mp3_file, turns, info)
+    with open(out_path, 'wb') as out:
+        out.write(data)
+    return len(data)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Staged pipeline runner: the cases flow through a list of stages connected
+# by bounded queues, every stage runs on its own workers.
+#
+#   stages = [Stage('download', fetch, 8, 'thread'),      # network
+#             Stage('decode', decode, 2, 'process'),      # ffmpeg / CPU
+#             Stage('f0', analyze, 4, 'process')]         # CPU
+#   run_pipeline(items, stages, on_result, queue_size=4)
+#
+# With run_in_pool (batchpool.py) every case runs all of its steps in order
+# in a worker, so a worker waiting on the network holds a CPU slot. Here
+# the stages of different cases overlap and the throughput is set by the
+# slowest stage. The queues are bounded, a full queue blocks the stage
+# feeding it, so at most (queue_size + workers) cases per stage are in
+# memory whatever the number of cases.
+#
+# The stages are driven by an asyncio loop:
+#   'thread'   the I/O bound stages, on a thread pool
+#   'process'  the CPU bound stages, on a process pool (the value passed
+#              between the stages must be picklable)
+#   'async'    a coroutine function, run in the loop
+# A failure is not passed to the next stages, on_result(item, result,
+# error) is called in the loop thread for every item, in the order they
+# complete, with error the traceback text (like run_in_pool).
+
+import time
+import asyncio
+import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from batchpool import call_safely, start_pool
+
+
+class Stage(object):
+
+    def __init__(self, name, func, workers=1, kind='thread'):
+        if kind not in ('thread', 'process', 'async'):
+            raise ValueError('Unknown stage kind: ' + kind)
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.kind = kind
+        self.executor = None
+
+    def start(self):
+        if self.kind == 'process':
+            # fork the workers now, before the loop and the thread stages
+            # start any thread in this process
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'))
+            wait([self.executor.submit(time.sleep, 0.1) for i in range(self.workers)])
+        elif self.kind == 'thread':
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix=self.name)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    # run the stage on a value, return (result, error)
+    async def call(self, value):
+        if self.kind == 'async':
+            try:
+                return await self.func(value), None
+            except Exception:
+                return None, traceback.format_exc()
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        try:
+            return (await loop.run_in_executor(executor, call_safely, self.func, value))[1:]
+        except BrokenProcessPool:
+            # a worker crashed (eg. praat core dump), the cases it was running
+            # fail and a new pool takes the next ones. The threads of this
+            # process are running now, see start_pool
+            if self.executor is executor:
+                executor.shutdown(wait=False)
+                self.executor = start_pool(self.workers)
+            return None, traceback.format_exc()
+
+# marks the end of the items in a queue
+DONE = None
+
+
+async def run_stages(items, stages, on_result, queue_size, on_submit):
+    queues = [asyncio.Queue(queue_size) for i in range(len(stages) + 1)]
+
+    async def feed():
+        for item in items:
+            if on_submit is not None:
+                on_submit(item)
+            await queues[0].put((item, item, None))
+        for i in range(stages[0].workers):
+            await queues[0].put(DONE)
+
+    async def worker(i, stage):
+        while True:
+            record = await queues[i].get()
+            if record is DONE:
+                return
+            item, value, error = record
+            if error is None:
+                value, error = await stage.call(value)
+            await queues[i + 1].put((item, value, error))
+
+    async def run_stage(i, stage):
+        await asyncio.gather(*[worker(i, stage) for j in range(stage.workers)])
+        next_workers = stages[i + 1].workers if i + 1 < len(stages) else 1
+        for j in range(next_workers):
+            await queues[i + 1].put(DONE)
+
+    async def sink():
+        while True:
+            record = await queues[-1].get()
+            if record is DONE:
+                return
+            on_result(*record)
+
+    await asyncio.gather(feed(), sink(), *[run_stage(i, stage) for i, stage in enumerate(stages)])
+
+
+# Run the items through the stages, on_result(item, result, error) is called
+# for each item, on_submit(item) right before an item enters the pipeline,
+# on_start() once the process pools are started (eg. metrics.serve)
+# queue_size: the size of the queue in front of every stage
+def run_pipeline(items, stages, on_result, queue_size=None, on_submit=None, on_start=None):
+    if queue_size is None:
+        queue_size = max(stage.workers for stage in stages)
+    # the process pools first, see Stage.start
+    ordered = sorted(stages, key=lambda stage: stage.kind != 'process')
+    try:
+        for stage in ordered:
+            stage.start()
+        if on_start is not None:
+            on_start()
+        asyncio.run(run_stages(items, stages, on_result, queue_size, on_submit))
+    finally:
+        for stage in stages:
+            stage.close()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# F0 (pitch) statistics computed in process with parselmouth.
+#
+# It replaces the round trip through myspsolution.praat (TextGrids in tmp/,
+# mean and std picked out of the captured stdout) by Sound.to_pitch with the
+# same parameters, run on PCM samples which are already in memory.
+
+from collections import namedtuple
+import numpy as np
+import parselmouth
+
+# the parameters myspsolution.praat is called with in step2.py
+PITCH_FLOOR = 80
+PITCH_CEILING = 400
+TIME_STEP = 0.01
+
+# mean/std/median/minimum/maximum are in Hz over the voiced frames
+PitchStats = namedtuple('PitchStats', ['mean', 'std', 'median', 'minimum', 'maximum', 'voiced_frames', 'frames'])
+
+
+class PitchError(ValueError):
+    pass
+
+
+# the samples of a pydub AudioSegment as mono float64 in [-1, 1]
+def segment_to_samples(sound):
+    samples = np.array(sound.get_array_of_samples(), dtype=np.float64)
+    if sound.channels > 1:
+        samples = samples.reshape(-1, sound.channels).mean(axis=1)
+    return samples / (1 << (8 * sound.sample_width - 1))
+
+# F0 statistics of a pitch contour
+def pitch_stats(pitch):
+    f0 = pitch.selected_array['frequency']
+    voiced = f0[f0 > 0]
+    if len(voiced) < 2:
+        raise PitchError('No voiced frame found ({0} frames)'.format(len(f0)))
+    return PitchStats(float(voiced.mean()), float(voiced.std(ddof=1)), float(np.median(voiced)),
+                      float(voiced.min()), float(voiced.max()), len(voiced), len(f0))
+
+# F0 statistics of a parselmouth Sound
+def sound_f0_stats(sound, floor=PITCH_FLOOR, ceiling=PITCH_CEILING, time_step=TIME_STEP):
+    if sound.duration < 3.0 / floor:
+        raise PitchError('Sound is too short: {0} seconds'.format(sound.duration))
+    pitch = sound.to_pitch(time_step=time_step, pitch_floor=floor, pitch_ceiling=ceiling)
+    return pitch_stats(pitch)
+
+# F0 statistics of mono samples (float in [-1, 1])
+def f0_stats(samples, sample_rate, floor=PITCH_FLOOR, ceiling=PITCH_CEILING, time_step=TIME_STEP):
+    sound = parselmouth.Sound(np.asarray(samples, dtype=np.float64), sampling_frequency=sample_rate)
+    return sound_f0_stats(sound, floor, ceiling, time_step)
+
+# F0 statistics of a pydub AudioSegment
+def segment_f0_stats(segment, floor=PITCH_FLOOR, ceiling=PITCH_CEILING, time_step=TIME_STEP):
+    return f0_stats(segment_to_samples(segment), segment.frame_rate, floor, ceiling, time_step)
+
+# a sound file as a mono parselmouth Sound (praat reads wav, mp3, flac...)
+def read_sound(sound_path):
+    try:
+        sound = parselmouth.Sound(sound_path)
+    except parselmouth.PraatError as e:
+        raise PitchError('Can not read {0}: {1}'.format(sound_path, e))
+    if sound.n_channels > 1:
+        sound = sound.convert_to_mono()
+    return sound
+
+# F0 statistics of a sound file
+def f0_stats_from_file(sound_path, floor=PITCH_FLOOR, ceiling=PITCH_CEILING, time_step=TIME_STEP):
+    return sound_f0_stats(read_sound(sound_path), floor, ceiling, time_step)
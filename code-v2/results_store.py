@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Results of step2.py in a SQLite database (WAL mode).
+#
+# One row per case, keyed by the case id, with a status column:
+#   processing  the case was handed to a worker (a crash leaves it here)
+#   done        the csv row of the case is stored
+#   failed      the failure reason is stored
+# result.csv and fail.csv are exported from it for compatibility, without
+# the duplicated rows of the append-only files.
+
+import os, os.path
+import csv          # csv.reader, csv.writer
+import json         # json.dumps
+import sqlite3
+import time
+import urllib.parse
+
+STATUS_PROCESSING = 'processing'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+class ResultStore(object):
+
+    # batch_size: number of results written per commit
+    # read_only: open an existing database without changing it (no table or
+    #   journal mode set up)
+    def __init__(self, db_path, batch_size=50, read_only=False):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.uncommitted = 0
+        # called before every commit, eg. FeatureWriter.flush: the features of
+        # the cases are written before the cases are committed as done
+        self.before_commit = None
+        if read_only:
+            self.conn = connect_read_only(db_path)
+            return
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS results (
+                                 case_id TEXT PRIMARY KEY,
+                                 seq TEXT,
+                                 status TEXT NOT NULL,
+                                 row TEXT,
+                                 reason TEXT,
+                                 updated REAL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS results_status ON results (status)')
+        self.conn.commit()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def commit(self):
+        if self.before_commit is not None:
+            self.before_commit()
+        self.conn.commit()
+        self.uncommitted = 0
+
+    # the status of a case, None if it was never processed
+    def status(self, case_id):
+        res = self.conn.execute('SELECT status FROM results WHERE case_id = ?', (case_id,)).fetchone()
+        return None if res is None else res[0]
+
+    # the number of cases per status
+    def counts(self):
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM results GROUP BY status').fetchall())
+
+    def upsert(self, case_id, seq, status, row=None, reason=None):
+        self.conn.execute('''INSERT INTO results (case_id, seq, status, row, reason, updated)
+                             VALUES (?, ?, ?, ?, ?, ?)
+                             ON CONFLICT (case_id) DO UPDATE SET
+                                 seq = excluded.seq, status = excluded.status, row = excluded.row,
+                                 reason = excluded.reason, updated = excluded.updated''',
+                          (case_id, seq, status, None if row is None else json.dumps(row), reason, time.time()))
+        self.uncommitted += 1
+        if self.uncommitted >= self.batch_size:
+            self.commit()
+
+    # mark a case before it is handed to a worker, committed right away (with
+    # the pending results) so a crashing case is not retried by the next run
+    def mark_processing(self, case_id, seq):
+        self.upsert(case_id, seq, STATUS_PROCESSING)
+        self.commit()
+
+    def save_result(self, case_id, seq, row):
+        self.upsert(case_id, seq, STATUS_DONE, row=row)
+
+    def save_failure(self, case_id, seq, reason):
+        self.upsert(case_id, seq, STATUS_FAILED, reason=reason)
+
+    # Import the rows of the csv files written by the older step2.py
+    def import_csv(self, csv_path, csv_fail_path):
+        for path, status in ((csv_fail_path, STATUS_FAILED), (csv_path, STATUS_DONE)):
+            if not os.path.exists(path):
+                continue
+            with open(path) as f:
+                rows = list(csv.reader(f))[1:]  # remove header
+            for row in rows:
+                if len(row) < 2:
+                    continue
+                if status == STATUS_DONE:
+                    self.upsert(row[1], row[0], STATUS_DONE, row=row[1:])
+                elif row[2:3] == ['processing...']:
+                    # the marker written before each case, kept only if
+                    # nothing else is known about the case (a crash)
+                    if self.status(row[1]) is None:
+                        self.upsert(row[1], row[0], STATUS_PROCESSING)
+                else:
+                    self.upsert(row[1], row[0], STATUS_FAILED, reason=','.join(row[2:]))
+        self.commit()
+
+    # Write result.csv (done cases) and fail.csv (failed or crashed cases)
+    def export_csv(self, csv_path, csv_fail_path, headers):
+        self.commit()
+        done = self.conn.execute('SELECT seq, row FROM results WHERE status = ? ORDER BY case_id', (STATUS_DONE,))
+        write_csv(csv_path, headers, ([seq] + json.loads(row) for seq, row in done))
+        failed = self.conn.execute('SELECT seq, case_id, status, reason FROM results WHERE status != ? ORDER BY case_id', (STATUS_DONE,))
+        write_csv(csv_fail_path, headers, ([seq, case_id, reason if status == STATUS_FAILED else 'processing...']
+                                           for seq, case_id, status, reason in failed))
+
+
+# write a csv file atomically
+def write_csv(filename, fields, rows):
+    with open(filename + '.tmp', 'w') as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(fields)
+        csvwriter.writerows(rows)
+    os.replace(filename + '.tmp', filename)
+
+
+# a read only connection to an existing database
+def connect_read_only(db_path):
+    uri = 'file:{0}?mode=ro'.format(urllib.parse.quote(os.path.abspath(db_path)))
+    return sqlite3.connect(uri, uri=True, timeout=60)
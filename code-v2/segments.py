@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Gather the turns of the speakers out of a decoded AudioSegment.
+#
+# `result = result + sound[start:stop]` copies the whole accumulated track
+# for every turn. Here the byte offsets of all the turns are computed at
+# once with numpy and each speaker's track is built by a single join over
+# memoryview slices of the raw data, so every sample is copied once.
+
+import numpy as np
+
+
+# byte offsets of turns [(start, stop, ...), ...] (in seconds) in the raw
+# data of sound, picking the same frames as pydub's sound[start_ms:stop_ms]
+def turn_offsets(turns, sound):
+    times = np.array([(turn[0], turn[1]) for turn in turns], dtype=np.float64).reshape(-1, 2)
+    ms = np.minimum(times * 1000, len(sound))
+    frames = (ms * sound.frame_rate / 1000.0).astype(np.int64)
+    offsets = frames * sound.frame_width
+    return np.minimum(offsets, len(sound.raw_data))
+
+# the raw data of the turns, concatenated
+def gather_data(offsets, data):
+    view = memoryview(data)
+    return b''.join(view[start:stop] for start, stop in offsets.tolist() if stop > start)
+
+# the turns of a speaker concatenated into a single AudioSegment
+def gather_turns(turns, sound):
+    return sound._spawn(gather_data(turn_offsets(turns, sound), sound.raw_data))
+
+# the tracks of all the speakers {speaker identifier: AudioSegment}
+# the offsets of every turn of every speaker are computed in one pass
+def gather_speakers(speakerMap, sound):
+    keys = list(speakerMap)
+    counts = [len(speakerMap[key]) for key in keys]
+    offsets = turn_offsets([turn for key in keys for turn in speakerMap[key]], sound)
+    bounds = np.cumsum([0] + counts)
+    data = sound.raw_data
+    return dict((key, sound._spawn(gather_data(offsets[bounds[i]:bounds[i + 1]], data)))
+                for i, key in enumerate(keys))
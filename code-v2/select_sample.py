@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# -*- encoding:utf-8 -*-
+
+import os, os.path, operator
+import glob                     # glob.glob
+import sys
+import json                     # json.dump
+import fcntl                    # fcntl.ioctl
+import shutil       # shutil.copy2
+import random
+
+# the original json dir (which contains both -t01.json & its correspondings
+base_dir='1994_2019'
+# copy the expected json to the out_dir
+out_dir = '1994_2019-sample-936/json'
+# the txt file which contains the selected *-t01.json file names
+txt_selected = '1994_2019-sample-936.txt'
+
+# how the cases are picked (see select_cases):
+# 'list':       the *-t01.json files of txt_selected
+# 'random':     sample_size cases of base_dir at random
+# 'stratified': sample_size cases of base_dir, the same number from every
+#               term (a term with fewer cases leaves its share to the others)
+# 'gender':     sample_size cases of base_dir, the same number for every
+#               pair of genders of the top advocates (appellant, appellee)
+select_rule = 'list'
+sample_size = 500
+# the seed of the random picks, the same seed on the same metadata gives the
+# same sample
+sample_seed = 0
+# drop the cases whose top advocate of a side talks less than this (seconds)
+min_advocate_seconds = 0
+# drop the cases step2.py fails on before anything is downloaded: no mp3
+# (media_file is None), no transcript, only one side of advocates detected
+# (the 'list' rule keeps the listed cases and prints a warning instead)
+skip_unusable = True
+# the metadata of the cases (media, advocates, genders, talk time), read
+# once and only updated for the json files changed since (None: no cache)
+metadata_path = '1994_2019-metadata.json'
+
+# how the sample is materialised in out_dir:
+# 'manifest': only write the manifest, step1.py / step2.py read the files
+#             from base_dir through it (sample_manifest)
+# 'hardlink': hard links to base_dir (copy if base_dir is on another disk)
+# 'symlink':  symbolic links to base_dir
+# 'reflink':  copy on write clones (btrfs, xfs), copy if not supported
+# 'copy':     full copies
+link_mode = 'hardlink'
+# the manifest of the sample, written in every mode
+manifest_path = '1994_2019-sample-936/manifest.json'
+# folder of the mp3 files downloaded for the whole corpus, the mp3 of the
+# selected cases are staged in mp3_out_dir the same way (None: no mp3)
+mp3_base_dir = None
+mp3_out_dir = '1994_2019-sample-936/mp3'
+
+# ioctl cloning a file on linux
+FICLONE = 0x40049409
+
+
+# whether dst already is src materialised with mode
+def is_same(src, dst, mode):
+    if mode == 'symlink':
+        return os.path.islink(dst) and os.readlink(dst) == os.path.abspath(src)
+    if os.path.islink(dst) or not os.path.exists(dst):
+        return False
+    st_src, st_dst = os.stat(src), os.stat(dst)
+    if mode == 'hardlink' and st_src.st_ino == st_dst.st_ino and st_src.st_dev == st_dst.st_dev:
+        return True
+    # a copy (or the copy fallback) is unchanged if size and mtime match
+    return st_src.st_size == st_dst.st_size and int(st_src.st_mtime) == int(st_dst.st_mtime)
+
+def copy_file(src, dst, reflink=False):
+    if reflink:
+        try:
+            with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+                fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+            shutil.copystat(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+# materialise src as dst, return False if dst was already up to date
+def link_file(src, dst, mode):
+    if is_same(src, dst, mode):
+        return False
+    tmp = dst + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(src), tmp)
+    elif mode == 'hardlink':
+        try:
+            os.link(src, tmp)
+        except OSError:
+            # eg. base_dir on another file system
+            copy_file(src, tmp)
+    else:
+        copy_file(src, tmp, mode == 'reflink')
+    os.replace(tmp, dst)
+    return True
+
+# the mp3 file of a case in mp3_base_dir, None if not downloaded
+def find_mp3(json_file):
+    if mp3_base_dir is None:
+        return None
+    from transcript import load_transcript
+    url = load_transcript(json_file).media_url
+    if url is None:
+        return None
+    path = os.path.join(mp3_base_dir, url.split('/')[-1])
+    return path if os.path.exists(path) else None
+
+# materialise the files (src, dst) in out_folder, if prune is true remove the
+# ones of a previous selection. return the number of files changed
+def materialise(files, out_folder, mode, prune=True):
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+    changed = 0
+    for src, dst in files:
+        if link_file(src, dst, mode):
+            print('link ' + dst)
+            changed += 1
+    if not prune:
+        return changed
+    expected = set(os.path.basename(dst) for src, dst in files)
+    for filename in os.listdir(out_folder):
+        if filename not in expected:
+            print('remove ' + filename)
+            os.remove(os.path.join(out_folder, filename))
+            changed += 1
+    return changed
+
+# write the manifest, only if it changed
+# selection: the rule and the settings the cases were picked with
+def write_manifest(path, cases, selection=None):
+    manifest = {'base_dir': os.path.abspath(base_dir), 'cases': cases}
+    if selection is not None:
+        manifest['selection'] = selection
+    data = json.dumps(manifest, indent=1, sort_keys=True)
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == data:
+                return False
+    with open(path + '.tmp', 'w') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+    return True
+
+# the cases of a manifest: [{'case_id', 'transcript', 'meta', 'mp3'}]
+def load_manifest(path):
+    with open(path) as f:
+        return json.load(f)['cases']
+
+# the files of a kind ('transcript', 'meta', 'mp3') listed in a manifest
+def manifest_files(path, kind):
+    return [case[kind] for case in load_manifest(path) if case[kind] is not None]
+
+
+# [size, mtime] of a file, None if it does not exist
+def file_stamp(path):
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+# the metadata of a case from its json files (no audio):
+# {'case_id', 'term', 'media', 'sections', 'advocates'}, advocates is
+# {identifier: [role, gender, talk time in seconds]} (None if unknown)
+def read_metadata(transcript_path):
+    from transcript import load_transcript, load_case_meta, get_term
+    from gender import NameMatcher
+    case_id = os.path.basename(transcript_path)[0:-9]
+    record = {'case_id': case_id, 'term': get_term(case_id), 'media': False, 'sections': False, 'advocates': None}
+    if not os.path.exists(transcript_path):
+        record['missing'] = True
+        return record
+    t = load_transcript(transcript_path)
+    record.update(media=t.media_url is not None, sections=t.speakers is not None)
+    meta_path = transcript_path[0:-9] + '.json'
+    if os.path.exists(meta_path):
+        m = load_case_meta(meta_path)
+        if m.advocates is not None:
+            # the same detection as step2.get_speaker_gender_map
+            genders = NameMatcher(set(m.last_names.values())).gender_map(t.texts)
+            durations = t.durations()
+            record['advocates'] = dict((id, [role, genders.get(m.last_names[id], 'X'), durations.get(id, 0.0)])
+                                       for id, role in m.advocates.items())
+    return record
+
+# the metadata of the -t01.json files, from metadata_path when the json
+# files did not change
+def load_metadata(transcripts):
+    cached = {}
+    if metadata_path is not None and os.path.exists(metadata_path):
+        with open(metadata_path) as f:
+            cached = json.load(f)
+    records, changed = {}, False
+    for path in transcripts:
+        case_id = os.path.basename(path)[0:-9]
+        stamp = [file_stamp(path), file_stamp(path[0:-9] + '.json')]
+        record = cached.get(case_id)
+        if record is None or record['stamp'] != stamp:
+            record = read_metadata(path)
+            record['stamp'] = stamp
+            changed = True
+        record['transcript'] = path
+        records[case_id] = record
+    if metadata_path is not None and (changed or len(records) != len(cached)):
+        # merged with the cases of the other runs (eg. another txt_selected)
+        cached.update(records)
+        with open(metadata_path + '.tmp', 'w') as f:
+            json.dump(cached, f)
+        os.replace(metadata_path + '.tmp', metadata_path)
+    return [records[case_id] for case_id in sorted(records)]
+
+# {role: (identifier, gender, talk time)} of the advocate talking the most
+# on each side
+def top_advocates(record):
+    tops = {}
+    for id, (role, gender, seconds) in sorted((record['advocates'] or {}).items()):
+        if role not in tops or seconds > tops[role][2]:
+            tops[role] = (id, gender, seconds)
+    return tops
+
+# why step2.py would fail on a case, None if it should not
+def unusable_reason(record):
+    from transcript import STR_APPELLANT, STR_APPELLEE
+    if record.get('missing'):
+        return 'no json file'
+    if not record['media']:
+        return 'no mp3'
+    if not record['sections']:
+        return 'no transcript sections'
+    if not record['advocates']:
+        return 'no advocates'
+    roles = set(role for role, gender, seconds in record['advocates'].values())
+    if STR_APPELLANT not in roles or STR_APPELLEE not in roles:
+        return 'only one side'
+    return None
+
+# the key of the group of a case for the 'stratified' and 'gender' rules
+def group_key(record, rule):
+    if rule == 'stratified':
+        return record['term']
+    from transcript import STR_APPELLANT, STR_APPELLEE
+    tops = top_advocates(record)
+    return '-'.join(tops[role][1] if role in tops else 'X' for role in (STR_APPELLANT, STR_APPELLEE))
+
+# take the cases from the groups in turn (each group in its order) until
+# size cases are taken or the groups are empty
+def pick_evenly(groups, size):
+    picked = []
+    queues = [list(groups[key]) for key in sorted(groups)]
+    while len(picked) < size and any(queues):
+        for queue in queues:
+            if queue and len(picked) < size:
+                picked.append(queue.pop(0))
+    return picked
+
+# pick the cases from the metadata records, return (records, {reason of the
+# dropped cases: count})
+# the cases are ranked in a random order (seed), the rules take them from
+# the top of the ranking, so the same seed gives the same sample
+def select_cases(records, rule, size, seed=0, min_seconds=0, skip=True):
+    candidates, dropped = [], {}
+    for record in records:
+        reason = unusable_reason(record) if skip else None
+        if reason is None and min_seconds > 0:
+            tops = top_advocates(record)
+            if len(tops) < 2 or min(seconds for id, gender, seconds in tops.values()) < min_seconds:
+                reason = 'advocate talk time < {0}s'.format(min_seconds)
+        if reason is not None and rule == 'list' and not record.get('missing'):
+            # an explicitly listed case is kept
+            print('Warning: {0} is kept, but {1}'.format(record['case_id'], reason))
+            reason = None
+        if reason is not None:
+            dropped[reason] = dropped.get(reason, 0) + 1
+            continue
+        candidates.append(record)
+    candidates.sort(key=operator.itemgetter('case_id'))
+    if rule == 'list':
+        return candidates, dropped
+    random.Random(seed).shuffle(candidates)
+    if rule == 'random':
+        return candidates[:size], dropped
+    if rule not in ('stratified', 'gender'):
+        raise ValueError('Unknown select rule: ' + rule)
+    groups = {}
+    for record in candidates:
+        groups.setdefault(group_key(record, rule), []).append(record)
+    return pick_evenly(groups, size), dropped
+
+# the -t01.json files to select from
+def candidate_transcripts():
+    if select_rule != 'list':
+        return glob.glob(os.path.join(base_dir, '*-t01.json'))
+    res = []
+    with open(txt_selected) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                res.append(os.path.join(base_dir, line))
+    return res
+
+def main():
+    records, dropped = select_cases(load_metadata(candidate_transcripts()), select_rule, sample_size,
+                                    sample_seed, min_advocate_seconds, skip_unusable)
+    for reason, count in sorted(dropped.items()):
+        print('{0} case(s) dropped: {1}'.format(count, reason))
+    if select_rule in ('stratified', 'gender'):
+        counts = {}
+        for record in records:
+            key = group_key(record, select_rule)
+            counts[key] = counts.get(key, 0) + 1
+        for key, count in sorted(counts.items()):
+            print('{0}: {1} case(s)'.format(key, count))
+    print('{0} case(s) selected'.format(len(records)))
+
+    cases = []
+    for record in records:
+        p1 = record['transcript']
+        p2 = p1[0:-9] + '.json'
+        mp3 = find_mp3(p1)
+        cases.append({'case_id': record['case_id'], 'transcript': os.path.abspath(p1), 'meta': os.path.abspath(p2),
+                      'mp3': None if mp3 is None else os.path.abspath(mp3)})
+    cases.sort(key=operator.itemgetter('case_id'))
+    selection = {'rule': select_rule, 'size': sample_size, 'seed': sample_seed,
+                 'min_advocate_seconds': min_advocate_seconds, 'skip_unusable': skip_unusable}
+
+    if link_mode != 'manifest':
+        files = []
+        for case in cases:
+            files.append((case['transcript'], os.path.join(out_dir, case['case_id'] + '-t01.json')))
+            files.append((case['meta'], os.path.join(out_dir, case['case_id'] + '.json')))
+        print('{0} json file(s) changed'.format(materialise(files, out_dir, link_mode)))
+        if mp3_base_dir is not None:
+            files = [(case['mp3'], os.path.join(mp3_out_dir, os.path.basename(case['mp3']))) for case in cases if case['mp3']]
+            # mp3_out_dir is also the download folder of step1.py, keep
+            # the files downloaded there
+            print('{0} mp3 file(s) changed'.format(materialise(files, mp3_out_dir, link_mode, False)))
+
+    manifest_dir = os.path.dirname(manifest_path)
+    if manifest_dir and not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+    if write_manifest(manifest_path, cases, selection):
+        print('manifest is saved to: ' + manifest_path)
+    print('done')
+
+if __name__ == '__main__':
+    main()
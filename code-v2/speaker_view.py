@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# A lazy view of the speakers of a case.
+#
+# The durations, the ranking and the turn selections only use the turn
+# metadata ({speaker identifier: [(start, stop, byte_start, byte_stop)]}),
+# no audio is touched until tracks() is called, and then only the turns of
+# the selected speakers are read:
+#
+#   view = CaseView(speakerMap, lambda: download_mp3(url))
+#   selection = view.select(top_k=2, first_turns=1)   # metadata only
+#   tracks = view.tracks(selection)                   # {key: AudioSegment}
+#
+# The mp3 may be given as a function, so it is only downloaded when the
+# audio is needed.
+
+import io
+
+from pydub import AudioSegment
+
+from mp3frames import probe_mp3, read_turns, ByteRangeError
+from segments import gather_speakers
+from stream_decode import stream_turns, BufferSink, SAMPLE_WIDTH
+from timeline import to_array, total_duration, normalize_speakers
+from transcript import load_transcript
+
+
+# total talk time (in seconds) of the turns of a speaker, overlapping turns
+# are counted once
+def talk_time(turns):
+    return total_duration(to_array(turns))
+
+# the turns cut after `seconds` of talk time, the byte offsets of a turn cut
+# in the middle are interpolated (the mp3 is CBR)
+def truncate_turns(turns, seconds):
+    res = []
+    for turn in turns:
+        if seconds <= 0:
+            break
+        length = turn[1] - turn[0]
+        if length > seconds:
+            stop = turn[0] + seconds
+            byte_start, byte_stop = turn[2], turn[3]
+            if byte_start is not None and byte_stop is not None:
+                byte_stop = byte_start + int((byte_stop - byte_start) * seconds / length)
+            turn = (turn[0], stop, byte_start, byte_stop)
+        res.append(turn)
+        seconds -= length
+    return res
+
+
+class CaseView(object):
+
+    # mp3_file: the path of the mp3, or a function returning it (called once,
+    # when the audio is first needed)
+    # byte_range: read the selected turns by their byte offsets when usable
+    # streaming: otherwise decode as a stream up to the last selected turn,
+    #   instead of decoding the whole mp3
+    def __init__(self, speakerMap, mp3_file=None, byte_range=True, streaming=True):
+        self.speakerMap = speakerMap
+        self.mp3_source = mp3_file
+        self.byte_range = byte_range
+        self.streaming = streaming
+
+    @property
+    def mp3_file(self):
+        if callable(self.mp3_source):
+            self.mp3_source = self.mp3_source()
+        return self.mp3_source
+
+    def speakers(self):
+        return list(self.speakerMap)
+
+    # {speaker identifier: talk time in seconds}
+    def durations(self):
+        return dict((key, talk_time(turns)) for key, turns in self.speakerMap.items())
+
+    # the identifiers of the top k speakers by talk time
+    def top(self, k):
+        durations = self.durations()
+        keys = sorted(durations, key=lambda key: durations[key], reverse=True)
+        if len(keys) < k:
+            raise ValueError('Only {0} speaker(s) found'.format(len(keys)))
+        return keys[:k]
+
+    # the turns to materialise {speaker identifier: [turn, ...]}
+    # keys: the speakers (default: all), top_k: the top k speakers instead
+    # first_turns: only the first n turns of each speaker
+    # first_seconds: only the first n seconds of talk of each speaker
+    def select(self, keys=None, top_k=None, first_turns=None, first_seconds=None):
+        if top_k is not None:
+            keys = self.top(top_k)
+        elif keys is None:
+            keys = self.speakers()
+        selection = {}
+        for key in keys:
+            turns = self.speakerMap[key]
+            if first_turns is not None:
+                turns = turns[:first_turns]
+            if first_seconds is not None:
+                turns = truncate_turns(turns, first_seconds)
+            selection[key] = turns
+        return selection
+
+    # the tracks of a selection {speaker identifier: AudioSegment}, the turns
+    # of each speaker concatenated (default: every turn of every speaker)
+    def tracks(self, selection=None):
+        if selection is None:
+            selection = self.select()
+        if not selection:
+            return {}
+        mp3_file = self.mp3_file
+        if self.byte_range:
+            try:
+                info = probe_mp3(mp3_file)
+                return dict((key, AudioSegment.from_file(io.BytesIO(read_turns(mp3_file, turns, info)), format='mp3'))
+                            for key, turns in selection.items())
+            except ByteRangeError as e:
+                print('Byte range extraction failed, fall back to decoding:', e)
+        if self.streaming:
+            info = probe_mp3(mp3_file)
+            sinks = dict((key, BufferSink()) for key in selection)
+            stream_turns(mp3_file, selection, sinks, info['sample_rate'], info['channels'])
+            return dict((key, AudioSegment(bytes(sink.data), sample_width=SAMPLE_WIDTH,
+                                           frame_rate=info['sample_rate'], channels=info['channels']))
+                        for key, sink in sinks.items())
+        return gather_speakers(selection, AudioSegment.from_mp3(mp3_file))
+
+
+# the view of a -t01.json file (turns cleaned by timeline.py), None if it
+# has no turns
+def open_case(json_file, mp3_file=None, gap=0.0, clip_overlaps=False, **kwargs):
+    speakers = load_transcript(json_file).speakers
+    if speakers is None:
+        return None
+    return CaseView(normalize_speakers(speakers, gap, clip_overlaps), mp3_file, **kwargs)
@@ -1,17 +1,23 @@
 #!/usr/bin/env python3
 # -*- encoding:utf-8 -*-
 
-from pydub import AudioSegment
-from parselmouth.praat import run_file
 import os, os.path  # os.path.sep
 import sys          # sys.exit
-import json         # json.load
 import shutil       # shutil.rmtree
-import requests     # requests.get
 import glob         # glob.glob
-import operator 
-import csv          # csv.writer
+import io           # io.BytesIO
+import json         # json.dumps
 import time
+from transcript import load_transcript
+import metrics
+from select_sample import manifest_files
+from cache import get_cache, file_hash, make_key
+from stream_decode import stream_turns, BufferSink, EncoderSink, SAMPLE_WIDTH
+from mp3frames import probe_mp3, read_turns, extract_turns, ByteRangeError
+from batchpool import run_in_pool, default_workers
+# pydub, numpy (timeline.py, segments.py, speaker_view.py) and requests
+# (downloader.py) are imported by the functions using them, so the single
+# file mode, the dry runs and the status of cli.py start fast
 
 
 # get the current directory of the script
@@ -25,71 +31,146 @@ output_dir = os.path.join(cur_dir_path, sample_dir + 'splitted_mp3')
 mp3_folder = os.path.join(cur_dir_path, sample_dir + 'mp3')
 # eg: processing all xx-t01.json: json/*-t01.json
 json_patten_in_batch = os.path.join(cur_dir_path, sample_dir + 'json/*-t01.json')
+# the manifest written by select_sample.py, if set its -t01.json files are
+# processed instead of json_patten_in_batch, and its mp3 files (the corpus
+# ones) are used instead of downloading them into mp3_folder
+sample_manifest = None
+# cut the turns by the byte offsets of the json instead of decoding the mp3
+# (falls back to decoding if the offsets are missing or inconsistent)
+byte_range_mode = True
+# decode the mp3 as a stream and route the turns to the outputs on the fly,
+# the memory used does not grow with the length of the argument
+streaming_decode = False
+# drop the silences and the noises of the turns (vad.py) before they are
+# encoded, the speech ratio of every speaker goes to the metrics (the byte
+# range mode copies the mp3 frames without decoding them, nothing is dropped)
+vad_trim = False
+# cache of the decoded turns (see cache.py), None to disable it
+cache_dir = os.path.join(cur_dir_path, sample_dir + 'cache')
+cache_max_bytes = 20 * 1024 ** 3
+# json lines file of the per-stage metrics (see metrics.py), None to disable
+metrics_path = os.path.join(cur_dir_path, sample_dir + 'metrics.jsonl')
+# serve the Prometheus text endpoint on this port (None: no endpoint)
+metrics_port = None
+# keep the sampling profiles of the N slowest cases in profile_dir (0: off)
+profile_slowest = 0
+profile_dir = os.path.join(cur_dir_path, sample_dir + 'profiles')
+# number of concurrent mp3 downloads
+download_workers = 4
+# clean the turns before slicing them (see timeline.py): merge the turns of
+# a speaker at most turn_merge_gap seconds apart (and the overlapping or
+# touching ones), None: the turns are sliced as in the json
+# clip_overlapping_turns: also remove the time where several speakers talk
+# at once from all of them.
+# Both change the slices (and the F0) of some cases, off to keep the results
+# of the earlier runs
+turn_merge_gap = None
+clip_overlapping_turns = False
+# plan the extraction from the turn index built by turn_index.py instead of
+# the json files (None: read the json files)
+turn_index_dir = None
+# number of worker processes for the batch mode
+num_workers = default_workers
+# number of the next cases whose mp3 is downloaded in the background
+prefetch_count = 4
+# 'pool': every case is downloaded and split in a row on one of num_workers
+#   processes, 'pipeline': the downloads (pipeline_io_workers threads) and
+#   the splitting (pipeline_split_workers processes) overlap (pipeline.py)
+batch_engine = 'pool'
+pipeline_io_workers = 8
+pipeline_split_workers = default_workers
+# cases waiting in front of each stage (None: the number of its workers)
+pipeline_queue_size = None
 
 ##### split mp3 start #####
 
+# the downloader of this process, the batch workers create their own one
+downloader, downloader_pid = None, None
+
+def get_downloader():
+    global downloader, downloader_pid
+    if downloader is None or downloader_pid != os.getpid():
+        from downloader import Downloader
+        downloader, downloader_pid = Downloader(mp3_folder, download_workers), os.getpid()
+    return downloader
+
+# {mp3 file name: path} of the mp3 files of sample_manifest
+manifest_mp3s = None
+
+# the mp3 file of a url listed in sample_manifest, None if it is not
+def manifest_mp3(url):
+    global manifest_mp3s
+    if sample_manifest is None:
+        return None
+    if manifest_mp3s is None:
+        manifest_mp3s = dict((os.path.basename(path), path) for path in manifest_files(sample_manifest, 'mp3'))
+    path = manifest_mp3s.get(url.split('/')[-1])
+    return path if path is not None and os.path.exists(path) else None
+
 # To download a mp3 file by given the URL of it (skip if already exists)
 # return the local file path.
 def download_mp3(url):
-    filename = url.split('/')[-1]
-    filepath = os.path.join(mp3_folder, str(filename))
-    if os.path.exists(filepath): # mp3 file already exists, skip download
-        print ('Skip to download mp3 from web, it already exists')
+    filepath = manifest_mp3(url)
+    if filepath is not None:
         return filepath
-    r = requests.get(url)
-    with open(filepath, 'wb') as fd:
-        fd.write(r.content)
+    with metrics.stage('download') as m:
+        filepath = get_downloader().get(url)
+        m['bytes'] = os.path.getsize(filepath)
     return filepath
 
+# the local file path of a mp3 url (the same as Downloader.local_path, or
+# the file of sample_manifest)
+def mp3_path(url):
+    return manifest_mp3(url) or os.path.join(mp3_folder, url.split('/')[-1])
+
+# the turn index of the corpus (see turn_index.py), None if it is not used
+turn_index = None
+
+def get_turn_index():
+    global turn_index
+    if turn_index is None and turn_index_dir is not None:
+        from turn_index import TurnIndex
+        turn_index = TurnIndex(turn_index_dir)
+    return turn_index
+
 # Parse the json file and analysis each speakers turns
+# {speaker identifier: [(start, stop, byte_start, byte_stop), ...]}
 def get_speakers_map(json_file):
-    speakerMap = {}
-    with open(json_file) as f:
-        meta = json.load(f)
-        sections = meta['transcript']['sections']
-        if sections is None:
-            return None
-        for section in sections:
-            for turn in section['turns']:
-                start = turn['start']
-                stop = turn['stop']
-                if turn['speaker'] is None:
-                    continue
-                id = turn['speaker']['identifier']
-                if not id in speakerMap:
-                    speakerMap[id] = []
-                speakerMap[id].append((start, stop))
-    return speakerMap
+    index = get_turn_index()
+    if index is not None and index.contains(json_file):
+        speakers = index.get_speakers_map(os.path.basename(json_file)[0:-9])
+    else:
+        with metrics.stage('parse'):
+            speakers = load_transcript(json_file).speakers
+    if speakers is None:
+        return None
+    from timeline import normalize_speakers
+    return normalize_speakers(speakers, turn_merge_gap, clip_overlapping_turns)
 
 # Parse the mp3 url from the json file
 def get_mp3_url(json_file):
-    with open(json_file) as f:
-        meta = json.load(f)
-        if meta['media_file'] is None:
-            return None
-        for media in meta['media_file']:
-            if media['mime'] == 'audio/mpeg':
-                return str(media['href'])
-    return None
+    index = get_turn_index()
+    if index is not None and index.contains(json_file):
+        return index.get_mp3_url(os.path.basename(json_file)[0:-9])
+    return load_transcript(json_file).media_url
 
 # Load the sound from mp3 file
 def load_sound_from_mp3(filepath):
-    return AudioSegment.from_mp3(filepath)
+    from pydub import AudioSegment
+    with metrics.stage('decode') as m:
+        sound = AudioSegment.from_mp3(filepath)
+        m['samples'] = int(sound.frame_count())
+    return sound
 
 # Save a sound to the mp3 file
 def save_to_mp3(filepath, sound):
-    sound.export(filepath, format="mp3")
+    with metrics.stage('encode', samples=int(sound.frame_count())):
+        sound.export(filepath, format="mp3")
 
 # split_mp3 for a single speaker's sound
 def process_speaker(speakerTurns, sound):
-    result = None
-    for turn in speakerTurns:
-        start, stop = turn[0] * 1000, turn[1] * 1000
-        if result is None:
-            result = sound[start:stop]
-        else:
-            result = result + sound[start:stop]
-    return result
+    from segments import gather_turns
+    return gather_turns(speakerTurns, sound)
 
 def process_speaker_1st_turn(speakerTurns, sound):
     turn = speakerTurns[0]
@@ -112,6 +193,18 @@ def create_dir(dir_path, force_empty=True):
 
 # split_mp3 for a single json file
 def split_mp3(json_file):
+    with metrics.case(os.path.basename(json_file)[0:-9]):
+        return split_mp3_case(json_file)
+
+def split_mp3_case(json_file):
+    job = fetch_case(json_file)
+    if job is None:
+        return None
+    return split_fetched(*job)
+
+# download the mp3 of a case, return (speakerMap, mp3 file, output folder) or
+# None if the case can not be split
+def fetch_case(json_file):
     print ('Processing json file:', json_file)
     mp3_url = get_mp3_url(json_file)
     if mp3_url is None:
@@ -130,76 +223,251 @@ def split_mp3(json_file):
     speakerMap = get_speakers_map(json_file)
     if speakerMap is None:
         return None
-    sound = load_sound_from_mp3(mp3_file)
-    top1, top2 = None, None
-    for key in speakerMap:
-        sub_sound = process_speaker(speakerMap[key], sound)
-        cur_output_path = os.path.join(cur_output_dir, key + '.mp3')
-        if top1 is None or len(top1[0]) < len(sub_sound):
-            top2 = top1
-            top1 = [sub_sound, key]
-        elif top2 is None or len(top2[0]) < len(sub_sound):
-            top2 = [sub_sound, key]
-        # save_to_mp3(cur_output_path, sub_sound)
-    # only store the first turn
-    top1[0] = process_speaker_1st_turn(speakerMap[top1[1]], sound)
-    top2[0] = process_speaker_1st_turn(speakerMap[top2[1]], sound)
-    save_to_mp3(os.path.join(cur_output_dir, top1[1] + '.mp3'), top1[0])
-    save_to_mp3(os.path.join(cur_output_dir, top2[1] + '.mp3'), top2[0])
-    return top1[1], top2[1]
-    
+    return speakerMap, mp3_file, cur_output_dir
 
-# split_mp3 for multiple json files by given the file pattens
-def split_in_batch(json_path_pat):
-    # step 1. split mp3 and obtain meta json
-    meta_jsons = []
-    jsons = glob.glob(json_path_pat)
-    count, total = 1, len(jsons)
-    failCount, failedJson = 0, []
-    for json_file in jsons:
-        print('\n{0}/{1} processing {2}'.format(count, total, json_file))
+# split the downloaded mp3 of a case into cur_output_dir
+def split_fetched(speakerMap, mp3_file, cur_output_dir):
+    if byte_range_mode:
         try:
-            filename = os.path.basename(json_file)
-            filename_without_ext = os.path.splitext(filename)[0]
-            cur_output_dir = os.path.join(output_dir, filename_without_ext)
-            if os.path.exists(cur_output_dir):
-                print("Already processed, skip...")
-                count += 1
-                continue
-
-            res = split_mp3(json_file)
-            if res is None:
-                failCount += 1
-                failedJson.append(json_file)
-                count += 1
-                continue
-            print(res)
-            meta_json = json_file[0:-9] + '.json'
-            print ('Construct meta:', meta_json)
-            meta_jsons.append(meta_json)
-        except:
-            print("failed for", json_file)
-            import traceback
-            traceback.print_exc()
-        count += 1
-    print('Over! processed:', total, 'json files', failCount, 'failed!')
-    if failCount > 0:
+            return split_mp3_by_bytes(speakerMap, mp3_file, cur_output_dir)
+        except ByteRangeError as e:
+            print('Byte range extraction failed, fall back to decoding:', e)
+    if streaming_decode:
+        return split_mp3_by_streaming(speakerMap, mp3_file, cur_output_dir)
+    return split_mp3_by_decoding(speakerMap, mp3_file, cur_output_dir)
+
+# the identifiers of the top speakers by talk time (turn metadata only)
+def select_top_speakers(speakerMap, k=2):
+    from speaker_view import CaseView
+    return CaseView(speakerMap).top(k)
+
+# cut the first turn of the two top speakers out of the mp3 by the byte
+# offsets of the json, without decoding the mp3
+def split_mp3_by_bytes(speakerMap, mp3_file, cur_output_dir):
+    top1, top2 = select_top_speakers(speakerMap)
+    info = probe_mp3(mp3_file)
+    for key in (top1, top2):
+        with metrics.stage('byte_range') as m:
+            m['bytes'] = extract_turns(mp3_file, speakerMap[key][:1], os.path.join(cur_output_dir, key + '.mp3'), info)
+    return top1, top2
+
+# decode the first turn of the two top speakers (in memory, nothing is
+# written), return {speaker identifier: AudioSegment}
+# only the frames of those turns are decoded if the byte offsets of the json
+# are usable, otherwise the whole mp3 is decoded once
+def load_top_turns(speakerMap, mp3_file):
+    keys = select_top_speakers(speakerMap)
+    cache = get_cache(cache_dir, cache_max_bytes)
+    if cache is None:
+        return decode_first_turns(speakerMap, keys, mp3_file)
+    # the decoded turns only depend on the mp3, the turn and the decoding mode
+    # (the streaming decoder and pydub do not cut the samples the same way)
+    mp3_hash = file_hash(mp3_file)
+    cacheKeys = dict((key, make_key('turn-pcm', mp3_hash, speakerMap[key][0], byte_range_mode, streaming_decode))
+                     for key in keys)
+    segments = dict((key, bytes_to_segment(cache.get(cacheKeys[key]))) for key in keys)
+    missing = [key for key in keys if segments[key] is None]
+    if missing:
+        for key, segment in decode_first_turns(speakerMap, missing, mp3_file).items():
+            cache.put(cacheKeys[key], segment_to_bytes(segment))
+            segments[key] = segment
+    return segments
+
+# decode the first turn of the speakers in keys
+def decode_first_turns(speakerMap, keys, mp3_file):
+    if byte_range_mode:
+        try:
+            info = probe_mp3(mp3_file)
+            turns = dict((key, read_turns(mp3_file, speakerMap[key][:1], info)) for key in keys)
+            from pydub import AudioSegment
+            return dict((key, AudioSegment.from_file(io.BytesIO(data), format='mp3')) for key, data in turns.items())
+        except ByteRangeError as e:
+            print('Byte range extraction failed, fall back to decoding:', e)
+    if streaming_decode:
+        firstTurns = dict((key, speakerMap[key][:1]) for key in keys)
+        return stream_to_segments(firstTurns, mp3_file)
+    sound = load_sound_from_mp3(mp3_file)
+    return dict((key, process_speaker_1st_turn(speakerMap[key], sound)) for key in keys)
+
+# an AudioSegment as a cache entry: a json header line and the raw data
+def segment_to_bytes(segment):
+    header = json.dumps([segment.frame_rate, segment.channels, segment.sample_width])
+    return header.encode('utf-8') + b'\n' + segment.raw_data
+
+def bytes_to_segment(data):
+    if data is None:
+        return None
+    header, raw = data.split(b'\n', 1)
+    frame_rate, channels, sample_width = json.loads(header.decode('utf-8'))
+    from pydub import AudioSegment
+    return AudioSegment(raw, sample_width=sample_width, frame_rate=frame_rate, channels=channels)
+
+# decode the turns of speakerMap as a stream, only the selected turns are
+# kept in memory, return {speaker identifier: AudioSegment}
+def stream_to_segments(speakerMap, mp3_file):
+    info = probe_mp3(mp3_file)
+    sinks = dict((key, BufferSink()) for key in speakerMap)
+    stream_turns(mp3_file, speakerMap, sinks, info['sample_rate'], info['channels'])
+    from pydub import AudioSegment
+    return dict((key, AudioSegment(bytes(sink.data), sample_width=SAMPLE_WIDTH,
+                                   frame_rate=info['sample_rate'], channels=info['channels']))
+                for key, sink in sinks.items())
+
+# decode the mp3 as a stream and encode the first turn of the two top
+# speakers on the fly, the decoding stops after the last of those turns
+def split_mp3_by_streaming(speakerMap, mp3_file, cur_output_dir):
+    top1, top2 = select_top_speakers(speakerMap)
+    info = probe_mp3(mp3_file)
+    sinks = {}
+    try:
+        for key in (top1, top2):
+            sinks[key] = EncoderSink(os.path.join(cur_output_dir, key + '.mp3'), info['sample_rate'], info['channels'])
+            if vad_trim:
+                from vad import VadSink
+                sinks[key] = VadSink(sinks[key], key, info['sample_rate'], info['channels'])
+        firstTurns = dict((key, speakerMap[key][:1]) for key in (top1, top2))
+        with metrics.stage('stream_decode') as m:
+            m['samples'] = sum(stream_turns(mp3_file, firstTurns, sinks, info['sample_rate'], info['channels']).values())
+    finally:
+        for sink in sinks.values():
+            sink.close()
+    return top1, top2
+
+# decode the whole mp3 and export the first turn of the two top speakers
+# (picked by the turn metadata, the other speakers are never gathered)
+def split_mp3_by_decoding(speakerMap, mp3_file, cur_output_dir):
+    top1, top2 = select_top_speakers(speakerMap)
+    sound = load_sound_from_mp3(mp3_file)
+    for key in (top1, top2):
+        # only store the first turn
+        segment = process_speaker_1st_turn(speakerMap[key], sound)
+        if vad_trim:
+            from vad import trim_track
+            segment = trim_track(key, segment)
+        save_to_mp3(os.path.join(cur_output_dir, key + '.mp3'), segment)
+    return top1, top2
+
+# the -t01.json files of the sample
+def list_jsons(json_path_pat):
+    if sample_manifest is not None:
+        return manifest_files(sample_manifest, 'transcript')
+    return glob.glob(json_path_pat)
+
+# the -t01.json files not split yet, and the number of -t01.json files
+def pending_jsons(json_path_pat, verbose=True):
+    jsons = list_jsons(json_path_pat)
+    total = len(jsons)
+    pending = []
+    for count, json_file in enumerate(jsons, 1):
+        filename = os.path.basename(json_file)
+        filename_without_ext = os.path.splitext(filename)[0]
+        cur_output_dir = os.path.join(output_dir, filename_without_ext)
+        if os.path.exists(cur_output_dir):
+            if verbose:
+                print('{0}/{1} already processed, skip {2}'.format(count, total, json_file))
+            continue
+        pending.append(json_file)
+    return pending, total
+
+# print the result of a case, return True if it succeeded
+def report_split(json_file, res, error, count, total):
+    print('\n{0}/{1} processed {2}'.format(count, total, json_file))
+    metrics.emit('progress', done=count, total=total, case=json_file)
+    if error is not None:
+        print("failed for", json_file)
+        print(error)
+        return False
+    if res is None:
+        return False
+    print(res)
+    meta_json = json_file[0:-9] + '.json'
+    print ('Construct meta:', meta_json)
+    return True
+
+def print_summary(total, failedJson):
+    print('Over! processed:', total, 'json files', len(failedJson), 'failed!')
+    if failedJson:
         print('\nFailed json file(s):')
         print('------')
         for json_file in failedJson:
             print(json_file)
 
+# split_mp3 for multiple json files by given the file pattens
+def split_in_batch(json_path_pat, workers=None):
+    if workers is None:
+        workers = num_workers
+    # step 1. split mp3 and obtain meta json
+    pending, total = pending_jsons(json_path_pat)
+    failedJson = []
+
+    # download the mp3 of the next cases while the current ones are processed
+    positions = dict((json_file, i) for i, json_file in enumerate(pending))
+    def prefetch_next(json_file):
+        i = positions[json_file]
+        for next_json in pending[i + 1:i + 1 + prefetch_count]:
+            try:
+                url = get_mp3_url(next_json)
+                if url is not None and manifest_mp3(url) is None:
+                    get_downloader().prefetch([url])
+            except Exception as e:
+                print('Failed to prefetch mp3 for', next_json, e)
+
+    count = total - len(pending) + 1
+    for json_file, res, error in run_in_pool(split_mp3, pending, workers, prefetch_next, metrics.serve):
+        if not report_split(json_file, res, error, count, total):
+            failedJson.append(json_file)
+        count += 1
+    print_summary(total, failedJson)
+
+# the same as split_in_batch with the downloads (pipeline_io_workers
+# threads) overlapped with the splitting (pipeline_split_workers processes),
+# see pipeline.py
+def split_in_pipeline(json_path_pat):
+    from pipeline import Stage, run_pipeline
+    pending, total = pending_jsons(json_path_pat)
+    failedJson = []
+    # created once here, not by several threads of the fetch stage
+    get_downloader()
+    counter = [total - len(pending)]
+
+    def on_result(json_file, res, error):
+        counter[0] += 1
+        if not report_split(json_file, res, error, counter[0], total):
+            failedJson.append(json_file)
+
+    stages = [Stage('fetch', pipeline_fetch, pipeline_io_workers, 'thread'),
+              Stage('split', pipeline_split, pipeline_split_workers, 'process')]
+    run_pipeline(pending, stages, on_result, pipeline_queue_size, on_start=metrics.serve)
+    print_summary(total, failedJson)
+
+# the stages of split_in_pipeline, a case that can not be split goes
+# through the split stage as None
+def pipeline_fetch(json_file):
+    with metrics.case(os.path.basename(json_file)[0:-9], 'fetch'):
+        return fetch_case(json_file)
+
+def pipeline_split(job):
+    if job is None:
+        return None
+    with metrics.case(os.path.basename(job[2]), 'split'):
+        return split_fetched(*job)
+
 
 ##### split mp3 end #####
 
 def main():
+    metrics.configure(metrics_path, metrics_port, profile_slowest, profile_dir)
     create_dir(output_dir, False)
     create_dir(mp3_folder, False)
 
     if len(os.sys.argv) > 1: # split_mp3 single file
+        metrics.serve()
         split_mp3(os.sys.argv[1])
     else: # batch mode
-        split_in_batch(json_patten_in_batch)
+        if batch_engine == 'pipeline':
+            split_in_pipeline(json_patten_in_batch)
+        else:
+            split_in_batch(json_patten_in_batch)
     print('Done')
 
 if __name__ == '__main__':
@@ -1,13 +1,26 @@
 #!/usr/bin/env python
 # -*- encoding:utf-8 -*-
 
-from parselmouth.praat import run_file
-import os, os.path, operator
+import os, os.path
 import glob                     # glob.glob
-import json                     # json.load
-import csv                      # csv.writer
 import time
-import re
+import sys
+import shutil                   # shutil.rmtree
+import hashlib
+import json                     # json.dump
+import traceback
+from batchpool import run_in_pool, default_workers
+from cache import get_cache, file_hash, make_key
+from gender import NameMatcher
+from results_store import ResultStore, STATUS_DONE
+import metrics
+from select_sample import manifest_files
+from transcript import load_transcript, load_case_meta, STR_APPELLANT, STR_APPELLEE, STR_UNKNOWN
+# parselmouth and numpy (pitch.py, f0_stream.py, speaker_view.py) are
+# imported by the functions using them, so the single file mode, the dry
+# runs and the status of cli.py start fast. The batch modes and
+# supervisor.py import them with import_dependencies() before they fork
+# their workers
 
 cur_dir_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -17,6 +30,9 @@ textgrid_out_dir = os.path.join(cur_dir_path, "tmp/")
 sample_dir = os.path.join(cur_dir_path, "1994_2019/sample-936")
 splitted_mp3_dir = sample_dir + "/splitted_mp3/"
 meta_json_dir = sample_dir + "/json"
+# the manifest written by select_sample.py, if set its meta json files are
+# processed instead of the ones in meta_json_dir
+sample_manifest = None
 
 # This stores the target csv file
 csv_out_path = sample_dir + "/result.csv"
@@ -24,22 +40,106 @@ csv_out_path = sample_dir + "/result.csv"
 # This file records the process status and failure reason
 csv_fail_out_path = sample_dir + "/fail.csv"
 
+# This database stores the status and result of every case, the csv files
+# above are exported from it
+db_path = sample_dir + "/results.sqlite"
+
+# cache of the F0 statistics (see cache.py), None to disable it
+cache_dir = sample_dir + "/cache"
+cache_max_bytes = 20 * 1024 ** 3
+
+# json lines file of the per-stage metrics (see metrics.py), None to disable
+metrics_path = sample_dir + "/metrics.jsonl"
+# serve the Prometheus text endpoint on this port (None: no endpoint)
+metrics_port = None
+# keep the sampling profiles of the N slowest cases in profile_dir (0: off)
+profile_slowest = 0
+profile_dir = sample_dir + "/profiles"
+
 # This file is used to indicate whether all the jsons have been processed
 status_path = os.path.join(cur_dir_path, "status.txt")
 
+# number of worker processes for the batch mode
+num_workers = default_workers
+
+# 'native': compute the F0 statistics in process with parselmouth (pitch.py)
+# 'praat': run myspsolution.praat and parse its output
+pitch_engine = 'native'
+
+# 'files': analyse the mp3 files split by step1.py
+# 'fused': download and decode the argument here and analyse the turns in
+#   memory, without the mp3 encode/decode round trip (step1.py is not needed)
+process_mode = 'files'
+# 'all_turns': download and stream the argument here, the F0 statistics
+#   cover every turn of the advocates (f0_stream.py, bounded memory), the
+#   advocate with the most talk time is reported for each side
+# drop the silences and the noises of the turns (vad.py) before the pitch is
+# computed, the speech ratio of every speaker goes to the metrics (the
+# 'native' pitch engine only, praat reads the whole file)
+vad_trim = False
+# in the fused mode, also write the analysed turns to splitted_mp3_dir
+fused_write_mp3 = False
+# in the all_turns mode, write the per-turn and per-window F0 series of
+# every advocate to <f0_series_dir>/<case>.json (None: no series)
+f0_series_dir = sample_dir + "/f0_series"
+f0_window_seconds = 60
+# in the all_turns mode, append one row per turn (role, gender, timings, F0)
+# to the Parquet dataset in features_dir (see features.py, None: no export)
+features_dir = sample_dir + "/features"
+
+# 'pool': every case runs all of its steps in a row on one of num_workers
+#   processes (batchpool.py)
+# 'pipeline': the steps of the cases overlap (pipeline.py), each stage with
+#   its own workers: prepare (parse, download) on threads, decode and
+#   analyze (F0) on processes
+batch_engine = 'pool'
+pipeline_io_workers = 8
+pipeline_decode_workers = max(1, default_workers // 2)
+pipeline_f0_workers = default_workers
+# cases waiting in front of each stage (None: the number of its workers)
+pipeline_queue_size = None
+
 # const values
-STR_APPELLANT = "appellant"
-STR_APPELLEE = "appellee"
-STR_UNKNOWN = "unknown"
 CSV_HEADERS = ['SeqNo', 'ID', 'Appellant', 'Petitioner Gender', 'Appellee', 'Respondent Gender', 'Petitioner f0_std', 'Respondent f0_std', 'Petitioner f0_mean', 'Respondent f0_mean']
 
 
 # Obtain the std and mean of a sound (myspf0sd, myspf0mean)
 # refs: https://github.com/Shahabks/my-voice-analysis
+# the result is cached by the content of the file and the parameters
 def myspf0sd(sound_path):
+    from pitch import PITCH_FLOOR, PITCH_CEILING, TIME_STEP
+    cache = get_cache(cache_dir, cache_max_bytes)
+    if cache is None:
+        return myspf0sd_nocache(sound_path)
+    key = make_key('f0-file', file_hash(sound_path), pitch_engine, PITCH_FLOOR, PITCH_CEILING, TIME_STEP,
+                   vad_params() if pitch_engine == 'native' else None)
+    res = cache.get_json(key)
+    if res is None:
+        res = myspf0sd_nocache(sound_path)
+        cache.put_json(key, res)
+    else:
+        print('myspf0sd is cached for file:', sound_path)
+    return tuple(res)
+
+def myspf0sd_nocache(sound_path):
+    with metrics.stage('pitch', engine=pitch_engine):
+        return myspf0sd_run(sound_path)
+
+def myspf0sd_run(sound_path):
     print('processing myspf0sd for file:', sound_path)
+    from pitch import f0_stats_from_file, f0_stats, read_sound, PITCH_FLOOR, PITCH_CEILING, TIME_STEP
+    if pitch_engine == 'native' and vad_trim:
+        from vad import trim_speech
+        sound = read_sound(sound_path)
+        speech = trim_speech(get_filename_without_ext(sound_path), sound.values[0], sound.sampling_frequency)
+        stats = f0_stats(speech, sound.sampling_frequency, PITCH_FLOOR, PITCH_CEILING, TIME_STEP)
+        return stats.std, stats.mean
+    if pitch_engine == 'native':
+        stats = f0_stats_from_file(sound_path, PITCH_FLOOR, PITCH_CEILING, TIME_STEP)
+        return stats.std, stats.mean
     try:
-        objects = run_file(praat_path, -20, 2, 0.3, "yes",sound_path, textgrid_out_dir, 80, 400, 0.01, capture_output=True)
+        from parselmouth.praat import run_file
+        objects = run_file(praat_path, -20, 2, 0.3, "yes",sound_path, textgrid_out_dir, PITCH_FLOOR, PITCH_CEILING, TIME_STEP, capture_output=True)
         z1 = str(objects[1]) 
         z2 = z1.strip().split()
         std = float(z2[8])
@@ -55,6 +155,8 @@ def myspf0sd(sound_path):
 
 # Obtain all the json files whose file name doesn't contain "-t01" string
 def obtain_meta_jsons(json_dir):
+    if sample_manifest is not None:
+        return sorted(manifest_files(sample_manifest, 'meta'))
     meta_jsons = set(glob.glob(os.path.join(json_dir, '*.json'))) - set(glob.glob(os.path.join(json_dir, '*-t01.json')))
     res_jsons = list(meta_jsons)
     res_jsons.sort()
@@ -64,55 +166,17 @@ def obtain_meta_jsons(json_dir):
 # json file ends with -t01.json
 def get_advocate_map(json_file):
     # {identifier: petitioner/ petitionee / unkown}
-    advocateMap = {}
-    lastNameMap = {}
-    with open(json_file) as f:
-        meta = json.load(f)
-
-        if 'advocates' not in meta:
-            print('No advocates info in json file:', json_file)
-            raise
-        for adv in meta['advocates']:
-            id = adv['advocate']['identifier']
-            lastName = adv['advocate']['last_name']
-            lastNameMap[id] = re.sub(r'\W+', '', lastName)
-            # advocate description is missing
-            if 'advocate_description' not in adv:
-                advocateMap[id] = STR_UNKNOWN
-            else:
-                desciption = adv['advocate_description'].lower()
-                if desciption.find('appellant') > -1 or desciption.find('petitioner') > -1:
-                    advocateMap[id] = STR_APPELLANT
-                elif desciption.find('appellee') > -1 or desciption.find('respondent') > -1:
-                    advocateMap[id] = STR_APPELLEE
-                else:
-                    advocateMap[id] = STR_UNKNOWN
-    return advocateMap, lastNameMap
+    meta = load_case_meta(json_file)
+    if meta.advocates is None:
+        print('No advocates info in json file:', json_file)
+        raise ValueError('No advocates info in json file: ' + json_file)
+    return dict(meta.advocates), dict(meta.last_names)
 
 # json_file not ends with -t01.json
 def get_speaker_gender_map(json_file, names):
     print('get gender map for file:', json_file)
     print('names:', names)
-    genderMap = {}
-    with open(json_file) as f:
-        meta = json.load(f)
-        sections = meta['transcript']['sections']
-        for section in sections:
-            for turn in section['turns']:
-                if turn['text_blocks'] is None:
-                    continue
-                for txtBlock in turn['text_blocks']:
-                    for name in names:
-                        if name not in genderMap:
-                            txt = txtBlock['text']
-                            if re.search('Mr\. [\w ]*?' + name, txt): # male
-                                genderMap[name] = 'M'
-                            elif re.search('Ms\. [\w ]*?' + name, txt) or \
-                                 re.search('Mrs\. [\w ]*?' + name, txt): # female
-                                genderMap[name] = 'F'
-                    if len(genderMap) == len(names):
-                        return genderMap
-    return genderMap
+    return NameMatcher(names).gender_map(load_transcript(json_file).texts)
 
 # get the filename without extension
 def get_filename_without_ext(fullpath):
@@ -120,34 +184,6 @@ def get_filename_without_ext(fullpath):
     filename_without_ext = os.path.splitext(filename)[0]
     return filename_without_ext
 
-def load_from_csv(filename):
-    res = {}
-    if not os.path.exists(filename):
-        return res
-    with open(filename, 'r') as f:
-        # creating a csv writer object
-        lines = f.readlines()
-        lines = lines[1:]  # remove header
-        for line in lines:
-            id = line.split(',')[1]
-            res[id] = True
-            
-    return res
-
-# writing to csv file
-def save_to_csv(filename, fields, rows):
-    head = True
-    if os.path.exists(filename):
-        head = False
-    with open(filename, 'a') as csvfile:
-        # creating a csv writer object
-        csvwriter = csv.writer(csvfile)
-        # writing the fields
-        if head:
-            csvwriter.writerow(fields)
-        # writing the data rows
-        csvwriter.writerows(rows)
-
 # create the directory, if force_empty is true, it will
 # delete the existing directory
 def create_dir(dir_path, force_empty=True):
@@ -162,32 +198,177 @@ def create_dir(dir_path, force_empty=True):
         print('Failed to create directory: ', dir_path)
         sys.exit(-1)
 
+# Obtain {speaker identifier: (std, mean)} of the mp3 files split by step1.py
+def analyze_files(mp3_out_dir):
+    # list the files and get the largest two files
+    all_files = (os.path.join(basedir, filename) for basedir, dirs, files in os.walk(mp3_out_dir) for filename in files)
+    f0Map = {}
+    for mp3_file in all_files:
+        f0Map[get_filename_without_ext(mp3_file)] = myspf0sd(mp3_file)
+    return f0Map
+
+# download the argument of a case for the fused and all_turns modes (step1.py
+# does not need to run first), return (mp3 file, speakerMap)
+def load_argument(sound_json):
+    import step1
+    mp3_url = step1.get_mp3_url(sound_json)
+    if mp3_url is None:
+        raise ValueError('No mp3 url found in ' + sound_json)
+    mp3_file = step1.download_mp3(mp3_url)
+    speakerMap = step1.get_speakers_map(sound_json)
+    if speakerMap is None:
+        raise ValueError('No transcript sections in ' + sound_json)
+    return mp3_file, speakerMap
+
+# Obtain {speaker identifier: (std, mean)} of the first turn of the two top
+# speakers {speaker identifier: AudioSegment}, decoded by step1.load_top_turns
+# and analysed in memory (no intermediate mp3 is written)
+def analyze_fused(sound_json, segments):
+    import step1
+    f0Map = {}
+    for id, segment in segments.items():
+        if fused_write_mp3:
+            cur_output_dir = os.path.join(splitted_mp3_dir, get_filename_without_ext(sound_json))
+            create_dir(cur_output_dir, False)
+            step1.save_to_mp3(os.path.join(cur_output_dir, id + '.mp3'), segment)
+        print('processing F0 of', id, 'in', sound_json)
+        f0Map[id] = segment_f0(segment, id)
+    return f0Map
+
+# Obtain {speaker identifier: (std, mean)} over every turn of the advocates,
+# the top advocate (by talk time) of each side is kept, and the per-turn F0
+# series {speaker identifier: [turn, ...]} of every advocate
+def analyze_all_turns(sound_json, advocateMap, mp3_file, speakerMap):
+    from pitch import PITCH_FLOOR, PITCH_CEILING, TIME_STEP
+    from f0_stream import stream_f0
+    from speaker_view import talk_time
+    advocateTurns = dict((id, turns) for id, turns in speakerMap.items() if id in advocateMap)
+    print('processing F0 of every turn of', ', '.join(sorted(advocateTurns)), 'in', sound_json)
+    with metrics.stage('pitch_stream', speakers=len(advocateTurns)):
+        accs = stream_f0(mp3_file, advocateTurns, PITCH_FLOOR, PITCH_CEILING, TIME_STEP, f0_window_seconds,
+                         vad=vad_trim)
+    if vad_trim:
+        from vad import report
+        for id, acc in sorted(accs.items()):
+            report(id, acc.speech_seconds, acc.seconds)
+    if f0_series_dir is not None:
+        create_dir(f0_series_dir, False)
+        series = dict((id, acc.to_json()) for id, acc in accs.items())
+        with open(os.path.join(f0_series_dir, get_filename_without_ext(sound_json)[0:-4] + '.json'), 'w') as f:
+            json.dump(series, f)
+    f0Map = {}
+    for side in (STR_APPELLANT, STR_APPELLEE):
+        ids = [id for id in accs if advocateMap[id] == side]
+        if not ids:
+            continue
+        top = max(ids, key=lambda id: talk_time(advocateTurns[id]))
+        stats = accs[top].stats()
+        f0Map[top] = (stats.std, stats.mean)
+    return f0Map, dict((id, acc.turn_series()) for id, acc in accs.items())
+
+# the settings of vad.py for the cache keys, None without vad_trim
+def vad_params():
+    if not vad_trim:
+        return None
+    from vad import params
+    return params()
+
+# (std, mean) of an AudioSegment, cached by the content of its samples
+# (after the silences are dropped with vad_trim)
+def segment_f0(segment, speaker=None):
+    from pitch import segment_f0_stats, PITCH_FLOOR, PITCH_CEILING, TIME_STEP
+    if vad_trim:
+        from vad import trim_track
+        segment = trim_track(speaker, segment)
+    cache = get_cache(cache_dir, cache_max_bytes)
+    key = None
+    if cache is not None:
+        key = make_key('f0-pcm', hashlib.sha256(segment.raw_data).hexdigest(), segment.frame_rate,
+                       segment.channels, segment.sample_width, PITCH_FLOOR, PITCH_CEILING, TIME_STEP, vad_params())
+        res = cache.get_json(key)
+        if res is not None:
+            return tuple(res)
+    with metrics.stage('pitch', samples=int(segment.frame_count())):
+        stats = segment_f0_stats(segment, PITCH_FLOOR, PITCH_CEILING, TIME_STEP)
+    if cache is not None:
+        cache.put_json(key, [stats.std, stats.mean])
+    return stats.std, stats.mean
+
+# import the modules of process() now, the worker processes forked afterwards
+# start warm instead of importing them on their first case
+def import_dependencies():
+    import numpy, pydub, parselmouth, parselmouth.praat
+    import pitch, vad, f0_stream, speaker_view, segments, timeline, step1
+
 # process for a single json file
 # the json file must be without "-t01.json" suffix
+# return (csv row or None, fail reason, per-turn feature rows)
 def process(json_file):
+    with metrics.case(get_filename_without_ext(json_file)):
+        return process_case(json_file)
+
+def process_case(json_file):
+    return finish_case(analyze_case(decode_case(prepare_case(json_file))))
+
+# The stages of a case (run in a row by process_case, or overlapped across
+# the cases by process_in_pipeline), a job dict is passed from one to the
+# next, a job with a fail_reason goes through the next stages untouched.
+# prepare (I/O): parse the json files, detect the genders, download the mp3
+def prepare_case(json_file):
     print ('Processing file: ', json_file)
-    advocateMap, lastNameMap = get_advocate_map(json_file)
+    job = {'json_file': json_file, 'case_id': get_filename_without_ext(json_file), 'fail_reason': None}
+    with metrics.stage('parse'):
+        advocateMap, lastNameMap = get_advocate_map(json_file)
 
     if len(set(advocateMap.values())) == 1:
-        return None, 'Can not detect appellant or appellee correctly.' 
+        job['fail_reason'] = 'Can not detect appellant or appellee correctly.'
+        return job
     # print('Obtain advocate map: ', advocateMap)
     sound_json = json_file[0:-5] + '-t01.json'
-    genderMap = get_speaker_gender_map(sound_json, set(lastNameMap.values()))
+    with metrics.stage('gender'):
+        genderMap = get_speaker_gender_map(sound_json, set(lastNameMap.values()))
     # if len(genderMap) < len(advocateMap):
     #     return None, 'Can not detect the gender correctly.'
+    job.update(advocateMap=advocateMap, lastNameMap=lastNameMap, genderMap=genderMap, sound_json=sound_json)
+    if process_mode in ('fused', 'all_turns'):
+        job['mp3_file'], job['speakerMap'] = load_argument(sound_json)
+    return job
 
-    filename_without_ext = get_filename_without_ext(json_file)
-    mp3_out_dir = os.path.join(splitted_mp3_dir, filename_without_ext + "-t01")
+# decode (CPU): the first turns of the top speakers in the fused mode
+def decode_case(job):
+    if job['fail_reason'] is None and process_mode == 'fused':
+        import step1
+        job['segments'] = step1.load_top_turns(job['speakerMap'], job['mp3_file'])
+    return job
 
-    # list the files and get the largest two files
-    all_files = (os.path.join(basedir, filename) for basedir, dirs, files in os.walk(mp3_out_dir) for filename in files)
-    if all_files is None:
-        return None, 'mp3 file has error'
-    csv_out = [filename_without_ext, '', '', '', '', -1, -1, -1, -1]
+# analyze (CPU): {speaker identifier: (std, mean)} and the feature rows
+def analyze_case(job):
+    if job['fail_reason'] is not None:
+        return job
+    featureRows = []
+    if process_mode == 'fused':
+        f0Map = analyze_fused(job['sound_json'], job.pop('segments'))
+    elif process_mode == 'all_turns':
+        f0Map, seriesMap = analyze_all_turns(job['sound_json'], job['advocateMap'], job['mp3_file'], job['speakerMap'])
+        if features_dir is not None:
+            from features import turn_rows
+            genders = dict((id, job['genderMap'].get(job['lastNameMap'][id], 'X')) for id in seriesMap)
+            featureRows = turn_rows(job['case_id'], seriesMap, job['advocateMap'], genders)
+    else:
+        mp3_out_dir = os.path.join(splitted_mp3_dir, job['case_id'] + "-t01")
+        f0Map = analyze_files(mp3_out_dir)
+    job.update(f0Map=f0Map, featureRows=featureRows)
+    return job
+
+# finish: the csv row of the case, return (csv row or None, fail reason,
+# per-turn feature rows)
+def finish_case(job):
+    if job['fail_reason'] is not None:
+        return None, job['fail_reason'], []
+    json_file, advocateMap, lastNameMap, genderMap = job['json_file'], job['advocateMap'], job['lastNameMap'], job['genderMap']
+    csv_out = [job['case_id'], '', '', '', '', -1, -1, -1, -1]
     fail_reason = 'Unkown reason'
-    for mp3_file in all_files:
-        std, mean = myspf0sd(mp3_file)
-        id = get_filename_without_ext(mp3_file)
+    for id, (std, mean) in job['f0Map'].items():
         print ('{0:24s} : {1:9s} : std = {2}, mean = {3}'.format(id, advocateMap[id], std, mean))
         if lastNameMap[id] in genderMap:
             gender = genderMap[lastNameMap[id]]
@@ -206,58 +387,176 @@ def process(json_file):
         else:
             print ('[Error] Advocate ', id, 'not exist in json file:', json_file)
             fail_reason = '[Error] Advocate ' + id + ' not exist in json file:' + json_file
-            return None, fail_reason
+            return None, fail_reason, []
 
-    return csv_out, fail_reason
+    return csv_out, fail_reason, job['featureRows']
 
-# process for multiple json files by given the json dir
-def process_in_batch(json_dir):
-    json_files = obtain_meta_jsons(json_dir)
+# open the results database, the csv files of an older run are imported
+# into a new database
+def open_result_store():
+    is_new = not os.path.exists(db_path)
+    store = ResultStore(db_path)
+    if is_new:
+        store.import_csv(csv_out_path, csv_fail_out_path)
+    return store
 
-    failCount = 0
-    failedJson = []
-    csv_rows = []
-    csv_done = load_from_csv(csv_out_path)
-    csv_fail = load_from_csv(csv_fail_out_path)
-    count, total = 1, len(json_files)
-    for json_file in json_files:
-        print('\n{0}/{1} processing {2}'.format(count, total, json_file))
+# the writer of the per-turn features, None if they are not exported. Its
+# rows are written before every commit of store, a case is never committed
+# as done with its features still in memory
+def open_feature_writer(store):
+    if process_mode != 'all_turns' or features_dir is None:
+        return None
+    from features import FeatureWriter
+    writer = FeatureWriter(features_dir)
+    store.before_commit = writer.flush
+    return writer
+
+# {json file: 'count/total'} of the cases of json_files not processed yet
+def pending_cases(store, json_files, verbose=True):
+    total = len(json_files)
+    seqMap = {}
+    for count, json_file in enumerate(json_files, 1):
         filename_without_ext = get_filename_without_ext(json_file)
-        if filename_without_ext in csv_done:
-            print('skip! already processed!')
-            count += 1
+        status = store.status(filename_without_ext)
+        if status == STATUS_DONE:
+            if verbose:
+                print('{0}/{1} skip! already processed! {2}'.format(count, total, json_file))
             continue
-        if filename_without_ext in csv_fail:
-            print('skip! already processed failed!')
-            count += 1
+        if status is not None:
+            if verbose:
+                print('{0}/{1} skip! already processed failed! {2}'.format(count, total, json_file))
             continue
-        fail_reason = 'Unknown reason'
-        success = True
-        seq_str = '{}/{}'.format(count, total)
-        try:
-            save_to_csv(csv_fail_out_path, CSV_HEADERS, [(seq_str, filename_without_ext, 'processing...')])
-            csv_row, fail_reason = process(json_file)
-            if csv_row is not None:
-                csv_rows.append(csv_row)
-                csv_row.insert(0, seq_str)
-                save_to_csv(csv_out_path, CSV_HEADERS, [csv_row])
-            else:
-                success = False
-        except:
+        seqMap[json_file] = '{}/{}'.format(count, total)
+    return seqMap
+
+# save the result (csv_row, fail_reason, featureRows) or the error of a case,
+# return True if it succeeded
+def save_case_result(store, featureWriter, json_file, seq_str, res, error):
+    filename_without_ext = get_filename_without_ext(json_file)
+    print('\n{0} processed {1}'.format(seq_str, json_file))
+    metrics.emit('progress', seq=seq_str, case=filename_without_ext)
+    fail_reason = 'Unknown reason'
+    success = True
+    if error is not None:
+        success = False
+        print(error)
+        fail_reason = error.strip().split('\n')[-1]
+    else:
+        csv_row, fail_reason, featureRows = res
+        if csv_row is not None:
+            # added first, save_result may commit
+            if featureWriter is not None:
+                featureWriter.add(featureRows)
+            store.save_result(filename_without_ext, seq_str, csv_row)
+        else:
             success = False
-            import traceback
-            traceback.print_exc()
 
-        if not success:
-            failCount += 1
+    if not success:
+        store.save_failure(filename_without_ext, seq_str, fail_reason)
+    print('Success\n' if success else 'Failed\n')
+    return success
+
+# process for multiple json files by given the json dir
+# the cases run on `workers` processes, the results are only written here
+def process_in_batch(json_dir, workers=None):
+    if workers is None:
+        workers = num_workers
+    json_files = obtain_meta_jsons(json_dir)
+
+    failedJson = []
+    store = open_result_store()
+    featureWriter = open_feature_writer(store)
+    seqMap = pending_cases(store, json_files)
+    import_dependencies()
+
+    # mark the case before it is handed to a worker, if the worker crashes
+    # (eg. praat core dump) the case is skipped by the next run
+    def mark_processing(json_file):
+        store.mark_processing(get_filename_without_ext(json_file), seqMap[json_file])
+
+    try:
+        for json_file, res, error in run_in_pool(process, list(seqMap), workers, mark_processing, metrics.serve):
+            if not save_case_result(store, featureWriter, json_file, seqMap[json_file], res, error):
+                failedJson.append(json_file)
+    finally:
+        store.export_csv(csv_out_path, csv_fail_out_path, CSV_HEADERS)
+        # also writes the buffered features (before_commit)
+        store.close()
+
+    print_summary(json_files, failedJson)
+
+# the same as process_in_batch, with the stages of the cases overlapped
+# (pipeline.py): the parsing and downloads of the next cases run on
+# pipeline_io_workers threads while the decoding and the F0 analysis of
+# the previous ones run on their own processes
+def process_in_pipeline(json_dir):
+    from pipeline import Stage, run_pipeline
+    json_files = obtain_meta_jsons(json_dir)
+
+    failedJson = []
+    store = open_result_store()
+    featureWriter = open_feature_writer(store)
+    seqMap = pending_cases(store, json_files)
+    import_dependencies()
+    if process_mode in ('fused', 'all_turns'):
+        # created once here, not by several threads of the prepare stage
+        import step1
+        step1.get_downloader()
+
+    def mark_processing(json_file):
+        store.mark_processing(get_filename_without_ext(json_file), seqMap[json_file])
+
+    def on_result(json_file, job, error):
+        res = None
+        if error is None:
+            try:
+                res = finish_case(job)
+            except Exception:
+                error = traceback.format_exc()
+        if not save_case_result(store, featureWriter, json_file, seqMap[json_file], res, error):
             failedJson.append(json_file)
-            save_to_csv(csv_fail_out_path, CSV_HEADERS, [(seq_str, filename_without_ext, fail_reason)])
-        print('Success\n' if success else 'Failed\n')
-        count += 1
 
+    stages = [Stage('prepare', pipeline_prepare, pipeline_io_workers, 'thread'),
+              Stage('decode', pipeline_decode, pipeline_decode_workers, 'process'),
+              Stage('analyze', pipeline_analyze, pipeline_f0_workers, 'process')]
+    try:
+        run_pipeline(list(seqMap), stages, on_result, pipeline_queue_size, mark_processing, metrics.serve)
+    finally:
+        store.export_csv(csv_out_path, csv_fail_out_path, CSV_HEADERS)
+        # also writes the buffered features (before_commit)
+        store.close()
+
+    print_summary(json_files, failedJson)
+
+# the stages of process_in_pipeline, timed per case (module functions, the
+# process stages pickle them)
+def pipeline_prepare(json_file):
+    with metrics.case(get_filename_without_ext(json_file), 'prepare'):
+        return prepare_case(json_file)
+
+def pipeline_decode(job):
+    with metrics.case(job['case_id'], 'decode'):
+        return decode_case(job)
+
+def pipeline_analyze(job):
+    with metrics.case(job['case_id'], 'analyze'):
+        return analyze_case(job)
+
+# print the csv row of a case (without SeqNo, the single file modes do not
+# save it), or its failure reason
+def print_case_result(res, header=False):
+    csv_row, fail_reason, featureRows = res
+    if header:
+        print(','.join(CSV_HEADERS[1:]))
+    if csv_row is not None:
+        print(','.join([str(e) for e in csv_row]))
+    else:
+        print('Failed:', fail_reason)
+
+def print_summary(json_files, failedJson):
     print ('CSV file is saved to:', csv_out_path)
-    print ('Total {0} json files processed, {1} json file(s) failed.'.format(len(json_files), failCount))
-    if failCount > 0:
+    print ('Total {0} json files processed, {1} json file(s) failed.'.format(len(json_files), len(failedJson)))
+    if failedJson:
         print('\nFailed json file(s):')
         print('------')
         for json_file in failedJson:
@@ -271,15 +570,18 @@ def reset_status():
         os.remove(status_path)
 
 def main():
+    metrics.configure(metrics_path, metrics_port, profile_slowest, profile_dir)
     create_dir(textgrid_out_dir, False)
 
     if len(os.sys.argv) > 1: # process single file
-        res = process(os.sys.argv[1])
-        print(','.join(CSV_HEADERS))
-        print(','.join([str(e) for e in res]))
+        metrics.serve()
+        print_case_result(process(os.sys.argv[1]), True)
     else: # batch mode
         # eg. put all your json files under dir json/
-        process_in_batch(meta_json_dir)
+        if batch_engine == 'pipeline':
+            process_in_pipeline(meta_json_dir)
+        else:
+            process_in_batch(meta_json_dir)
     print('\nDone')
 
 if __name__ == '__main__':
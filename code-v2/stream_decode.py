@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Decode an mp3 as a stream and route the samples to per-speaker sinks.
+#
+# AudioSegment.from_mp3 keeps the PCM of the whole argument in memory (over
+# 1 GB for a multi-hour consolidated argument). Here ffmpeg decodes into a
+# pipe which is read in fixed size chunks, each chunk is cut by the sorted
+# turn timeline and written to the sink of its speaker, so the peak memory
+# is one chunk whatever the length of the argument.
+
+import subprocess
+import wave
+
+FFMPEG = 'ffmpeg'
+SAMPLE_WIDTH = 2                # s16le
+CHUNK_FRAMES = 64 * 1024
+
+
+# keep the samples of a speaker in memory (for short selections, eg. the
+# first turn only)
+class BufferSink(object):
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        pass
+
+
+# write the samples of a speaker to a wav file
+class WavSink(object):
+
+    def __init__(self, path, sample_rate, channels):
+        self.wav = wave.open(path, 'wb')
+        self.wav.setnchannels(channels)
+        self.wav.setsampwidth(SAMPLE_WIDTH)
+        self.wav.setframerate(sample_rate)
+
+    def write(self, data):
+        self.wav.writeframesraw(data)
+
+    def close(self):
+        self.wav.close()
+
+
+# encode the samples of a speaker with ffmpeg (the format is taken from the
+# file extension of path, eg. .mp3)
+class EncoderSink(object):
+
+    def __init__(self, path, sample_rate, channels, options=()):
+        cmd = [FFMPEG, '-loglevel', 'error', '-y', '-f', 's16le', '-ar', str(sample_rate),
+               '-ac', str(channels), '-i', 'pipe:0'] + list(options) + [path]
+        self.path = path
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise IOError('Failed to encode ' + self.path)
+
+
+# the sorted timeline [(start_frame, stop_frame, speaker identifier), ...]
+# of the turns in speakerMap, frames are picked like pydub's ms slicing
+def build_timeline(speakerMap, sample_rate):
+    timeline = []
+    for key, turns in speakerMap.items():
+        for turn in turns:
+            start, stop = int(turn[0] * sample_rate), int(turn[1] * sample_rate)
+            if stop > start:
+                timeline.append((start, stop, key))
+    timeline.sort()
+    return timeline
+
+
+# Decode mp3_file and write the samples of each turn to sinks[speaker]
+# (sinks only needs an entry for the speakers of speakerMap)
+# ffmpeg is stopped as soon as the last turn is routed
+# return the number of frames written per speaker
+def stream_turns(mp3_file, speakerMap, sinks, sample_rate, channels, chunk_frames=CHUNK_FRAMES):
+    timeline = build_timeline(speakerMap, sample_rate)
+    frame_width = SAMPLE_WIDTH * channels
+    written = dict((key, 0) for key in speakerMap)
+    if not timeline:
+        return written
+    end_frame = max(turn[1] for turn in timeline)
+    cmd = [FFMPEG, '-loglevel', 'error', '-i', mp3_file, '-f', 's16le', '-acodec', 'pcm_s16le',
+           '-ar', str(sample_rate), '-ac', str(channels), 'pipe:1']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        pos, next_turn, active = 0, 0, []
+        while pos < end_frame:
+            data = proc.stdout.read(chunk_frames * frame_width)
+            if not data:
+                # ffmpeg exited before the last turn
+                if proc.wait() != 0:
+                    raise IOError('Failed to decode ' + mp3_file)
+                break
+            chunk_end = pos + len(data) // frame_width
+            while next_turn < len(timeline) and timeline[next_turn][0] < chunk_end:
+                active.append(timeline[next_turn])
+                next_turn += 1
+            view = memoryview(data)
+            for start, stop, key in active:
+                lo, hi = max(start, pos), min(stop, chunk_end)
+                if hi > lo:
+                    sinks[key].write(view[(lo - pos) * frame_width:(hi - pos) * frame_width])
+                    written[key] += hi - lo
+            active = [turn for turn in active if turn[1] > chunk_end]
+            pos = chunk_end
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+    return written
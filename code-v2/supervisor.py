@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Long running supervisor of step2.py, instead of the cron + ps loop of auto.sh.
+#
+# The cases are kept in a persistent queue (the jobs table of the results
+# database), a pool of warm worker processes (forked after step2.py and its
+# dependencies are imported) takes them one at a time. A failure is
+# classified:
+#   transient  network / disk errors, the case is retried with backoff
+#   crash      the worker died (eg. praat core dump), only this worker is
+#              restarted and the case is retried with backoff
+#   timeout    the case ran over case_timeout, the worker is killed and
+#              restarted, the case is retried with backoff
+#   permanent  bad data (no advocates, missing files...), not retried
+# A case failing max_attempts times is failed for good. The results are
+# saved by the parent only, result.csv / fail.csv are exported regularly.
+#
+#   python3 supervisor.py            # process the queue and exit
+#   python3 supervisor.py --watch    # keep running, rescan the json folder
+#   python3 supervisor.py --status   # print the queue
+#   python3 supervisor.py --requeue  # retry the failed cases of the queue
+#
+# Only one supervisor runs at a time (lock file), so auto.sh / cron can
+# start it blindly.
+
+import os, os.path
+import time
+import fcntl
+import signal
+import argparse
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+
+import step2
+import metrics
+from results_store import STATUS_DONE, STATUS_FAILED
+
+lock_path = os.path.join(step2.sample_dir, 'supervisor.lock')
+
+# number of worker processes
+num_workers = step2.num_workers
+# a case is failed for good after this number of attempts
+max_attempts = 3
+# delay before the n-th retry: min(backoff_base * 2 ** (n - 1), backoff_max)
+backoff_base = 30
+backoff_max = 30 * 60
+# kill a worker running a single case longer than this (seconds, None: never)
+case_timeout = 60 * 60
+# in --watch mode, rescan the json folder every scan_interval seconds
+scan_interval = 5 * 60
+# export result.csv / fail.csv every export_interval seconds
+export_interval = 60
+
+# job states
+STATE_PENDING = 'pending'
+STATE_RUNNING = 'running'
+STATE_RETRY = 'retry'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+# failure classes
+ERROR_TRANSIENT = 'transient'
+ERROR_CRASH = 'crash'
+ERROR_TIMEOUT = 'timeout'
+ERROR_PERMANENT = 'permanent'
+
+
+# the failure class of an exception raised by step2.process
+def classify(error):
+    if isinstance(error, FileNotFoundError):
+        # the split mp3 or json files are missing, a retry finds nothing new
+        return ERROR_PERMANENT
+    # DownloadError, connection resets, timeouts, full disk...
+    from downloader import DownloadError
+    if isinstance(error, (DownloadError, OSError, MemoryError)):
+        return ERROR_TRANSIENT
+    return ERROR_PERMANENT
+
+def backoff(attempts):
+    return min(backoff_base * 2 ** (attempts - 1), backoff_max)
+
+
+class CaseQueue(object):
+
+    # the jobs table is kept in the results database, updated with the same
+    # connection (and commits) as the results
+    def __init__(self, store):
+        self.store = store
+        self.conn = store.conn
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                                 case_id TEXT PRIMARY KEY,
+                                 json_file TEXT NOT NULL,
+                                 seq TEXT,
+                                 state TEXT NOT NULL,
+                                 attempts INTEGER NOT NULL DEFAULT 0,
+                                 next_try REAL NOT NULL DEFAULT 0,
+                                 error_class TEXT,
+                                 last_error TEXT)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, next_try)')
+        # the jobs left running by a killed supervisor are not the fault of
+        # the case, they start over
+        self.conn.execute('UPDATE jobs SET state = ? WHERE state = ?', (STATE_PENDING, STATE_RUNNING))
+        self.store.commit()
+
+    # add the json files not known yet, the cases already in the results
+    # (done or failed by step2.py) are skipped. return the number added
+    def sync(self, json_files):
+        known = set(row[0] for row in self.conn.execute('SELECT case_id FROM jobs'))
+        results = dict(self.conn.execute('SELECT case_id, status FROM results').fetchall())
+        total = len(json_files)
+        added = 0
+        for count, json_file in enumerate(json_files, 1):
+            case_id = step2.get_filename_without_ext(json_file)
+            status = results.get(case_id)
+            if case_id in known or status in (STATUS_DONE, STATUS_FAILED):
+                continue
+            seq = '{}/{}'.format(count, total)
+            if status is None:
+                self.conn.execute('INSERT INTO jobs (case_id, json_file, seq, state) VALUES (?, ?, ?, ?)',
+                                  (case_id, json_file, seq, STATE_PENDING))
+            else:
+                # marked processing by a step2.py run which crashed on it
+                self.conn.execute('''INSERT INTO jobs (case_id, json_file, seq, state, attempts, next_try, error_class)
+                                     VALUES (?, ?, ?, ?, 1, 0, ?)''', (case_id, json_file, seq, STATE_RETRY, ERROR_CRASH))
+            added += 1
+        self.store.commit()
+        return added
+
+    # the next job ready to run (case_id, json_file, seq, attempts), None if
+    # there is none
+    def next_ready(self):
+        return self.conn.execute('''SELECT case_id, json_file, seq, attempts FROM jobs
+                                    WHERE state IN (?, ?) AND next_try <= ?
+                                    ORDER BY next_try, rowid LIMIT 1''',
+                                 (STATE_PENDING, STATE_RETRY, time.time())).fetchone()
+
+    # seconds until the next retry is due, None if no job is waiting
+    def next_due(self):
+        res = self.conn.execute('SELECT MIN(next_try) FROM jobs WHERE state IN (?, ?)',
+                                (STATE_PENDING, STATE_RETRY)).fetchone()[0]
+        return None if res is None else max(0, res - time.time())
+
+    def start(self, case_id, seq):
+        self.conn.execute('UPDATE jobs SET state = ?, attempts = attempts + 1 WHERE case_id = ?', (STATE_RUNNING, case_id))
+        self.store.mark_processing(case_id, seq)
+
+    def done(self, case_id):
+        self.conn.execute('UPDATE jobs SET state = ?, error_class = NULL, last_error = NULL WHERE case_id = ?',
+                          (STATE_DONE, case_id))
+
+    # record a failure, return True if the case will be retried
+    def fail(self, case_id, error_class, reason):
+        attempts = self.conn.execute('SELECT attempts FROM jobs WHERE case_id = ?', (case_id,)).fetchone()[0]
+        retry = error_class != ERROR_PERMANENT and attempts < max_attempts
+        self.conn.execute('UPDATE jobs SET state = ?, next_try = ?, error_class = ?, last_error = ? WHERE case_id = ?',
+                          (STATE_RETRY if retry else STATE_FAILED, time.time() + backoff(attempts) if retry else 0,
+                           error_class, reason, case_id))
+        self.store.commit()
+        return retry
+
+    # put the failed jobs back in the queue
+    def requeue(self):
+        n = self.conn.execute('UPDATE jobs SET state = ?, attempts = 0, next_try = 0 WHERE state = ?',
+                              (STATE_PENDING, STATE_FAILED)).rowcount
+        self.store.commit()
+        return n
+
+    def counts(self):
+        return self.conn.execute('''SELECT state, COALESCE(error_class, ''), COUNT(*) FROM jobs
+                                    GROUP BY state, error_class ORDER BY state''').fetchall()
+
+    def busy(self):
+        return self.conn.execute('SELECT COUNT(*) FROM jobs WHERE state IN (?, ?, ?)',
+                                 (STATE_PENDING, STATE_RETRY, STATE_RUNNING)).fetchone()[0] > 0
+
+
+##### worker processes #####
+
+# the loop of a worker: run step2.process on the json files sent by the
+# supervisor, send back (json_file, result, error class, error text)
+def worker_loop(conn):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    while True:
+        json_file = conn.recv()
+        if json_file is None:
+            return
+        try:
+            conn.send((json_file, step2.process(json_file), None, None))
+        except Exception as e:
+            conn.send((json_file, None, classify(e), traceback.format_exc()))
+
+class Worker(object):
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_loop, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        # (case_id, json_file, seq) of the running case
+        self.job = None
+        self.started = None
+
+    def run(self, job):
+        self.job = job
+        self.started = time.time()
+        self.conn.send(job[1])
+
+    def finish(self):
+        job, self.job = self.job, None
+        return job
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, EOFError):
+            pass
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class Supervisor(object):
+
+    def __init__(self, json_dir, workers, watch=False):
+        self.json_dir = json_dir
+        self.watch = watch
+        self.stopping = False
+        self.store = step2.open_result_store()
+        self.queue = CaseQueue(self.store)
+        self.feature_writer = step2.open_feature_writer(self.store)
+        # fork: the workers start warm, with step2.py and its dependencies
+        # (imported lazily by the single case modes) imported in the parent
+        step2.import_dependencies()
+        self.context = multiprocessing.get_context('fork')
+        self.workers = [Worker(self.context) for i in range(max(1, workers))]
+        self.last_scan = 0
+        self.last_export = time.time()
+
+    def scan(self):
+        added = self.queue.sync(step2.obtain_meta_jsons(self.json_dir))
+        self.last_scan = time.time()
+        if added:
+            print('{0} new case(s) queued'.format(added))
+
+    def dispatch(self):
+        for worker in self.workers:
+            if worker.job is not None:
+                continue
+            job = self.queue.next_ready()
+            if job is None:
+                return
+            case_id, json_file, seq, attempts = job
+            self.queue.start(case_id, seq)
+            print('{0} processing {1}{2}'.format(seq, json_file, ' (retry {0})'.format(attempts) if attempts else ''))
+            worker.run((case_id, json_file, seq))
+
+    def on_result(self, worker, message):
+        if worker.job is None:
+            return
+        case_id, json_file, seq = worker.finish()
+        json_file, res, error_class, error = message
+        metrics.emit('progress', seq=seq, case=case_id)
+        if error is None:
+            csv_row, fail_reason, featureRows = res
+            if csv_row is not None:
+                # added first, save_result may commit
+                if self.feature_writer is not None:
+                    self.feature_writer.add(featureRows)
+                self.store.save_result(case_id, seq, csv_row)
+                self.queue.done(case_id)
+                print('{0} Success {1}'.format(seq, case_id))
+                return
+            error_class, reason = ERROR_PERMANENT, fail_reason
+        else:
+            print(error)
+            reason = error.strip().split('\n')[-1]
+        self.on_failure(case_id, seq, error_class, reason)
+
+    def on_failure(self, case_id, seq, error_class, reason):
+        metrics.emit('failure', case=case_id, error_class=error_class, reason=reason)
+        if self.queue.fail(case_id, error_class, reason):
+            print('{0} Failed ({1}), retry later {2}: {3}'.format(seq, error_class, case_id, reason))
+        else:
+            print('{0} Failed ({1}) {2}: {3}'.format(seq, error_class, case_id, reason))
+            self.store.save_failure(case_id, seq, '[{0}] {1}'.format(error_class, reason))
+
+    # replace a dead or killed worker, its case is failed with error_class
+    def restart(self, worker, error_class, reason):
+        worker.kill()
+        if worker.job is not None:
+            case_id, json_file, seq = worker.finish()
+            self.on_failure(case_id, seq, error_class, reason)
+        self.workers[self.workers.index(worker)] = Worker(self.context)
+
+    def check_timeouts(self):
+        if case_timeout is None:
+            return
+        for worker in list(self.workers):
+            if worker.job is not None and time.time() - worker.started > case_timeout:
+                self.restart(worker, ERROR_TIMEOUT, 'running over {0} seconds'.format(case_timeout))
+
+    def wait(self, timeout):
+        conns = dict((worker.conn, worker) for worker in self.workers)
+        sentinels = dict((worker.process.sentinel, worker) for worker in self.workers)
+        for ready in wait(list(conns) + list(sentinels), timeout):
+            if ready in conns:
+                worker = conns[ready]
+                if worker not in self.workers:
+                    continue
+                try:
+                    message = ready.recv()
+                except (EOFError, OSError):
+                    continue
+                self.on_result(worker, message)
+            else:
+                worker = sentinels[ready]
+                if worker in self.workers and not worker.process.is_alive():
+                    self.restart(worker, ERROR_CRASH, 'worker exited with code {0}'.format(worker.process.exitcode))
+
+    def export(self):
+        self.store.export_csv(step2.csv_out_path, step2.csv_fail_out_path, step2.CSV_HEADERS)
+        self.last_export = time.time()
+
+    def run(self):
+        self.scan()
+        try:
+            while not self.stopping:
+                self.dispatch()
+                idle = all(worker.job is None for worker in self.workers)
+                if idle and not self.queue.busy():
+                    if not self.watch:
+                        break
+                    # the queue is drained, write the buffered features
+                    if self.feature_writer is not None:
+                        self.feature_writer.flush()
+                timeout = 1.0
+                due = self.queue.next_due()
+                if idle and due is not None:
+                    timeout = max(timeout, min(due, scan_interval))
+                if self.watch and idle and due is None:
+                    timeout = max(1.0, self.last_scan + scan_interval - time.time())
+                self.wait(timeout)
+                self.check_timeouts()
+                if time.time() - self.last_export > export_interval:
+                    self.export()
+                if self.watch and time.time() - self.last_scan > scan_interval:
+                    self.scan()
+        finally:
+            for worker in self.workers:
+                if worker.job is not None:
+                    worker.kill()
+                else:
+                    worker.stop()
+                    worker.process.join(5)
+            self.export()
+            # also writes the buffered features (before_commit)
+            self.store.close()
+        print('CSV file is saved to:', step2.csv_out_path)
+        return not self.stopping
+
+    def stop(self, signum=None, frame=None):
+        print('Stopping...')
+        self.stopping = True
+
+
+# hold the lock file while running, None if another supervisor holds it
+def acquire_lock(path):
+    f = open(path, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+def print_status():
+    store = step2.open_result_store()
+    queue = CaseQueue(store)
+    for state, error_class, count in queue.counts():
+        print('{0:8s} {1:10s} {2}'.format(state, error_class, count))
+    for case_id, error_class, last_error in store.conn.execute(
+            'SELECT case_id, error_class, last_error FROM jobs WHERE state = ? ORDER BY case_id', (STATE_FAILED,)):
+        print('failed: {0} [{1}] {2}'.format(case_id, error_class, last_error))
+    store.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Run step2.py on a pool of warm workers with a persistent queue')
+    parser.add_argument('--watch', action='store_true', help='keep running and rescan the json folder')
+    parser.add_argument('--workers', type=int, default=num_workers)
+    parser.add_argument('--status', action='store_true', help='print the queue and exit')
+    parser.add_argument('--requeue', action='store_true', help='put the failed cases back in the queue')
+    args = parser.parse_args()
+
+    if args.status:
+        print_status()
+        return
+    lock = acquire_lock(lock_path)
+    if lock is None:
+        print('It is running')
+        return
+    if args.requeue:
+        store = step2.open_result_store()
+        print('{0} case(s) requeued'.format(CaseQueue(store).requeue()))
+        store.close()
+
+    step2.create_dir(step2.textgrid_out_dir, False)
+    step2.reset_status()
+    # the metrics endpoint thread is started after the workers are forked
+    metrics.configure(step2.metrics_path, step2.metrics_port, step2.profile_slowest, step2.profile_dir)
+    supervisor = Supervisor(step2.meta_json_dir, args.workers, args.watch)
+    metrics.serve()
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    signal.signal(signal.SIGINT, supervisor.stop)
+    if supervisor.run():
+        step2.write_status()
+    print('\nDone')
+
+if __name__ == '__main__':
+    main()
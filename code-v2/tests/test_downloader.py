@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Tests of downloader.py against a local stand-in of the mp3 server.
+#
+#   python3 -m unittest discover -s tests      (in code-v2)
+
+import os, os.path
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import http.server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from downloader import Downloader, DownloadError, CHUNK_SIZE, SIZE_SUFFIX
+
+DATA = os.urandom(2 * CHUNK_SIZE + 1000)
+
+
+# serves DATA at any path, with Range requests. A test changes the settings
+# of the server:
+#   cut: the number of the next responses whose body is cut at cut_at bytes
+#   content_length: a wrong Content-Length of the 200 responses
+#   head_status: the status of the HEAD requests
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        server = self.server
+        server.heads += 1
+        self.send_response(server.head_status)
+        self.send_header('Content-Length', str(len(DATA)))
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        server.ranges.append(self.headers.get('Range'))
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= len(DATA):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{0}'.format(len(DATA)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, len(DATA) - 1, len(DATA)))
+            length = len(DATA) - start
+        else:
+            self.send_response(200)
+            length = server.content_length or len(DATA)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        body = DATA[start:]
+        if server.cut > 0:
+            server.cut -= 1
+            body = body[:server.cut_at]
+        self.wfile.write(body)
+        self.wfile.flush()
+        self.close_connection = True
+
+
+class DownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.ranges = []
+        self.server.heads = 0
+        self.server.head_status = 200
+        self.server.cut = 0
+        self.server.cut_at = CHUNK_SIZE + 1000
+        self.server.content_length = None
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.folder = tempfile.mkdtemp()
+        self.url = 'http://127.0.0.1:{0}/files/case.mp3'.format(self.server.server_port)
+        self.path = os.path.join(self.folder, 'case.mp3')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def download(self, retries=3):
+        downloader = Downloader(self.folder, workers=1, timeout=10, retries=retries)
+        try:
+            return downloader.get(self.url)
+        finally:
+            downloader.close()
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        self.assertEqual(self.download(), self.path)
+        self.assertEqual(self.read(self.path), DATA)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        self.assertEqual(self.read(self.path + SIZE_SUFFIX), str(len(DATA)).encode())
+
+    def test_resume_with_range(self):
+        self.server.cut = 1
+        self.download()
+        self.assertEqual(self.read(self.path), DATA)
+        # the chunks read before the connection broke are kept
+        self.assertEqual(self.server.ranges, [None, 'bytes={0}-'.format(CHUNK_SIZE)])
+
+    def test_resume_part_file(self):
+        with open(self.path + '.part', 'wb') as f:
+            f.write(DATA[:1234])
+        self.download()
+        self.assertEqual(self.read(self.path), DATA)
+        self.assertEqual(self.server.ranges, ['bytes=1234-'])
+
+    def test_416_complete_part_file(self):
+        with open(self.path + '.part', 'wb') as f:
+            f.write(DATA)
+        self.download()
+        self.assertEqual(self.read(self.path), DATA)
+        self.assertEqual(self.server.ranges, ['bytes={0}-'.format(len(DATA))])
+
+    def test_416_oversized_part_file(self):
+        with open(self.path + '.part', 'wb') as f:
+            f.write(DATA + b'garbage')
+        # the part file is emptied, the next attempt downloads it again
+        self.download()
+        self.assertEqual(self.read(self.path), DATA)
+        self.assertEqual(self.server.ranges, ['bytes={0}-'.format(len(DATA) + 7), None])
+
+    def test_truncated_body_is_rejected(self):
+        self.server.cut = 10
+        with self.assertRaises(DownloadError):
+            self.download(retries=0)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_content_length_mismatch_is_rejected(self):
+        # the body is complete but shorter than announced
+        self.server.content_length = len(DATA) + 1000
+        with self.assertRaises(DownloadError):
+            self.download(retries=0)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_cached_file_verified_once(self):
+        with open(self.path, 'wb') as f:
+            f.write(DATA)
+        self.download()
+        self.download()
+        self.assertEqual(self.server.heads, 1)
+        self.assertEqual(self.server.ranges, [])
+
+    def test_cached_file_truncated(self):
+        with open(self.path, 'wb') as f:
+            f.write(DATA[:5000])
+        self.download()
+        self.assertEqual(self.read(self.path), DATA)
+        self.assertEqual(self.server.ranges, ['bytes=5000-'])
+
+    def test_cached_file_head_error(self):
+        with open(self.path, 'wb') as f:
+            f.write(DATA[:5000])
+        self.server.head_status = 405
+        self.assertEqual(self.download(), self.path)
+        self.assertEqual(self.read(self.path), DATA[:5000])
+        self.assertEqual(self.server.ranges, [])
+        self.assertFalse(os.path.exists(self.path + SIZE_SUFFIX))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Tests of the interval operations of timeline.py.
+#
+#   python3 -m unittest discover -s tests      (in code-v2)
+
+import os, os.path
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from timeline import (union, intersection, difference, sweep, total_duration, merge_turns,
+                      normalize_speakers)
+
+
+class TimelineTest(unittest.TestCase):
+
+    def assertIntervals(self, a, expected):
+        self.assertEqual([tuple(e) for e in a.tolist()], expected)
+
+    def test_union(self):
+        self.assertIntervals(union([(5, 6), (0, 2), (1, 3), (3, 4), (7, 7)]), [(0, 4), (5, 6)])
+        self.assertIntervals(union([(0, 1), (1.5, 2), (4, 5)], 0.5), [(0, 2), (4, 5)])
+        self.assertIntervals(union([]), [])
+
+    def test_intersection(self):
+        a = [(0, 10), (20, 30)]
+        b = [(5, 25), (28, 40)]
+        self.assertIntervals(intersection(a, b), [(5, 10), (20, 25), (28, 30)])
+        self.assertIntervals(intersection(a, [(10, 20)]), [])
+        self.assertIntervals(intersection(a, []), [])
+
+    def test_difference(self):
+        a = [(0, 10), (20, 30)]
+        self.assertIntervals(difference(a, [(5, 25)]), [(0, 5), (25, 30)])
+        self.assertIntervals(difference(a, []), [(0, 10), (20, 30)])
+        self.assertIntervals(difference(a, [(0, 30)]), [])
+
+    def test_sweep(self):
+        a = [(0, 10)]
+        b = [(5, 15)]
+        # covered by b only
+        self.assertIntervals(sweep(a, b, False, True), [(10, 15)])
+        self.assertIntervals(sweep([], [], True, True), [])
+
+    def test_total_duration(self):
+        self.assertEqual(total_duration([(0, 10), (5, 15), (20, 21)]), 16.0)
+
+    def test_merge_turns(self):
+        turns = [(10, 12, 100, 120), (0, 10, 0, 100), (20, 25, 200, 250), (3, 3, 30, 30)]
+        self.assertEqual(merge_turns(turns), [(0, 12, 0, 120), (20, 25, 200, 250)])
+        self.assertEqual(merge_turns(turns, 8.0), [(0, 25, 0, 250)])
+        # the byte offsets are unknown once a merged turn has none
+        self.assertEqual(merge_turns([(0, 10, 0, 100), (5, 12)]), [(0, 12, None, None)])
+
+    def test_normalize_speakers_bypass(self):
+        speakers = {'a': [(0, 10, 0, 100), (10, 12, 100, 120)], 'b': [(5, 6, 50, 60)]}
+        self.assertIs(normalize_speakers(speakers, None), speakers)
+        self.assertEqual(normalize_speakers(speakers, 0.0)['a'], [(0, 12, 0, 120)])
+
+    def test_normalize_speakers_clip_overlaps(self):
+        speakers = {'a': [(0, 10, 0, 100)], 'b': [(5, 6, 50, 60), (8, 8, 80, 80)], 'c': [(6, 7, 0, 10)]}
+        res = normalize_speakers(speakers, None, clip_overlaps=True)
+        self.assertEqual(res['a'], [(0, 5, 0, 50), (7, 10, 70, 100)])
+        # the turns of b and c are covered by a
+        self.assertEqual(sorted(res), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Interval operations on the turn timeline of a case.
+#
+# The intervals are numpy arrays of shape (n, 2) of (start, stop) seconds,
+# every operation is vectorised (sort + cumulative max / event sweep), no
+# python loop over the turns:
+#   union(a)              sorted, merged disjoint intervals
+#   union(a, gap)         also merge the intervals at most `gap` apart
+#   intersection(a, b)    the time covered by both a and b
+#   difference(a, b)      the time covered by a but not b
+#   total_duration(a)     the time covered by a (overlaps counted once)
+#
+# normalize_speakers cleans a speakerMap {speaker identifier: [(start, stop,
+# byte_start, byte_stop)]} with them before the turns are sliced: empty
+# turns are dropped, the turns of a speaker are sorted and merged when they
+# overlap or are less than `gap` apart, and optionally (clip_overlaps) the
+# time where several speakers talk at once is removed from all of them, so
+# no audio ends up in two speakers' tracks. The byte offsets of a cut turn
+# are interpolated (CBR). With gap None and no clip_overlaps the speakerMap
+# is kept as it is.
+
+import numpy as np
+
+
+# the (start, stop) of turns [(start, stop, ...)] as an (n, 2) array
+def to_array(turns):
+    return np.array([(turn[0], turn[1]) for turn in turns], dtype=np.float64).reshape(-1, 2)
+
+# the intervals of positive length, sorted by start
+def sort_intervals(a):
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 2)
+    a = a[a[:, 1] > a[:, 0]]
+    return a[np.argsort(a[:, 0], kind='stable')]
+
+# the group of each sorted interval once the intervals at most gap apart
+# are merged
+def merge_groups(a, gap=0.0):
+    if len(a) == 0:
+        return np.zeros(0, dtype=np.int64)
+    reach = np.maximum.accumulate(a[:, 1])
+    starts_group = np.ones(len(a), dtype=bool)
+    starts_group[1:] = a[1:, 0] > reach[:-1] + gap
+    return np.cumsum(starts_group) - 1
+
+def union(a, gap=0.0):
+    a = sort_intervals(a)
+    if len(a) == 0:
+        return a
+    groups = merge_groups(a, gap)
+    first = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    return np.stack([a[first, 0], np.maximum.reduceat(a[:, 1], first)], axis=1)
+
+def total_duration(a):
+    u = union(a)
+    return float((u[:, 1] - u[:, 0]).sum())
+
+# the intervals where the coverage of (a, b) matches (in_a, in_b)
+def sweep(a, b, in_a, in_b):
+    a, b = union(a), union(b)
+    times = np.concatenate([a.ravel(), b.ravel()])
+    if len(times) == 0:
+        return np.zeros((0, 2))
+    # +1 at a start, -1 at a stop, for a and b separately
+    da = np.concatenate([np.tile([1, -1], len(a)), np.zeros(2 * len(b), dtype=np.int64)])
+    db = np.concatenate([np.zeros(2 * len(a), dtype=np.int64), np.tile([1, -1], len(b))])
+    order = np.argsort(times, kind='stable')
+    times, ca, cb = times[order], np.cumsum(da[order]), np.cumsum(db[order])
+    selected = ((ca > 0) == in_a) & ((cb > 0) == in_b)
+    res = np.stack([times[:-1], times[1:]], axis=1)[selected[:-1]]
+    return union(res)
+
+def intersection(a, b):
+    return sweep(a, b, True, True)
+
+def difference(a, b):
+    return sweep(a, b, True, False)
+
+
+# the turn (start, stop, byte_start, byte_stop) cut to [start, stop], the
+# byte offsets are interpolated
+def cut_turn(turn, start, stop):
+    byte_start, byte_stop = turn[2], turn[3]
+    length = turn[1] - turn[0]
+    if byte_start is not None and byte_stop is not None and length > 0:
+        rate = (byte_stop - byte_start) / length
+        byte_start, byte_stop = (int(turn[2] + (start - turn[0]) * rate), int(turn[2] + (stop - turn[0]) * rate))
+    return (start, stop, byte_start, byte_stop)
+
+# the turns of a speaker sorted, merged when they overlap or are at most gap
+# apart (the merged turn keeps the byte offsets of its first and last turn)
+def merge_turns(turns, gap=0.0):
+    turns = [tuple(turn) + (None,) * (4 - len(turn)) for turn in turns if turn[1] > turn[0]]
+    if not turns:
+        return []
+    turns.sort(key=lambda turn: turn[0])
+    groups = merge_groups(to_array(turns), gap)
+    res = []
+    for group in np.split(np.arange(len(turns)), np.flatnonzero(np.diff(groups)) + 1):
+        members = [turns[i] for i in group]
+        last = max(members, key=lambda turn: turn[1])
+        first = members[0]
+        byte_start, byte_stop = first[2], last[3]
+        if any(turn[2] is None or turn[3] is None for turn in members):
+            byte_start, byte_stop = None, None
+        res.append((first[0], last[1], byte_start, byte_stop))
+    return res
+
+# the parts of turns outside of the intervals `other` (an union)
+def clip_turns(turns, other):
+    if len(other) == 0:
+        return turns
+    res = []
+    for turn in turns:
+        for start, stop in difference(to_array([turn]), other).tolist():
+            res.append(cut_turn(turn, start, stop))
+    return res
+
+# the cleaned speakerMap, see the top of the file, the speakers left without
+# any turn are dropped
+# gap: merge the turns of a speaker at most gap seconds apart, None: only
+# drop the empty turns (the turns are not merged)
+# clip_overlaps: remove the time several speakers talk at once
+def normalize_speakers(speakerMap, gap=0.0, clip_overlaps=False):
+    if gap is None and not clip_overlaps:
+        return speakerMap
+    if gap is None:
+        merged = dict((key, [turn for turn in turns if turn[1] > turn[0]]) for key, turns in speakerMap.items())
+    else:
+        merged = dict((key, merge_turns(turns, gap)) for key, turns in speakerMap.items())
+    merged = dict((key, turns) for key, turns in merged.items() if turns)
+    if not clip_overlaps or len(merged) < 2:
+        return merged
+    # the time covered by at least two speakers
+    keys = list(merged)
+    unions = [union(to_array(merged[key])) for key in keys]
+    intervals = np.concatenate(unions)
+    if len(intervals) == 0:
+        return merged
+    times = intervals.ravel()
+    deltas = np.tile([1, -1], len(intervals))
+    order = np.argsort(times, kind='stable')
+    times, count = times[order], np.cumsum(deltas[order])
+    overlaps = union(np.stack([times[:-1], times[1:]], axis=1)[count[:-1] > 1])
+    if len(overlaps) == 0:
+        return merged
+    clipped = dict((key, clip_turns(turns, overlaps)) for key, turns in merged.items())
+    return dict((key, turns) for key, turns in clipped.items() if turns)
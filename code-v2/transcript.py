@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Compact model of the Oyez json files of a case, shared by all the stages.
+#
+# A -t01.json transcript (~300 KB) used to be json.load-ed by every helper
+# that needed a piece of it. Here it is parsed once into a small object
+# holding only what the scripts use, the big dict is dropped right away and
+# the parsed object is memoized per file (path, size, mtime).
+
+import os
+import json         # json.load
+import re
+from functools import lru_cache
+
+# const values
+STR_APPELLANT = "appellant"
+STR_APPELLEE = "appellee"
+STR_UNKNOWN = "unknown"
+
+
+class Transcript(object):
+    __slots__ = ('path', 'title', 'media_url', 'media_size', 'speakers', 'texts')
+
+    def __init__(self, path):
+        self.path = path
+        self.title = None
+        # url and size of the audio/mpeg media file (None if there is none)
+        self.media_url = None
+        self.media_size = None
+        # {speaker identifier: [(start, stop, byte_start, byte_stop), ...]}
+        # None if the transcript has no sections
+        self.speakers = None
+        # the text of all the text blocks, in order
+        self.texts = []
+
+    # total talk time (in seconds) of each speaker
+    def durations(self):
+        return dict((key, sum(turn[1] - turn[0] for turn in turns))
+                    for key, turns in (self.speakers or {}).items())
+
+
+class CaseMeta(object):
+    __slots__ = ('path', 'advocates', 'last_names')
+
+    def __init__(self, path):
+        self.path = path
+        # {identifier: appellant / appellee / unknown}, None if the json has
+        # no advocates info
+        self.advocates = None
+        # {identifier: last name without the non-word characters}
+        self.last_names = {}
+
+
+def file_key(json_file):
+    st = os.stat(json_file)
+    return json_file, st.st_size, st.st_mtime_ns
+
+# Parse a -t01.json transcript (memoized, the object must not be modified)
+def load_transcript(json_file):
+    return parse_transcript(*file_key(json_file))
+
+# Parse the meta json of a case (memoized, the object must not be modified)
+def load_case_meta(json_file):
+    return parse_case_meta(*file_key(json_file))
+
+
+@lru_cache(maxsize=16)
+def parse_transcript(json_file, size, mtime):
+    with open(json_file) as f:
+        meta = json.load(f)
+    t = Transcript(json_file)
+    for media in meta.get('media_file') or []:
+        if media['mime'] == 'audio/mpeg':
+            t.media_url = str(media['href'])
+            t.media_size = media.get('size')
+            break
+    transcript = meta.get('transcript') or {}
+    t.title = transcript.get('title')
+    sections = transcript.get('sections')
+    if sections is None:
+        return t
+    t.speakers = {}
+    for section in sections:
+        for turn in section['turns']:
+            for txtBlock in turn.get('text_blocks') or []:
+                t.texts.append(txtBlock['text'])
+            if turn['speaker'] is None:
+                continue
+            id = turn['speaker']['identifier']
+            if not id in t.speakers:
+                t.speakers[id] = []
+            # byte offsets are kept for byte range extraction (see mp3frames.py)
+            t.speakers[id].append((turn['start'], turn['stop'], turn.get('byte_start'), turn.get('byte_stop')))
+    return t
+
+
+@lru_cache(maxsize=16)
+def parse_case_meta(json_file, size, mtime):
+    with open(json_file) as f:
+        meta = json.load(f)
+    m = CaseMeta(json_file)
+    if 'advocates' not in meta:
+        return m
+    m.advocates = {}
+    for adv in meta['advocates']:
+        id = adv['advocate']['identifier']
+        m.last_names[id] = re.sub(r'\W+', '', adv['advocate']['last_name'])
+        m.advocates[id] = get_advocate_role(adv.get('advocate_description'))
+    return m
+
+# appellant / appellee / unknown from the advocate description
+def get_advocate_role(description):
+    # advocate description is missing
+    if description is None:
+        return STR_UNKNOWN
+    description = description.lower()
+    if description.find('appellant') > -1 or description.find('petitioner') > -1:
+        return STR_APPELLANT
+    elif description.find('appellee') > -1 or description.find('respondent') > -1:
+        return STR_APPELLEE
+    return STR_UNKNOWN
+
+# the term of a case id, eg. 1994 for 1994.93-1234 (0 if unknown)
+def get_term(case_id):
+    term = case_id.split('.')[0]
+    return int(term) if term.isdigit() else 0
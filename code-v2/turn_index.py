@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Columnar index of all the speaker turns of a corpus of -t01.json files.
+#
+# The index is a directory of .npy columns (one row per turn, rows grouped
+# by case) plus small json tables:
+#   files.json    {json file name: [size, mtime_ns]}, to update incrementally
+#   cases.json    [[case id, mp3 url], ...], the case column indexes it
+#   speakers.json [speaker identifier, ...], the speaker column indexes it
+# The columns are memory mapped, so "which cases has speaker X argued in" or
+# "total talk time per advocate" never open a json file again.
+#
+# An update writes a new generation of all the files (case.<n>.npy,
+# cases.<n>.json...) and then manifest.json {"generation": n}, the files of
+# the generation before the previous one are removed after. A reader opens
+# the generation of the manifest, so it never sees the columns of two
+# updates, and an interrupted update leaves the previous generation in use.
+# The previous generation is kept for the readers which read the manifest
+# just before the update, a reader which still misses the files of its
+# generation (several updates meanwhile) reads the manifest again.
+#
+# usage: python3 turn_index.py <json dir> <index dir> [speaker identifier]
+
+import os, os.path
+import sys
+import json         # json.dump
+import glob         # glob.glob
+import numpy as np
+
+from transcript import load_transcript
+
+COLUMNS = {'case': np.int32, 'speaker': np.int32, 'start': np.float64, 'stop': np.float64,
+           'byte_start': np.int64, 'byte_stop': np.int64}
+TABLES = ('files', 'cases', 'speakers')
+# the times a reader reads the manifest again when the files of its
+# generation are removed meanwhile
+OPEN_RETRIES = 3
+
+
+# the case id of a -t01.json file, eg. 1986.85-1088
+def get_case_id(json_file):
+    return os.path.basename(json_file)[0:-9]
+
+
+class TurnIndex(object):
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        for i in range(OPEN_RETRIES + 1):
+            # generation None: an index written before the manifest (or no
+            # index yet)
+            self.generation = load_json(os.path.join(index_dir, 'manifest.json'), {}).get('generation')
+            try:
+                self.load()
+                return
+            except FileNotFoundError:
+                # the generation was removed by the updates since the
+                # manifest was read
+                if i == OPEN_RETRIES:
+                    raise
+
+    # read the files of self.generation, they must all exist once the
+    # manifest names the generation
+    def load(self):
+        required = self.generation is not None
+        self.files = load_json(self.path('files', '.json'), {}, required)
+        cases = load_json(self.path('cases', '.json'), [], required)
+        self.case_ids = [case[0] for case in cases]
+        self.mp3_urls = [case[1] for case in cases]
+        self.speaker_ids = load_json(self.path('speakers', '.json'), [], required)
+        self.case_pos = dict((id, i) for i, id in enumerate(self.case_ids))
+        self.speaker_pos = dict((id, i) for i, id in enumerate(self.speaker_ids))
+        self.columns = {}
+        for name, dtype in COLUMNS.items():
+            path = self.path(name, '.npy')
+            if required or os.path.exists(path):
+                self.columns[name] = np.load(path, mmap_mode='r')
+            else:
+                self.columns[name] = np.zeros(0, dtype=dtype)
+
+    def __len__(self):
+        return len(self.columns['case'])
+
+    # the file of a column or a table in the generation of the index
+    def path(self, name, ext, generation=None):
+        if generation is None:
+            generation = self.generation
+        if generation is None:
+            return os.path.join(self.index_dir, name + ext)
+        return os.path.join(self.index_dir, '{0}.{1}{2}'.format(name, generation, ext))
+
+    # True if json_file is in the index and was not modified since
+    def contains(self, json_file):
+        entry = self.files.get(os.path.basename(json_file))
+        if entry is None:
+            return False
+        st = os.stat(json_file)
+        return entry == [st.st_size, st.st_mtime_ns]
+
+    # the row range of a case
+    def case_rows(self, case_id):
+        pos = self.case_pos[case_id]
+        case = self.columns['case']
+        return np.searchsorted(case, pos, 'left'), np.searchsorted(case, pos, 'right')
+
+    def get_mp3_url(self, case_id):
+        return self.mp3_urls[self.case_pos[case_id]]
+
+    # the same map as step1.get_speakers_map, built from the index
+    # {speaker identifier: [(start, stop, byte_start, byte_stop), ...]}
+    def get_speakers_map(self, case_id):
+        lo, hi = self.case_rows(case_id)
+        if lo == hi:
+            return None
+        cols = [np.asarray(self.columns[name][lo:hi]) for name in ('speaker', 'start', 'stop', 'byte_start', 'byte_stop')]
+        speakerMap = {}
+        for speaker, start, stop, byte_start, byte_stop in zip(*[col.tolist() for col in cols]):
+            id = self.speaker_ids[speaker]
+            if not id in speakerMap:
+                speakerMap[id] = []
+            speakerMap[id].append((start, stop,
+                                   byte_start if byte_start >= 0 else None,
+                                   byte_stop if byte_stop >= 0 else None))
+        return speakerMap
+
+    # the case ids a speaker talks in
+    def cases_for_speaker(self, speaker_id):
+        pos = self.speaker_pos.get(speaker_id)
+        if pos is None:
+            return []
+        cases = np.unique(self.columns['case'][self.columns['speaker'] == pos])
+        return [self.case_ids[i] for i in cases]
+
+    # total talk time (in seconds) of every speaker, or of a single one
+    def talk_time(self, speaker_id=None):
+        durations = self.columns['stop'] - self.columns['start']
+        totals = np.bincount(self.columns['speaker'], weights=durations, minlength=len(self.speaker_ids))
+        if speaker_id is not None:
+            pos = self.speaker_pos.get(speaker_id)
+            return 0.0 if pos is None else float(totals[pos])
+        return dict(zip(self.speaker_ids, totals.tolist()))
+
+
+# the default of a missing file, unless it is required (FileNotFoundError)
+def load_json(path, default, required=False):
+    if not required and not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+def save_json(path, obj):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.replace(path + '.tmp', path)
+
+
+# Add the new and modified -t01.json files of json_dir to the index
+# return the updated TurnIndex
+def update_index(json_dir, index_dir):
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    index = TurnIndex(index_dir)
+    changed = []
+    present = set()
+    for json_file in sorted(glob.glob(os.path.join(json_dir, '*-t01.json'))):
+        present.add(os.path.basename(json_file))
+        if not index.contains(json_file):
+            changed.append(json_file)
+    removed = set(index.files) - present
+    if not changed and not removed:
+        return index
+
+    # drop the rows of the modified and removed files
+    drop = set(get_case_id(f) for f in changed) | set(get_case_id(f) for f in removed)
+    keep = ~np.isin(index.columns['case'], [index.case_pos[id] for id in drop if id in index.case_pos])
+    columns = dict((name, [np.asarray(col[keep])]) for name, col in index.columns.items())
+    cases = [[id, url] for id, url in zip(index.case_ids, index.mp3_urls)]
+    speaker_ids = list(index.speaker_ids)
+    speaker_pos = dict(index.speaker_pos)
+    case_pos = dict(index.case_pos)
+    files = dict((name, entry) for name, entry in index.files.items() if name not in removed)
+
+    for json_file in changed:
+        print('index', json_file)
+        t = load_transcript(json_file)
+        case_id = get_case_id(json_file)
+        if case_id not in case_pos:
+            case_pos[case_id] = len(cases)
+            cases.append([case_id, t.media_url])
+        else:
+            cases[case_pos[case_id]][1] = t.media_url
+        rows = []
+        for id, turns in (t.speakers or {}).items():
+            if id not in speaker_pos:
+                speaker_pos[id] = len(speaker_ids)
+                speaker_ids.append(id)
+            for turn in turns:
+                rows.append((case_pos[case_id], speaker_pos[id], turn[0], turn[1],
+                             -1 if turn[2] is None else turn[2], -1 if turn[3] is None else turn[3]))
+        # keep the turns of a speaker in the time order of the transcript
+        rows.sort(key=lambda row: (row[1], row[2]))
+        for i, name in enumerate(COLUMNS):
+            columns[name].append(np.array([row[i] for row in rows], dtype=COLUMNS[name]))
+        st = os.stat(json_file)
+        files[os.path.basename(json_file)] = [st.st_size, st.st_mtime_ns]
+
+    columns = dict((name, np.concatenate(parts)) for name, parts in columns.items())
+    # rows grouped by case, see TurnIndex.case_rows
+    order = np.argsort(columns['case'], kind='stable')
+    generation = (index.generation or 0) + 1
+    for name, dtype in COLUMNS.items():
+        np.save(index.path(name, '.npy', generation), columns[name][order].astype(dtype))
+    save_json(index.path('cases', '.json', generation), cases)
+    save_json(index.path('speakers', '.json', generation), speaker_ids)
+    save_json(index.path('files', '.json', generation), files)
+    # written last, the readers switch to the new generation at once
+    save_json(os.path.join(index_dir, 'manifest.json'), {'generation': generation})
+    # the readers of the previous generation may still be opening it, the one
+    # before is removed (the mapped columns of its readers stay valid)
+    if index.generation is not None:
+        old = index.generation - 1
+        for name in list(COLUMNS) + list(TABLES):
+            ext = '.npy' if name in COLUMNS else '.json'
+            # generation 0: the files written before the manifest
+            path = index.path(name, ext, old) if old > 0 else os.path.join(index_dir, name + ext)
+            if os.path.exists(path):
+                os.remove(path)
+    return TurnIndex(index_dir)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('usage: python3 turn_index.py <json dir> <index dir> [speaker identifier]')
+        sys.exit(-1)
+    index = update_index(sys.argv[1], sys.argv[2])
+    print('{0} turns of {1} cases, {2} speakers'.format(len(index), len(index.case_ids), len(index.speaker_ids)))
+    if len(sys.argv) > 3:
+        speaker = sys.argv[3]
+        print('cases of', speaker, ':', index.cases_for_speaker(speaker))
+        print('talk time of', speaker, ':', round(index.talk_time(speaker), 1), 'seconds')
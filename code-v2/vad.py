@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+
+# Energy based voice activity detection on decoded PCM.
+#
+# The turns cut by their start / stop contain silences, paper shuffling and
+# the tail of the other speakers. The samples are cut in frames of
+# FRAME_SECONDS and the energy (dBFS) of every frame is computed at once
+# with numpy. A frame is speech if it is louder than a threshold adapted to
+# the clip: MARGIN_DB above its noise floor (the quietest frames), at most
+# half way between the noise floor and the loud frames, never under
+# FLOOR_DB. The bursts of speech shorter than MIN_SPEECH_SECONDS (clicks,
+# shuffling) are dropped, and HANGOVER_SECONDS are kept around the speech so
+# the onsets and the ends of the words are not cut.
+#
+#   runs = speech_runs(samples, sample_rate)     # [(start, stop)] samples
+#   trimmed = keep_runs(samples, runs)
+#
+# The speech ratio (kept / total) of each speaker is reported to metrics.py
+# as a 'speech_ratio' event.
+
+import numpy as np
+
+import metrics
+from stream_decode import SAMPLE_WIDTH
+
+FRAME_SECONDS = 0.03
+FLOOR_DB = -50.0
+MARGIN_DB = 12.0
+NOISE_PERCENTILE = 10
+LOUD_PERCENTILE = 90
+MIN_SPEECH_SECONDS = 0.1
+HANGOVER_SECONDS = 0.2
+# VadSink decides on blocks of this length
+BLOCK_SECONDS = 10
+
+
+# the settings of the trimming, part of the cache keys of the results
+# computed on trimmed samples
+def params():
+    return [FRAME_SECONDS, FLOOR_DB, MARGIN_DB, NOISE_PERCENTILE, LOUD_PERCENTILE,
+            MIN_SPEECH_SECONDS, HANGOVER_SECONDS]
+
+
+# the energy (dBFS) of the frames of mono samples (float in [-1, 1]), the
+# last frame is zero padded
+def frame_energy(samples, frame_len):
+    n = -(-len(samples) // frame_len)
+    frames = np.zeros(n * frame_len)
+    frames[:len(samples)] = samples
+    rms = np.sqrt((frames.reshape(n, frame_len) ** 2).mean(axis=1))
+    return 20 * np.log10(rms + 1e-10)
+
+# the threshold (dBFS) of the speech frames of a clip
+def speech_threshold(energy):
+    noise = np.percentile(energy, NOISE_PERCENTILE)
+    loud = np.percentile(energy, LOUD_PERCENTILE)
+    if loud - noise < MARGIN_DB:
+        # no quiet part (or no loud part): the whole clip is one or the other
+        return FLOOR_DB
+    return max(FLOOR_DB, min(noise + MARGIN_DB, (noise + loud) / 2))
+
+# the (start, stop) indices of the runs of True of a boolean array
+def true_runs(mask):
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return np.stack([np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)], axis=1)
+
+# the speech frames of the frame energies
+def speech_frames(energy):
+    mask = energy > speech_threshold(energy)
+    runs = true_runs(mask)
+    # drop the short bursts
+    runs = runs[runs[:, 1] - runs[:, 0] >= max(1, int(round(MIN_SPEECH_SECONDS / FRAME_SECONDS)))]
+    # keep the hangover around the speech
+    hangover = int(round(HANGOVER_SECONDS / FRAME_SECONDS))
+    edges = np.zeros(len(energy) + 1, dtype=np.int64)
+    np.add.at(edges, np.maximum(runs[:, 0] - hangover, 0), 1)
+    np.add.at(edges, np.minimum(runs[:, 1] + hangover, len(energy)), -1)
+    return np.cumsum(edges[:-1]) > 0
+
+# the (start, stop) sample indices of the speech of mono samples (float in
+# [-1, 1]), an (n, 2) array
+def speech_runs(samples, sample_rate):
+    if len(samples) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    frame_len = max(1, int(FRAME_SECONDS * sample_rate))
+    runs = true_runs(speech_frames(frame_energy(samples, frame_len))) * frame_len
+    return np.minimum(runs, len(samples))
+
+# the rows of an array (samples, or frames of samples) inside the runs
+def keep_runs(data, runs):
+    if len(runs) == 0:
+        return data[:0]
+    return np.concatenate([data[start:stop] for start, stop in runs])
+
+# the speech of mono samples (float in [-1, 1])
+def trim_samples(samples, sample_rate):
+    return keep_runs(samples, speech_runs(samples, sample_rate))
+
+# the speech of interleaved PCM (little endian signed, sample_width bytes),
+# return (data, kept frames, total frames)
+def trim_pcm(data, sample_rate, channels, sample_width=SAMPLE_WIDTH):
+    pcm = np.frombuffer(data, dtype='<i{0}'.format(sample_width))
+    frames = pcm[:len(pcm) - len(pcm) % channels].reshape(-1, channels)
+    mono = frames.mean(axis=1) / float(1 << (8 * sample_width - 1))
+    kept = keep_runs(frames, speech_runs(mono, sample_rate))
+    return kept.tobytes(), len(kept), len(frames)
+
+# report the speech ratio of a speaker
+def report(speaker, speech_seconds, seconds):
+    ratio = speech_seconds / seconds if seconds > 0 else 0.0
+    print('speech ratio of {0}: {1:.2f} ({2:.1f}s of {3:.1f}s)'.format(speaker, ratio, speech_seconds, seconds))
+    metrics.emit('speech_ratio', case=metrics.current_case(), speaker=speaker, ratio=round(ratio, 4),
+                 speech_seconds=round(speech_seconds, 3), seconds=round(seconds, 3))
+    return ratio
+
+# the speech of the mono samples of a speaker
+def trim_speech(speaker, samples, sample_rate):
+    with metrics.stage('vad') as m:
+        speech = trim_samples(samples, sample_rate)
+        m['seconds_in'] = len(samples) / float(sample_rate)
+        m['speech_seconds'] = len(speech) / float(sample_rate)
+    report(speaker, m['speech_seconds'], m['seconds_in'])
+    return speech
+
+# the speech of the track of a speaker (a pydub AudioSegment)
+def trim_track(speaker, segment):
+    if segment.sample_width not in (2, 4):
+        # 8 and 24 bit samples are left as they are
+        return segment
+    with metrics.stage('vad') as m:
+        data, kept, total = trim_pcm(segment.raw_data, segment.frame_rate, segment.channels, segment.sample_width)
+        m['seconds_in'] = total / float(segment.frame_rate)
+        m['speech_seconds'] = kept / float(segment.frame_rate)
+    report(speaker, m['speech_seconds'], m['seconds_in'])
+    return segment._spawn(data)
+
+
+# a sink (stream_decode.py) writing only the speech of the samples to sink,
+# decided on blocks of BLOCK_SECONDS
+class VadSink(object):
+
+    def __init__(self, sink, speaker, sample_rate, channels):
+        self.sink = sink
+        self.speaker = speaker
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.block_bytes = BLOCK_SECONDS * sample_rate * SAMPLE_WIDTH * channels
+        self.buffer = bytearray()
+        self.kept = 0
+        self.total = 0
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_bytes:
+            self.flush(self.block_bytes)
+
+    def flush(self, size):
+        data, kept, total = trim_pcm(bytes(self.buffer[:size]), self.sample_rate, self.channels)
+        del self.buffer[:size]
+        self.kept += kept
+        self.total += total
+        if data:
+            self.sink.write(data)
+
+    def close(self):
+        if self.buffer:
+            self.flush(len(self.buffer) - len(self.buffer) % (SAMPLE_WIDTH * self.channels))
+        self.sink.close()
+        report(self.speaker, self.kept / float(self.sample_rate), self.total / float(self.sample_rate))
@@ -1,81 +1,148 @@
 #!/usr/bin/env python3
 # -*- encoding:utf-8 -*-
 
-from pydub import AudioSegment
 import os, os.path  # os.path.sep
 import sys          # sys.exit
-import json         # json.load
 import shutil       # shutil.rmtree
-import requests     # requests.get
 import glob         # glob.glob
 
 # get the current directory of the script
 cur_dir_path = os.path.dirname(os.path.realpath(__file__))
 
+# the shared helpers live next to the step scripts
+sys.path.insert(0, os.path.join(cur_dir_path, 'code-v2'))
+from transcript import load_transcript
+import metrics
+from stream_decode import stream_turns, EncoderSink
+from encoder_pool import EncoderPool, encoder_options, default_workers
+from mp3frames import probe_mp3, check_turns, extract_turns, ByteRangeError
+# pydub, numpy (timeline.py, segments.py, speaker_view.py) and requests
+# (downloader.py) are imported by the functions using them
+
 # !!! UPDATE THE DIRECTORY FOR YOUR CASES !!!
 # store the splited mp3 files for each speaker
 output_dir = cur_dir_path + '/out'
 # store the downloaded mp3 file (to cache the downloaded mp3 file)
 mp3_folder = cur_dir_path + '/mp3'
+# cut the turns by the byte offsets of the json instead of decoding the mp3
+# (falls back to decoding if the offsets are missing or inconsistent)
+byte_range_mode = True
+# decode the mp3 as a stream and route the turns to the outputs on the fly,
+# the memory used does not grow with the length of the argument
+streaming_decode = False
+# drop the silences and the noises of the turns (vad.py) before they are
+# encoded, the speech ratio of every speaker goes to the metrics (the byte
+# range mode copies the mp3 frames without decoding them, nothing is dropped)
+vad_trim = False
+# only export some speakers / turns, picked from the turn metadata before
+# any audio is decoded (None: every speaker, every turn)
+export_top_k = None             # the top k speakers by talk time
+export_first_turns = None       # the first n turns of each speaker
+export_first_seconds = None     # the first n seconds of talk of each speaker
+# codec of the per-speaker files: 'mp3', 'opus' or 'flac' (see encoder_pool.py)
+# the byte range mode only applies to mp3, the others are always re-encoded
+export_codec = 'mp3'
+# bitrate of the encoder, eg. '32k' (None: ffmpeg default, ignored by flac)
+export_bitrate = None
+# number of speakers encoded at the same time
+export_workers = default_workers
+# json lines file of the per-stage metrics (see metrics.py), None to disable
+metrics_path = cur_dir_path + '/metrics.jsonl'
+# serve the Prometheus text endpoint on this port (None: no endpoint)
+metrics_port = None
+# keep the sampling profiles of the N slowest cases in profile_dir (0: off)
+profile_slowest = 0
+profile_dir = cur_dir_path + '/profiles'
+# number of concurrent mp3 downloads
+download_workers = 4
+# clean the turns before slicing them (see timeline.py): merge the turns of
+# a speaker at most turn_merge_gap seconds apart (and the overlapping or
+# touching ones), None: the turns are sliced as in the json
+# clip_overlapping_turns: also remove the time where several speakers talk
+# at once from all of them.
+# Both change the slices (and the F0) of some cases, off to keep the results
+# of the earlier runs
+turn_merge_gap = None
+clip_overlapping_turns = False
+# plan the extraction from the turn index built by turn_index.py instead of
+# the json files (None: read the json files)
+turn_index_dir = None
+
+# the downloader of this process, the batch workers create their own one
+downloader, downloader_pid = None, None
+
+def get_downloader():
+    global downloader, downloader_pid
+    if downloader is None or downloader_pid != os.getpid():
+        from downloader import Downloader
+        downloader, downloader_pid = Downloader(mp3_folder, download_workers), os.getpid()
+    return downloader
 
 # To download a mp3 file by given the URL of it (skip if already exists)
 # return the local file path.
 def download_mp3(url):
-    filename = url.split('/')[-1]
-    filepath = os.path.join(mp3_folder, str(filename))
-    if os.path.exists(filepath): # mp3 file already exists, skip download
-        print ('Skip to download mp3 from web, it already exists')
-        return filepath
-    r = requests.get(url)
-    with open(filepath, 'wb') as fd:
-        fd.write(r.content)
+    with metrics.stage('download') as m:
+        filepath = get_downloader().get(url)
+        m['bytes'] = os.path.getsize(filepath)
     return filepath
 
+# the encoder pool of this process
+encoder_pool = None
+
+def get_encoder_pool():
+    global encoder_pool
+    if encoder_pool is None:
+        encoder_pool = EncoderPool(export_codec, export_bitrate, export_workers)
+    return encoder_pool
+
+# the turn index of the corpus (see turn_index.py), None if it is not used
+turn_index = None
+
+def get_turn_index():
+    global turn_index
+    if turn_index is None and turn_index_dir is not None:
+        from turn_index import TurnIndex
+        turn_index = TurnIndex(turn_index_dir)
+    return turn_index
+
 # Parse the json file and analysis each speakers turns
+# {speaker identifier: [(start, stop, byte_start, byte_stop), ...]}
 def get_speakers_map(json_file):
-    speakerMap = {}
-    with open(json_file) as f:
-        meta = json.load(f)
-        sections = meta['transcript']['sections']
-        for section in sections:
-            for turn in section['turns']:
-                start = turn['start']
-                stop = turn['stop']
-                if turn['speaker'] is None:
-                    continue
-                id = turn['speaker']['identifier']
-                if not id in speakerMap:
-                    speakerMap[id] = []
-                speakerMap[id].append((start, stop))
-    return speakerMap
+    index = get_turn_index()
+    if index is not None and index.contains(json_file):
+        speakers = index.get_speakers_map(os.path.basename(json_file)[0:-9])
+    else:
+        with metrics.stage('parse'):
+            speakers = load_transcript(json_file).speakers
+    if speakers is None:
+        return None
+    from timeline import normalize_speakers
+    return normalize_speakers(speakers, turn_merge_gap, clip_overlapping_turns)
 
 # Parse the mp3 url from the json file
 def get_mp3_url(json_file):
-    with open(json_file) as f:
-        meta = json.load(f)
-        for media in meta['media_file']:
-            if media['mime'] == 'audio/mpeg':
-                return str(media['href'])
-    return None
+    index = get_turn_index()
+    if index is not None and index.contains(json_file):
+        return index.get_mp3_url(os.path.basename(json_file)[0:-9])
+    return load_transcript(json_file).media_url
 
 # Load the sound from mp3 file
 def load_sound_from_mp3(filepath):
-    return AudioSegment.from_mp3(filepath)
+    from pydub import AudioSegment
+    with metrics.stage('decode') as m:
+        sound = AudioSegment.from_mp3(filepath)
+        m['samples'] = int(sound.frame_count())
+    return sound
 
 # Save a sound to the mp3 file
 def save_to_mp3(filepath, sound):
-    sound.export(filepath, format="mp3")
+    with metrics.stage('encode', samples=int(sound.frame_count())):
+        sound.export(filepath, format="mp3")
 
 # process for a single speaker's sound
 def process_speaker(speakerTurns, sound):
-    result = None
-    for turn in speakerTurns:
-        start, stop = turn[0] * 1000, turn[1] * 1000
-        if result is None:
-            result = sound[start:stop]
-        else:
-            result = result + sound[start:stop]
-    return result
+    from segments import gather_turns
+    return gather_turns(speakerTurns, sound)
 
 # create the directory, if force_empty is true, it will
 # delete the existing directory
@@ -93,6 +160,10 @@ def create_dir(dir_path, force_empty=True):
 
 # process for a single json file
 def process(json_file):
+    with metrics.case(os.path.basename(json_file)[0:-9]):
+        process_case(json_file)
+
+def process_case(json_file):
     print ('Processing json file:', json_file)
     mp3_url = get_mp3_url(json_file)
     print ('mp3 url is:', mp3_url)
@@ -105,12 +176,57 @@ def process(json_file):
     cur_output_dir = os.path.join(output_dir, filename_without_ext)
     create_dir(cur_output_dir)
 
-    speakerMap = get_speakers_map(json_file)
+    from speaker_view import CaseView
+    speakerMap = CaseView(get_speakers_map(json_file)).select(
+        top_k=export_top_k, first_turns=export_first_turns, first_seconds=export_first_seconds)
+    if byte_range_mode and export_codec == 'mp3':
+        try:
+            process_by_bytes(speakerMap, mp3_file, cur_output_dir)
+            return
+        except ByteRangeError as e:
+            print('Byte range extraction failed, fall back to decoding:', e)
+    if streaming_decode:
+        process_by_streaming(speakerMap, mp3_file, cur_output_dir)
+        return
+    from segments import gather_speakers
     sound = load_sound_from_mp3(mp3_file)
+    tracks = gather_speakers(speakerMap, sound)
+    del sound
+    if vad_trim:
+        from vad import trim_track
+        tracks = dict((key, trim_track(key, track)) for key, track in tracks.items())
+    # every speaker is piped to its own encoder, in parallel
+    get_encoder_pool().export(tracks, cur_output_dir)
+
+# cut every speaker's turns out of the mp3 by the byte offsets of the json,
+# without decoding the mp3
+def process_by_bytes(speakerMap, mp3_file, cur_output_dir):
+    info = probe_mp3(mp3_file)
+    # check all the offsets first, so a bad json never leaves half of the speakers
+    for key in speakerMap:
+        check_turns(speakerMap[key], info)
     for key in speakerMap:
-        sub_sound = process_speaker(speakerMap[key], sound)
         cur_output_path = os.path.join(cur_output_dir, key + '.mp3')
-        save_to_mp3(cur_output_path, sub_sound)
+        with metrics.stage('byte_range') as m:
+            m['bytes'] = extract_turns(mp3_file, speakerMap[key], cur_output_path, info)
+
+# decode the mp3 as a stream and encode every speaker's turns on the fly
+def process_by_streaming(speakerMap, mp3_file, cur_output_dir):
+    info = probe_mp3(mp3_file)
+    ext, options = encoder_options(export_codec, export_bitrate)
+    sinks = {}
+    try:
+        for key in speakerMap:
+            cur_output_path = os.path.join(cur_output_dir, key + ext)
+            sinks[key] = EncoderSink(cur_output_path, info['sample_rate'], info['channels'], options)
+            if vad_trim:
+                from vad import VadSink
+                sinks[key] = VadSink(sinks[key], key, info['sample_rate'], info['channels'])
+        with metrics.stage('stream_decode') as m:
+            m['samples'] = sum(stream_turns(mp3_file, speakerMap, sinks, info['sample_rate'], info['channels']).values())
+    finally:
+        for sink in sinks.values():
+            sink.close()
 
 # process for multiple json files by given the file pattens
 def process_in_batch(json_path_pat):
@@ -119,6 +235,9 @@ def process_in_batch(json_path_pat):
 
 
 if __name__ == '__main__':
+    metrics.configure(metrics_path, metrics_port, profile_slowest, profile_dir)
+    # no worker process here, the encoders are threads
+    metrics.serve()
     create_dir(output_dir)
     create_dir(mp3_folder, False)
 